@@ -15,8 +15,110 @@ class Config:
     CODE_LIST = []
     CODE_SAVE_DIR = os.path.join(BASE_DIR, "storage", "save", "code")
     
+    # 提出物のzipの展開方法
+    #   "background": プロセスプールで展開する。展開が終わるまで、そのレポートは「展開中」と表示する
+    #   "direct": PDFのzipは展開せず、ページ画像を作るときにzipから直接読む（プログラムのzipは "background" と同じ）
+    #   "sync": 起動時・再読み込み時に、全て展開し終わってから続ける
+    UNZIP_MODE = "background"
+    UNZIP_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+
+    # PDF_BASE_DIR・CODE_BASE_DIR に追加・削除された提出フォルダやzipを、自動でレポートの一覧に反映する
+    # inotify が使えない環境では WATCH_INTERVAL 秒ごとにフォルダを確認する
+    # 更新されてから WATCH_DEBOUNCE 秒経っていないzipは、コピー中とみなして後で読む
+    WATCH_ENABLED = True
+    WATCH_INTERVAL = 2.0
+    WATCH_DEBOUNCE = 1.0
+
+    # 起動時の提出フォルダのスキャン
+    #   "background": 別のスレッドで行い、すぐにリクエストを受け付ける（終わるまで課題一覧は「読み込み中」と表示する）
+    #   "sync": スキャンし終わってから起動する（本番用の wsgi.py では常にこちら）
+    STARTUP_SCAN = "background"
+
+    # 提出物の索引が、フォルダの更新を確認する間隔（秒）
+    CATALOG_CHECK_INTERVAL = 2.0
+    # 学生名簿のキャッシュに保持するレポート数
+    STUDENT_ROSTER_CACHE_SIZE = 32
+
+    # PDFページ画像のバックグラウンド事前生成（プロセスプール）
+    PRERENDER_ENABLED = True
+    PRERENDER_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+    # ビューアを開いたときに画像を先読みしておく、次の未完了の学生の人数
+    PREFETCH_COUNT = 3
+    # PDFページ画像の形式 ("PNG", "JPEG", "WEBP")、JPEG/WEBP の画質、解像度 (DPI)
+    # 変更すると、次に表示したときに画像が作り直される
+    IMAGE_FORMAT = "WEBP"
+    IMAGE_QUALITY = 85
+    IMAGE_DPI = 200
+    # ビューアに表示するサムネイルの横幅 (px)。0 にするとサムネイルを作らず原寸の画像を表示する
+    # 原寸の画像は、画像をクリックして拡大表示したときに読み込む
+    THUMBNAIL_WIDTH = 1000
+    # 画像の回転に使うスレッド数
+    ROTATE_WORKERS = 4
+    # ビューアで画像を1ページずつ受け取って表示する (Server-Sent Events)
+    IMAGE_STREAMING = True
+
     REPORT_SETTINGS_FILE = 'report_settings.json'
     SAVE_DIR = os.path.join(BASE_DIR, "storage", "save")
+
+    # 採点結果の保存先 ("json": 学生ごとのJSONファイル, "sqlite": GRADE_DB_PATH のデータベース)
+    # 切り替えるときは flask --app run import-grades / export-grades で移行する
+    GRADE_STORE = "json"
+    GRADE_DB_PATH = os.path.join(SAVE_DIR, "grades.sqlite3")
+    # 提出されたPDFの内容のハッシュの索引（同じ内容の提出物の判定に使う）
+    CONTENT_HASH_INDEX_PATH = os.path.join(SAVE_DIR, "pdf_hashes.json")
+    # 別の学生のページ画像が似ているもの（書き写し・コピーの疑い）を探すときの、知覚ハッシュのハミング距離の上限 (0-64)
+    # PAGE_HASH_MAX_SHARE より多くの割合の学生に似たページがあるページは、配布した問題用紙などとみなして数えない
+    PAGE_HASH_DISTANCE = 8
+    PAGE_HASH_MAX_SHARE = 0.5
+    # 名簿・出席のExcelファイルを読み込んだ結果を保存しておくフォルダ
+    WORKBOOK_CACHE_DIR = os.path.join(SAVE_DIR, "workbook_cache")
+    # プログラムの提出物を、課題ごとのテストケース (CODE_SAVE_DIR/<課題>_tests.json) で実行する
+    # CODE_RUN_WORKERS 個のプロセスで並列に実行し、結果は (提出物のハッシュ, テストのハッシュ) ごとに
+    # CODE_RESULT_CACHE_DIR に保存する（テストも提出物も変わっていなければ実行し直さない）
+    CODE_RUN_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+    CODE_RESULT_CACHE_DIR = os.path.join(SAVE_DIR, "code_results")
+    # プログラムの提出物のファイルの内容のハッシュの索引（サイズと更新時刻が変わったファイルだけ読み直す）
+    CODE_HASH_INDEX_PATH = os.path.join(SAVE_DIR, "code_hashes.json")
+    # 提出されたプログラムの隔離の方法。テストケースごとに提出物を新しい一時フォルダにコピーして実行する
+    #   "bwrap": bubblewrap で、新しい名前空間（ネットワークなし）に読み込み専用のシステムのフォルダと
+    #            作業フォルダだけを見せて実行する。保存フォルダ（テストの期待出力）や他の学生の提出物は見えない
+    #   "unshare": util-linux の unshare で同じ環境を作る（root でなければ、ユーザー名前空間が使えること）
+    #   "user": root で動かしているときに、CODE_SANDBOX_USER の権限で実行するだけ。
+    #           他のユーザーが読めるファイル（保存フォルダの権限による）は読めてしまい、ネットワークも使える。
+    #           Python も CODE_SANDBOX_USER が読める場所にあること
+    #   "none": 隔離しない。CPU時間・メモリ・出力の大きさを制限するだけで、提出物は
+    #           サーバーと同じ権限で保存フォルダのテストの期待出力を読んだり、採点結果を書き換えたりできる
+    #   "auto": bwrap, unshare, user の順に、この環境で動くものを選ぶ
+    #           どれも動かなければ提出物を実行せず、テストケースごとにエラーにする（隔離しないときは "none" を指定する）
+    # root で動かしているときは、bwrap・unshare でも CODE_SANDBOX_USER の権限で実行する
+    # ノートブックの提出物 (NOTEBOOK_KERNELS のカーネル) も同じように隔離し、メモリを制限する
+    CODE_SANDBOX = "auto"
+    CODE_SANDBOX_USER = "nobody"
+    # テストの設定の mode が "notebook" の課題（Jupyter ノートブックの提出物）を実行するカーネルの数
+    # 提出物ごとに新しいカーネルで実行し、使ったカーネルは捨てる（前の学生の変数やモジュールの変更を引き継がない）
+    # 実行している間に次のカーネルを起動しておく（0 にするとノートブックを実行しない）
+    NOTEBOOK_KERNELS = 4
+    NOTEBOOK_MEMORY_MB = 2048
+    # プログラムの提出物の類似度（コピーの疑い）を調べる索引 (MOSS と同じ winnowing の指紋)
+    # 課題ごとに SIMILARITY_INDEX_DIR/<課題>.json に保存し、内容が変わったファイルだけ指紋を作り直す
+    # SIMILARITY_KGRAM 字句の並びのハッシュから、SIMILARITY_WINDOW 個ごとに1つ指紋を選ぶ
+    # （変更すると索引を作り直す）。SIMILARITY_MAX_HOLDERS 人より多くの学生、または SIMILARITY_MAX_SHARE より
+    # 多くの割合の学生が持つ指紋は、配布したコードなどとみなして数えない（MOSS の -m と同じ。大きくすると、
+    # 1つの指紋から数える学生の組が人数の2乗で増える）。似ている組を SIMILARITY_TOP_K 組表示する
+    SIMILARITY_INDEX_DIR = os.path.join(SAVE_DIR, "similarity")
+    SIMILARITY_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+    SIMILARITY_KGRAM = 12
+    SIMILARITY_WINDOW = 8
+    SIMILARITY_MAX_SHARE = 0.1
+    SIMILARITY_MAX_HOLDERS = 10
+    SIMILARITY_TOP_K = 50
+
+    # 複数のワーカープロセスで動かすとき（本番用の wsgi.py から起動すると有効になる）に、
+    # レポートの一覧・評価の設定・採点結果の更新の通知をプロセス間で共有するデータベース
+    SHARED_STATE_ENABLED = False
+    SHARED_STATE_PATH = os.path.join(SAVE_DIR, "shared_state.sqlite3")
+    # 画像の事前生成・zipの展開・フォルダの監視を行うプロセスを1つに決めるためのロックファイル
+    BACKGROUND_LOCK_PATH = os.path.join(SAVE_DIR, "background.lock")
     
     # 必要に応じて、自動でフォルダを作成するための設定
     OS_MAKEDIRS = [PDF_BASE_DIR, CODE_BASE_DIR, IMAGE_DIR, PDF_SAVE_DIR, CODE_SAVE_DIR]
\ No newline at end of file
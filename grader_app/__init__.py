@@ -1,21 +1,62 @@
 import os
+import multiprocessing
 from flask import Flask
-from grader_app.utils import refresh_app_config, load_report_settings
+from grader_app.utils import load_report_settings
 
 
-def create_app():
+def create_app(production=False):
+    """
+    production=True は本番用のサーバー (wsgi.py) から呼ぶ場合。
+    複数のワーカープロセスで動かせるよう、プロセス間で状態を共有する (SHARED_STATE_ENABLED)。
+    """
     app = Flask(__name__)
     
     # 文字列指定よりも、オブジェクトを直接渡す方が確実です
     from config import Config
     app.config.from_object(Config)
+    if production:
+        app.config['SHARED_STATE_ENABLED'] = True
+        # gunicorn の preload_app では、フォークする前にスキャンを終えておく（warm_caches もレポートの一覧を使う）
+        app.config['STARTUP_SCAN'] = 'sync'
 
     # フォルダが存在しない場合に自動作成（エラー防止）
     for path in app.config.get('OS_MAKEDIRS', []):
         os.makedirs(path, exist_ok=True)
 
-    with app.app_context():
-        refresh_app_config(app)
+    # 画像の事前生成用プロセスプールの子プロセスでは、フォルダのスキャンなどは行わない
+    # (spawnの子プロセスは起動スクリプトを読み込み直すため、ここを通る)
+    if multiprocessing.current_process().name != "MainProcess":
+        return app
+
+    from .pdf_grader.prerender import create_prerenderer
+    create_prerenderer(app)
+
+    from .archive import create_extractor
+    create_extractor(app)
+
+    from .code_grader.runner import create_code_runner
+    create_code_runner(app)
+
+    from .code_grader.similarity import create_similarity_index
+    create_similarity_index(app)
+
+    from .models import create_grade_store, register_commands
+    create_grade_store(app)
+    register_commands(app)
+
+    from .startup import start_report_scan, register_startup_commands
+    register_startup_commands(app)
+
+    from .shared import create_shared_state
+    create_shared_state(app)
+
+    # STARTUP_SCAN が "background" なら、スキャンの終わりを待たずにリクエストを受け付ける
+    start_report_scan(app)
+
+    # 起動時のフォルダの状態を覚えてから、監視を始める
+    # （画像の事前生成・zipの展開と同じく、スレッドやプロセスプールは最初のリクエストで起動する）
+    from .watcher import create_watcher
+    create_watcher(app)
 
     # Blueprintの登録（既存の通り）
     from .code_grader.routes import code_bp
@@ -0,0 +1,344 @@
+import os
+import time
+import shutil
+import zipfile
+import tempfile
+import threading
+import atexit
+import multiprocessing
+from collections import namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+# 展開中のフォルダにつける接尾辞（展開し終わったら取り除く）
+PARTIAL_SUFFIX = ".partial"
+# 1つのジョブで展開するファイルの合計サイズ（バイト）の目安
+CHUNK_BYTES = 64 * 1024 * 1024
+
+# zipの中のファイルの os.stat の代わり
+ZipStat = namedtuple("ZipStat", ["st_size", "st_mtime_ns"])
+
+
+def is_partial_dir(name):
+    return name.endswith(PARTIAL_SUFFIX)
+
+
+def find_zip_member(path):
+    """
+    展開していないzipの中のファイルを指すパスなら (zipのパス, zip内のパス) を返す。それ以外は None。
+    zipの中のファイルは、zipと同じ名前のフォルダに展開したときのパスで指す
+    （例: <PDF_BASE_DIR>/<提出フォルダ>/<学生のフォルダ>/report.pdf → <提出フォルダ>.zip の中の <学生のフォルダ>/report.pdf）。
+    """
+    if os.path.exists(path):
+        return None
+    parent, name = os.path.split(path)
+    member = [name]
+    while parent and parent != os.path.dirname(parent):
+        if os.path.isfile(parent + ".zip"):
+            return parent + ".zip", "/".join(reversed(member))
+        parent, name = os.path.split(parent)
+        member.append(name)
+    return None
+
+
+def file_stat(path):
+    """st_size と st_mtime_ns を返す（zipの中のファイルにも使える）"""
+    member = find_zip_member(path)
+    if member is None:
+        return os.stat(path)
+    zip_path, name = member
+    with zipfile.ZipFile(zip_path) as zf:
+        try:
+            info = zf.getinfo(name)
+        except KeyError:
+            raise FileNotFoundError(path)
+    return ZipStat(info.file_size, int(time.mktime(info.date_time + (0, 0, -1))) * 1_000_000_000)
+
+
+@contextmanager
+def open_file(path):
+    """ファイルをバイナリで開く（zipの中のファイルにも使える）"""
+    member = find_zip_member(path)
+    if member is None:
+        with open(path, 'rb') as f:
+            yield f
+        return
+    zip_path, name = member
+    with zipfile.ZipFile(zip_path) as zf, zf.open(name) as f:
+        yield f
+
+
+@contextmanager
+def local_file(path):
+    """
+    ファイルのパスを返す。zipの中のファイルなら一時ファイルに書き出して、そのパスを返す
+    （pdftoppm など、パスしか受け取らない外部コマンドに渡すため）。
+    """
+    if find_zip_member(path) is None:
+        yield path
+        return
+    fd, tmp_path = tempfile.mkstemp(suffix=os.path.splitext(path)[1])
+    try:
+        with os.fdopen(fd, 'wb') as out, open_file(path) as f:
+            shutil.copyfileobj(f, out)
+        yield tmp_path
+    finally:
+        os.remove(tmp_path)
+
+
+def list_zip_folders(zip_path):
+    """zipの中の最上位のフォルダごとに、その直下のファイル・フォルダ名のソート済みリストを返す"""
+    folders = {}
+    with zipfile.ZipFile(zip_path) as zf:
+        for name in zf.namelist():
+            parts = name.split("/")
+            if len(parts) < 2:
+                continue
+            names = folders.setdefault(parts[0], set())
+            if parts[1]:
+                names.add(parts[1])
+    return {folder: sorted(names) for folder, names in folders.items()}
+
+
+def extract_members(zip_path, dest_dir, members):
+    """zipの members を dest_dir に展開し、展開したサイズの合計を返す（プロセスプールから呼ぶ）"""
+    size = 0
+    with zipfile.ZipFile(zip_path) as zf:
+        for name in members:
+            zf.extract(name, dest_dir)
+            size += zf.getinfo(name).file_size
+    return size
+
+
+def split_members(infos, chunk_bytes=CHUNK_BYTES):
+    """zipの中のファイルを、合計サイズが chunk_bytes 程度になるまとまりに分ける"""
+    chunks = []
+    names, size = [], 0
+    for info in infos:
+        names.append(info.filename)
+        size += info.file_size
+        if size >= chunk_bytes:
+            chunks.append(names)
+            names, size = [], 0
+    if names:
+        chunks.append(names)
+    return chunks
+
+
+class ZipExtractor:
+    """
+    提出物のzipを、プロセスプールで並列に展開する。
+    zipの中のファイルを CHUNK_BYTES ごとのジョブに分けて投入するので、大きなzipも並列に展開でき、
+    zipごとの進み具合（展開したバイト数）がわかる。
+    展開中は <フォルダ名>.partial に展開し、全て終わってからフォルダ名を変えるので、
+    展開途中のフォルダが提出フォルダとして読み込まれることはない。
+    start を呼ぶまでは、schedule されたzipを覚えておくだけで展開しない
+    （Werkzeugのリローダーの親プロセスや、gunicorn のフォーク前の親プロセスでプロセスプールを作らないため）。
+    """
+
+    def __init__(self, max_workers, on_done=None, on_change=None):
+        self.max_workers = max_workers
+        # 展開が終わったときに、展開先のフォルダのパスを引数にして呼ばれる
+        self.on_done = on_done
+        # 進み具合が変わったときに（引数なしで）呼ばれる
+        self.on_change = on_change
+        self._lock = threading.RLock()
+        self._jobs = {}  # zipのパス -> {"folder", "total", "done", "remaining", "state", "error"}
+        self._executor = None
+        self._closed = False
+        self._started = False
+        self._waiting = {}  # start を呼ぶ前に schedule されたもの: zipのパス -> 展開先のフォルダのパス
+
+    def start(self):
+        """展開を始める（2回目以降は何もしない）"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            waiting, self._waiting = self._waiting, {}
+            for zip_path, folder_path in waiting.items():
+                self.schedule(zip_path, folder_path)
+
+    def schedule(self, zip_path, folder_path):
+        """zipの展開を始める。展開中のものは何もしない"""
+        self._schedule(zip_path, folder_path)
+        self._changed()
+
+    def _schedule(self, zip_path, folder_path):
+        with self._lock:
+            if not self._started:
+                self._waiting[zip_path] = folder_path
+                return
+            job = self._jobs.get(zip_path)
+            if self._closed or (job is not None and job["state"] == "extracting"):
+                return
+            partial_path = folder_path + PARTIAL_SUFFIX
+            # 前回の展開が途中で止まっていたら、最初からやり直す
+            shutil.rmtree(partial_path, ignore_errors=True)
+            try:
+                with zipfile.ZipFile(zip_path) as zf:
+                    infos = zf.infolist()
+            except (OSError, zipfile.BadZipFile) as e:
+                print(f"エラー: {zip_path} を開けませんでした。エラー: {e}")
+                self._jobs[zip_path] = {"folder": folder_path, "total": 0, "done": 0, "remaining": 0, "state": "failed", "error": str(e)}
+                return
+            os.makedirs(partial_path)
+            chunks = split_members(infos)
+            job = {
+                "folder": folder_path,
+                "total": sum(info.file_size for info in infos),
+                "done": 0,
+                "remaining": len(chunks),
+                "state": "extracting",
+                "error": None,
+            }
+            self._jobs[zip_path] = job
+            print(f"{os.path.basename(zip_path)} の展開を始めます ({len(infos)}ファイル)。")
+            if not chunks:
+                self._finish(zip_path, job)
+                return
+            if self._executor is None:
+                # spawn にしておくと、Flaskのスレッドを抱えたままforkすることがない
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            for names in chunks:
+                try:
+                    future = self._executor.submit(extract_members, zip_path, partial_path, names)
+                except RuntimeError:
+                    # インタプリタの終了処理中はプールに投入できないので、以降の展開をやめる
+                    self._closed = True
+                    job["state"] = "failed"
+                    job["error"] = "shutdown"
+                    return
+                future.add_done_callback(lambda f: self._chunk_done(zip_path, job, f))
+
+    def status(self):
+        """zipごとの展開の進み具合"""
+        with self._lock:
+            return [self._describe(zip_path, job) for zip_path, job in self._jobs.items()]
+
+    def pending(self, target_dir):
+        """target_dir で展開中のzipの進み具合"""
+        with self._lock:
+            return [
+                self._describe(zip_path, job) for zip_path, job in self._jobs.items()
+                if job["state"] == "extracting" and os.path.dirname(zip_path) == target_dir
+            ]
+
+    def shared_status(self):
+        """SharedState に書き込む進み具合: [(zipのあるフォルダ, 進み具合), ...]"""
+        with self._lock:
+            return [(os.path.dirname(zip_path), self._describe(zip_path, job)) for zip_path, job in self._jobs.items()]
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _describe(self, zip_path, job):
+        return {
+            "zip": os.path.basename(zip_path),
+            "folder": os.path.basename(job["folder"]),
+            "state": job["state"],
+            "total": job["total"],
+            "done": job["done"],
+            "percent": round(job["done"] / job["total"] * 100, 1) if job["total"] else 100.0,
+            "error": job["error"],
+        }
+
+    def _chunk_done(self, zip_path, job, future):
+        with self._lock:
+            if job["state"] != "extracting":
+                return
+            if future.cancelled() or future.exception() is not None:
+                job["state"] = "failed"
+                job["error"] = "cancelled" if future.cancelled() else str(future.exception())
+                print(f"エラー: {zip_path} の展開に失敗しました。エラー: {job['error']}")
+            else:
+                job["done"] += future.result()
+                job["remaining"] -= 1
+            finished = job["state"] == "extracting" and job["remaining"] == 0
+        if finished:
+            self._finish(zip_path, job)
+        self._changed()
+
+    def _changed(self):
+        if self.on_change is None:
+            return
+        try:
+            self.on_change()
+        except Exception as e:
+            print(f"エラー: zipの展開の進み具合を共有できませんでした。エラー: {e}")
+
+    def _finish(self, zip_path, job):
+        with self._lock:
+            try:
+                os.replace(job["folder"] + PARTIAL_SUFFIX, job["folder"])
+            except OSError as e:
+                job["state"] = "failed"
+                job["error"] = str(e)
+                print(f"エラー: {zip_path} の展開先のフォルダを作れませんでした。エラー: {e}")
+                return
+            job["state"] = "done"
+        print(f"{os.path.basename(zip_path)} を展開しました。")
+        if self.on_done is not None:
+            # プールの管理スレッドを止めないよう、別のスレッドで呼ぶ
+            threading.Thread(target=self.on_done, args=(job["folder"],), daemon=True).start()
+
+
+class SharedZipExtractor:
+    """
+    複数のワーカープロセスで動かすときに、zipを展開しないプロセス（フォロワー）が ZipExtractor の代わりに使う。
+    展開の依頼は SharedState のイベント ("extract") で展開するプロセス（リーダー）に送り、
+    進み具合はリーダーが SharedState に書き込んだもの ("extract_status") を読む。
+    """
+
+    def __init__(self, shared, max_workers):
+        self.shared = shared
+        self.max_workers = max_workers
+
+    def start(self):
+        pass
+
+    def schedule(self, zip_path, folder_path):
+        self.shared.notify("extract", zip_path, folder_path)
+
+    def status(self):
+        return [job for _, job in self.shared.get("extract_status", [])]
+
+    def pending(self, target_dir):
+        return [
+            job for job_dir, job in self.shared.get("extract_status", [])
+            if job["state"] == "extracting" and job_dir == target_dir
+        ]
+
+    def shutdown(self):
+        pass
+
+
+def create_extractor(app):
+    """設定 (UNZIP_MODE) に応じて ZipExtractor を作成し、app.config に登録する"""
+    if app.config.get('UNZIP_MODE', 'sync') == 'sync':
+        app.config['ZIP_EXTRACTOR'] = None
+        return None
+
+    def on_done(folder_path):
+        # 展開が終わったフォルダを、提出フォルダの一覧に加える（既にあるレポートの番号は変えない）
+        from grader_app.utils import apply_directory_changes
+        with app.app_context():
+            apply_directory_changes(app, os.path.dirname(folder_path), [os.path.basename(folder_path)], [])
+
+    def on_change():
+        # 他のワーカープロセスの課題一覧にも、展開中のzipを表示する
+        from grader_app.shared import publish_extract_status
+        publish_extract_status(app)
+
+    extractor = ZipExtractor(app.config.get('UNZIP_WORKERS', 1), on_done, on_change)
+    atexit.register(extractor.shutdown)
+    app.config['ZIP_EXTRACTOR'] = extractor
+    return extractor
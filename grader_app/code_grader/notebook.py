@@ -0,0 +1,392 @@
+import os
+import re
+import json
+import time
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from jinja2 import Environment
+
+from grader_app.code_grader.sandbox import effective_limits, find_main_file
+from grader_app.code_grader.sandbox import SANDBOX_UNAVAILABLE, SANDBOX_WORKDIR, chown_for_sandbox, detect_sandbox, wrap_command
+
+# ノートブックのセルの実行の制限の既定値（テストの設定の limits で上書きできる）
+NOTEBOOK_LIMITS = {
+    "cell_timeout": 30.0,  # 1つのセルの実行時間（秒）
+}
+# 割り込んでから、カーネルが止まるのを待つ時間（秒）。止まらなければカーネルを入れ替える
+INTERRUPT_GRACE = 5.0
+# 結果に残す、1つのセルのテキストの出力の長さ（文字数）
+KEEP_CELL_OUTPUT_CHARS = 20000
+
+ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+
+# カーネルを起動した直後に1回だけ実行する。メモリを制限する
+SETUP_CODE = """
+try:
+    import resource as _resource
+    _resource.setrlimit(_resource.RLIMIT_AS, ({memory}, {memory}))
+    _resource.setrlimit(_resource.RLIMIT_CORE, (0, 0))
+    del _resource
+except (ImportError, ValueError, OSError):
+    pass
+"""
+
+
+def notebook_limits(suite):
+    return dict(NOTEBOOK_LIMITS, **effective_limits(suite))
+
+
+def load_notebook(path):
+    """ノートブックのセルを [{"cell_type", "source"}, ...] で返す"""
+    with open(path, 'r', encoding='utf-8') as f:
+        nb = json.load(f)
+    cells = []
+    for cell in nb.get("cells", []):
+        source = cell.get("source", "")
+        if isinstance(source, list):
+            source = "".join(source)
+        cells.append({"cell_type": cell.get("cell_type", "code"), "source": source})
+    return cells
+
+
+def _kernel_manager_class():
+    """提出物を隔離して実行するカーネルの KernelManager（jupyter_client は読み込みに時間がかかるので、使うときに作る）"""
+    from jupyter_client import KernelManager
+
+    class SandboxedKernelManager(KernelManager):
+        """カーネルを sandbox.wrap_command で隔離して起動する"""
+        sandbox = None
+        sandbox_workdir = None
+
+        async def _async_launch_kernel(self, kernel_cmd, **kw):
+            kernel_cmd, uid, gid = wrap_command(kernel_cmd, self.sandbox_workdir, self.sandbox)
+            # 接続用のファイル（鍵を含むので root だけが読める）は、起動の直前に書き出される
+            chown_for_sandbox(self.connection_file, self.sandbox)
+            if uid is not None:
+                kw.update(user=uid, group=gid, extra_groups=[])
+            await super()._async_launch_kernel(kernel_cmd, **kw)
+
+    return SandboxedKernelManager
+
+
+class WarmKernel:
+    """
+    提出物を1人分だけ実行する、起動しておいたローカルの Jupyter カーネル。
+    sandbox ({"mode", "user", "hidden"}) の方法で、プログラムの提出物と同じように隔離して起動する。
+    カーネルは root の下に自分のフォルダを持ち、提出物は work に（隔離したときは SANDBOX_WORKDIR に見える）、
+    接続用のファイルとソケットは runtime に置く（ネットワークが無くても使えるよう、TCP ではなく ipc でつなぐ）。
+    """
+
+    def __init__(self, root, memory_mb, sandbox):
+        self.root = root
+        self.memory_mb = memory_mb
+        self.sandbox = sandbox
+        self.broken = False
+        self.dir = None
+        self.workdir = None
+        self.km = None
+        self.client = None
+
+    def start(self):
+        self.dir = tempfile.mkdtemp(prefix="kernel_", dir=self.root)
+        self.workdir = os.path.join(self.dir, "work")
+        runtime = os.path.join(self.dir, "runtime")
+        os.makedirs(self.workdir)
+        os.makedirs(runtime)
+        chown_for_sandbox(self.dir, self.sandbox)
+        isolated = self.sandbox["mode"] in ("bwrap", "unshare")
+        home = SANDBOX_WORKDIR if isolated else self.workdir
+        env = {
+            "PATH": os.environ.get("PATH", ""),
+            "HOME": home,
+            "TMPDIR": home,
+            "LANG": "C.UTF-8",
+            "PYTHONDONTWRITEBYTECODE": "1",
+            "MPLBACKEND": "Agg",
+            "IPYTHONDIR": os.path.join(runtime, "ipython"),
+            "MPLCONFIGDIR": os.path.join(runtime, "matplotlib"),
+        }
+        self.km = _kernel_manager_class()(
+            kernel_name="python3", transport="ipc",
+            ip=os.path.join(runtime, "kernel"), connection_file=os.path.join(runtime, "kernel.json"),
+        )
+        self.km.sandbox = dict(self.sandbox, binds=[runtime])
+        self.km.sandbox_workdir = self.workdir
+        # 割り込みはシグナルではなく、制御用のチャネルで送る（隔離のためのプロセスを挟んでも、カーネルに届く）
+        self.km.kernel_spec.interrupt_mode = "message"
+        # 隔離したカーネルは PID 名前空間の中で親が PID 1 に見えるので、親の監視 (JPY_PARENT_PID) はしない
+        # （サーバーが終了すれば、名前空間ごと止まる）。セルの出力は iopub で受け取るので、標準出力は捨てる
+        self.km.start_kernel(cwd=self.workdir, env=env, independent=isolated, stdout=subprocess.DEVNULL)
+        self.client = self.km.blocking_client()
+        self.client.start_channels()
+        self.client.wait_for_ready(timeout=60)
+        memory = int(self.memory_mb) * 1024 * 1024
+        _, status = self.execute(SETUP_CODE.format(memory=memory), 30)
+        if status != "ok":
+            raise RuntimeError("カーネルの初期設定に失敗しました。")
+
+    def prepare(self, submission_dir):
+        """提出物を作業フォルダにコピーする（カーネルはそのフォルダで起動してある）"""
+        shutil.copytree(submission_dir, self.workdir, dirs_exist_ok=True)
+        chown_for_sandbox(self.workdir, self.sandbox)
+
+    def execute(self, code, timeout):
+        """
+        code を実行し、(出力のリスト, 状態) を返す。状態は "ok", "error", "timeout"。
+        出力は nbformat と同じ形（stream / execute_result / display_data / error）。
+        時間切れのときは割り込み、止まらなければ broken にする（プールが新しいカーネルに入れ替える）。
+        """
+        # 読まずに溜まった前回までの execute_reply を捨てる
+        while True:
+            try:
+                self.client.get_shell_msg(timeout=0)
+            except queue.Empty:
+                break
+        msg_id = self.client.execute(code, store_history=False, allow_stdin=False, stop_on_error=False)
+        outputs = []
+        status = "ok"
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                if not self._interrupt(msg_id):
+                    self.broken = True
+                return outputs, "timeout"
+            try:
+                msg = self.client.get_iopub_msg(timeout=min(remaining, 1.0))
+            except queue.Empty:
+                if not self.km.is_alive():
+                    # メモリの制限などでカーネルが終了した
+                    self.broken = True
+                    outputs.append({"output_type": "error", "ename": "KernelDied", "evalue": "カーネルが終了しました。", "traceback": []})
+                    return outputs, "error"
+                continue
+            if msg["parent_header"].get("msg_id") != msg_id:
+                continue
+            if self._collect(msg, outputs):
+                status = "error"
+            if msg["msg_type"] == "status" and msg["content"]["execution_state"] == "idle":
+                return outputs, status
+
+    def _interrupt(self, msg_id):
+        """割り込んで、実行中のセルが終わるのを待つ。止まったら True"""
+        try:
+            self.km.interrupt_kernel()
+        except Exception:
+            return False
+        deadline = time.monotonic() + INTERRUPT_GRACE
+        while time.monotonic() < deadline:
+            try:
+                msg = self.client.get_iopub_msg(timeout=deadline - time.monotonic())
+            except queue.Empty:
+                break
+            if (msg["parent_header"].get("msg_id") == msg_id and msg["msg_type"] == "status"
+                    and msg["content"]["execution_state"] == "idle"):
+                return True
+        return False
+
+    def _collect(self, msg, outputs):
+        """iopub のメッセージを outputs に加える。エラーなら True を返す"""
+        msg_type, content = msg["msg_type"], msg["content"]
+        if msg_type == "stream":
+            if outputs and outputs[-1]["output_type"] == "stream" and outputs[-1]["name"] == content["name"]:
+                outputs[-1]["text"] = (outputs[-1]["text"] + content["text"])[:KEEP_CELL_OUTPUT_CHARS]
+            else:
+                outputs.append({"output_type": "stream", "name": content["name"], "text": content["text"][:KEEP_CELL_OUTPUT_CHARS]})
+        elif msg_type in ("execute_result", "display_data"):
+            # HTML や JavaScript の出力は、採点画面でそのまま表示しないよう、テキストと画像だけを残す
+            data = {k: v for k, v in content["data"].items() if k in ("text/plain", "image/png", "image/jpeg")}
+            if "text/plain" in data:
+                data["text/plain"] = data["text/plain"][:KEEP_CELL_OUTPUT_CHARS]
+            outputs.append({"output_type": msg_type, "data": data})
+        elif msg_type == "error":
+            outputs.append({
+                "output_type": "error",
+                "ename": content["ename"],
+                "evalue": content["evalue"],
+                "traceback": [ANSI_ESCAPE.sub("", line) for line in content["traceback"]],
+            })
+            return True
+        return False
+
+    def shutdown(self):
+        try:
+            if self.client is not None:
+                self.client.stop_channels()
+            if self.km is not None:
+                self.km.shutdown_kernel(now=True)
+        except Exception as e:
+            print(f"エラー: カーネルを終了できませんでした。エラー: {e}")
+        if self.dir is not None:
+            shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class KernelPool:
+    """
+    起動しておいた size 個のカーネルのプール。
+    前の提出物で書き換えられた状態（組み込み関数やモジュールの書き換え、残したスレッドなど）を持ち越さないよう、
+    1つのカーネルは1人分の提出物にだけ使って終了する。kernel() でカーネルを借りると、すぐに代わりのカーネルを
+    バックグラウンドで起動し始めるので、提出物を実行している間に次のカーネルの起動が終わる。
+    sandbox の方法で隔離できなければ (detect_sandbox)、カーネルを起動せずにエラーにする。
+    """
+
+    def __init__(self, size, memory_mb, sandbox=None):
+        self.size = size
+        self.memory_mb = memory_mb
+        self.sandbox = sandbox or {"mode": "none"}
+        self.root = None  # カーネルごとのフォルダを作るフォルダ（カーネルを起動するときに作る）
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+        self._closed = False
+        self._kernels = set()
+
+    def start(self):
+        """カーネルを起動し始める（2回目以降は何もしない）。起動を待たずに戻る"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            self.sandbox = detect_sandbox(self.sandbox)
+            if self.sandbox["mode"] is None:
+                return
+            self.root = tempfile.mkdtemp(prefix="code_nb_")
+            if self.sandbox["mode"] == "user":
+                # カーネルを実行するユーザーが、自分のフォルダまでたどれるようにする（一覧は見せない）
+                os.chmod(self.root, 0o711)
+        for _ in range(self.size):
+            self._spawn()
+
+    @contextmanager
+    def kernel(self):
+        self.start()
+        if self.sandbox["mode"] is None:
+            raise RuntimeError(SANDBOX_UNAVAILABLE)
+        kernel = self._idle.get()
+        # 借りた分のカーネルを、次の提出物のために起動しておく
+        self._spawn()
+        if isinstance(kernel, Exception):
+            raise kernel
+        try:
+            yield kernel
+        finally:
+            self._retire(kernel)
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+            kernels = list(self._kernels)
+            self._kernels.clear()
+        for kernel in kernels:
+            kernel.shutdown()
+        if self.root is not None:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+    def _spawn(self):
+        def run():
+            kernel = WarmKernel(self.root, self.memory_mb, self.sandbox)
+            try:
+                kernel.start()
+            except Exception as e:
+                kernel.shutdown()
+                if not self._closed:
+                    print(f"エラー: Jupyter カーネルを起動できませんでした。エラー: {e}")
+                self._idle.put(e)
+                return
+            with self._lock:
+                if self._closed:
+                    kernel.shutdown()
+                    return
+                self._kernels.add(kernel)
+            self._idle.put(kernel)
+
+        with self._lock:
+            if self._closed:
+                return
+        threading.Thread(target=run, name="kernel-start", daemon=True).start()
+
+    def _retire(self, kernel):
+        with self._lock:
+            self._kernels.discard(kernel)
+        threading.Thread(target=kernel.shutdown, name="kernel-stop", daemon=True).start()
+
+
+def run_notebook(pool, submission_dir, suite):
+    """
+    1人分のノートブックを、プールのカーネルでセルごとに実行し、(テストの結果, 実行したセル) を返す。
+    テストケースの code は、ノートブックを最後まで実行した後の同じカーネルで実行し、
+    エラーなく終われば "pass"、AssertionError なら "fail"、それ以外のエラーは "error" とする。
+    """
+    limits = notebook_limits(suite)
+    tests = suite.get("tests", [])
+    with pool.kernel() as kernel:
+        notebook = find_main_file(submission_dir, suite.get("main", ".ipynb"))
+        if notebook is None:
+            message = f"{suite.get('main', '.ipynb')} のファイルが提出されていません。"
+            return {test["id"]: {"status": "error", "message": message} for test in tests}, []
+        kernel.prepare(submission_dir)
+        cells = load_notebook(os.path.join(kernel.workdir, notebook))
+        for cell in cells:
+            if cell["cell_type"] != "code":
+                continue
+            if kernel.broken:
+                cell["status"] = "skipped"
+                cell["outputs"] = []
+                continue
+            cell["outputs"], cell["status"] = kernel.execute(cell["source"], limits["cell_timeout"])
+        results = {}
+        for test in tests:
+            if kernel.broken:
+                results[test["id"]] = {"status": "error", "message": "カーネルが停止したため実行できませんでした。"}
+                continue
+            outputs, status = kernel.execute(test.get("code", ""), limits["cell_timeout"])
+            errors = [o for o in outputs if o["output_type"] == "error"]
+            if status == "ok":
+                result = "pass"
+            elif status == "timeout":
+                result = "timeout"
+            else:
+                result = "fail" if errors and errors[-1]["ename"] == "AssertionError" else "error"
+            results[test["id"]] = {
+                "status": result,
+                "message": f"{errors[-1]['ename']}: {errors[-1]['evalue']}" if errors else "",
+            }
+        return results, cells
+
+
+NOTEBOOK_TEMPLATE = Environment(autoescape=True).from_string("""
+{%- for cell in cells %}
+<div class="nb-cell mb-3">
+    {%- if cell.cell_type == 'code' %}
+    <pre class="nb-source border rounded p-2 bg-light mb-1"><code>{{ cell.source }}</code></pre>
+    {%- if cell.status == 'timeout' %}<div class="text-warning small">時間切れで中断しました</div>{% endif %}
+    {%- if cell.status == 'skipped' %}<div class="text-secondary small">カーネルが停止したため実行していません</div>{% endif %}
+    {%- for out in cell.outputs %}
+    {%- if out.output_type == 'stream' %}
+    <pre class="nb-output mb-1 {{ 'text-danger' if out.name == 'stderr' }}">{{ out.text }}</pre>
+    {%- elif out.output_type == 'error' %}
+    <pre class="nb-output mb-1 text-danger">{{ out.traceback | join('\n') or (out.ename ~ ': ' ~ out.evalue) }}</pre>
+    {%- elif 'image/png' in out.data %}
+    <img class="nb-output mb-1" src="data:image/png;base64,{{ out.data['image/png'] }}">
+    {%- elif 'image/jpeg' in out.data %}
+    <img class="nb-output mb-1" src="data:image/jpeg;base64,{{ out.data['image/jpeg'] }}">
+    {%- elif 'text/plain' in out.data %}
+    <pre class="nb-output mb-1">{{ out.data['text/plain'] }}</pre>
+    {%- endif %}
+    {%- endfor %}
+    {%- else %}
+    <div class="nb-markdown text-secondary" style="white-space: pre-wrap">{{ cell.source }}</div>
+    {%- endif %}
+</div>
+{%- endfor %}
+""")
+
+
+def render_notebook(cells):
+    """実行したセルを HTML にする（結果のキャッシュに保存しておき、表示するたびに作り直さない）"""
+    return NOTEBOOK_TEMPLATE.render(cells=cells)
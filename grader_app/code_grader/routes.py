@@ -1,14 +1,170 @@
-from flask import Blueprint, render_template, current_app
+import json
+import os
+from flask import Blueprint, render_template, current_app, jsonify, request, redirect, url_for, abort
+from grader_app.code_grader.utils import get_submissions, submission_digest, get_code_hash_index, suite_digest, load_test_suite, save_test_suite, validate_test_suite
+from grader_app.code_grader.similarity import read_source
+from grader_app.code_grader.sandbox import SANDBOX_UNAVAILABLE
+from grader_app.utils import get_problems, get_finished_status, abort_if_removed_report
 
 code_bp = Blueprint(
-    'code', __name__, 
-    template_folder='templates', 
+    'code', __name__,
+    template_folder='templates',
     static_folder='static',
     url_prefix='/code'
 )
 
+@code_bp.before_request
+def check_report_index():
+    abort_if_removed_report('CODE_LIST')
+
+def get_report(report_index):
+    return current_app.config['CODE_LIST'][report_index]
+
+def hashed_submissions(report):
+    """{学生名: (フォルダのパス, 提出物のハッシュ)}（サイズと更新時刻が変わったファイルだけ読み直す）"""
+    hashes = get_code_hash_index(current_app)
+    submissions = {name: (path, submission_digest(path, hashes)) for name, path in get_submissions(report).items()}
+    hashes.save()
+    return submissions
+
 @code_bp.route('/')
 def index():
     sorted_dirlist = current_app.config['CODE_LIST']
-    finished = [False for report in sorted_dirlist]
-    return render_template("dirlist.html", dirlist=sorted_dirlist, finished=finished)
+    return render_template("code_grader/index.html", dirlist=sorted_dirlist)
+
+@code_bp.route('<int:report_index>/')
+def report_results(report_index):
+    report = get_report(report_index)
+    suite = load_test_suite(report)
+    suite_hash = suite_digest(suite)
+    runner = current_app.config['CODE_RUNNER']
+    notebook = suite.get("mode") == "notebook"
+    if notebook:
+        # 実行ボタンを押すまでに、ノートブックを実行するカーネルを起動しておく
+        runner.warm_up()
+    submissions = hashed_submissions(report)
+    # 実行した結果はキャッシュから読む（テストか提出物が変わっていれば「未実行」になる）
+    results = {name: runner.cache.get(suite_hash, digest) for name, (_, digest) in submissions.items()}
+    finished = get_finished_status('code', report, list(submissions), get_problems('code', report))
+    return render_template(
+        "code_grader/report.html", report=report, report_index=report_index, suite=suite,
+        results=results, finished=dict(zip(submissions, finished)), notebook=notebook,
+        status=runner.status(report), running=runner.running(report),
+    )
+
+@code_bp.route('<int:report_index>/run/', methods=['POST'])
+def run_tests(report_index):
+    """課題の全ての提出物を、テストケースで実行する（結果がキャッシュにあるものは実行しない）"""
+    report = get_report(report_index)
+    suite = load_test_suite(report)
+    if not suite.get("tests"):
+        return jsonify({"status": "error", "message": "テストケースがありません。"}), 400
+    runner = current_app.config['CODE_RUNNER']
+    if suite.get("mode") == "notebook" and runner.kernel_pool is None:
+        return jsonify({"status": "error", "message": "ノートブックを実行するカーネルがありません (NOTEBOOK_KERNELS)。"}), 400
+    if not runner.sandbox_available():
+        # 実行してもエラーになるだけなので、結果をキャッシュに残さないように実行しない
+        return jsonify({"status": "error", "message": SANDBOX_UNAVAILABLE}), 400
+    runner.run_report(report, hashed_submissions(report), suite, suite_digest(suite))
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({"status": "started", "progress": runner.status(report)}), 202
+    return redirect(url_for('code.report_results', report_index=report_index))
+
+@code_bp.route('<int:report_index>/<int:student_index>/notebook/')
+def notebook_view(report_index, student_index):
+    """ノートブックを実行した結果（セルと出力）を表示する。HTML は実行したときに作って保存してある"""
+    report = get_report(report_index)
+    submissions = list(get_submissions(report).items())
+    if not 0 <= student_index < len(submissions):
+        abort(404)
+    student_name, submission_dir = submissions[student_index]
+    suite = load_test_suite(report)
+    runner = current_app.config['CODE_RUNNER']
+    submission_hash = submission_digest(submission_dir, get_code_hash_index(current_app))
+    html = runner.cache.get_view(suite_digest(suite), submission_hash)
+    results = runner.cache.get(suite_digest(suite), submission_hash)
+    return render_template(
+        "code_grader/notebook.html", report=report, report_index=report_index,
+        student_name=student_name, suite=suite, results=results, html=html,
+    )
+
+@code_bp.route('<int:report_index>/run_status/')
+def run_status(report_index):
+    runner = current_app.config['CODE_RUNNER']
+    return jsonify({"progress": runner.status(get_report(report_index))})
+
+@code_bp.route('<int:report_index>/tests/', methods=['GET', 'POST'])
+def edit_tests(report_index):
+    """テストの設定 (CODE_SAVE_DIR/<課題>_tests.json) を JSON のまま編集する"""
+    report = get_report(report_index)
+    error = None
+    if request.method == 'POST':
+        text = request.form.get('suite', '')
+        try:
+            suite = json.loads(text)
+            error = validate_test_suite(suite)
+        except ValueError as e:
+            error = f"JSON として読めません: {e}"
+        if error is None:
+            save_test_suite(report, suite)
+            return redirect(url_for('code.report_results', report_index=report_index))
+    else:
+        text = json.dumps(load_test_suite(report), ensure_ascii=False, indent=4)
+    return render_template("code_grader/edit_tests.html", report=report, report_index=report_index, text=text, error=error)
+
+def similar_pairs(report):
+    index = current_app.config['SIMILARITY_INDEX']
+    return index.similar_pairs(
+        report, current_app.config.get('SIMILARITY_TOP_K', 50),
+        current_app.config.get('SIMILARITY_MAX_SHARE', 0.1), current_app.config.get('SIMILARITY_MAX_HOLDERS', 10),
+    )
+
+@code_bp.route('<int:report_index>/similarity/')
+def similarity(report_index):
+    """提出物どうしで共通の部分が多い組の一覧（保存してある索引から求める）"""
+    report = get_report(report_index)
+    index = current_app.config['SIMILARITY_INDEX']
+    running = index.running(report)
+    return render_template(
+        "code_grader/similarity.html", report=report, report_index=report_index,
+        pairs=similar_pairs(report), stale=[] if running else index.stale(report, get_submissions(report)),
+        status=index.status(report), running=running,
+    )
+
+@code_bp.route('<int:report_index>/similarity/update/', methods=['POST'])
+def update_similarity(report_index):
+    """類似度の索引を更新する（追加・変更されたファイルだけ指紋を作る）"""
+    report = get_report(report_index)
+    index = current_app.config['SIMILARITY_INDEX']
+    index.update(report, get_submissions(report))
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({"status": "started", "progress": index.status(report)}), 202
+    return redirect(url_for('code.similarity', report_index=report_index))
+
+@code_bp.route('<int:report_index>/similarity/compare/')
+def compare_similarity(report_index):
+    """2人の提出物の一致した箇所を並べて表示する (?a=学生名&b=学生名)"""
+    report = get_report(report_index)
+    a, b = request.args.get('a'), request.args.get('b')
+    pair = next((p for p in similar_pairs(report) if p["a"] == a and p["b"] == b), None)
+    if pair is None:
+        abort(404)
+    submissions = get_submissions(report)
+    sources = {}
+
+    def lines(student, relpath, span):
+        key = (student, relpath)
+        if key not in sources:
+            try:
+                sources[key] = read_source(os.path.join(submissions[student], relpath)).splitlines()
+            except (KeyError, OSError, ValueError):
+                sources[key] = []
+        return sources[key][span[0] - 1:span[1]]
+
+    regions = [
+        dict(region, code_a=lines(a, region["file_a"], region["lines_a"]), code_b=lines(b, region["file_b"], region["lines_b"]))
+        for region in pair["regions"]
+    ]
+    return render_template(
+        "code_grader/similarity_compare.html", report=report, report_index=report_index, pair=pair, regions=regions,
+    )
@@ -0,0 +1,210 @@
+import os
+import json
+import threading
+import atexit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from grader_app.models import write_file_atomic
+from grader_app.code_grader.sandbox import run_submission, detect_sandbox
+from grader_app.code_grader.notebook import KernelPool, run_notebook, render_notebook
+
+# 提出されたプログラムを隔離して実行するときに、見えないようにするフォルダの設定
+SANDBOX_HIDDEN_DIRS = ('SAVE_DIR', 'PDF_SAVE_DIR', 'CODE_SAVE_DIR', 'PDF_BASE_DIR', 'CODE_BASE_DIR', 'IMAGE_DIR')
+
+
+class ResultCache:
+    """
+    提出物を実行した結果のキャッシュ。(テストの設定のハッシュ, 提出物のハッシュ) ごとに
+    cache_dir/<テストのハッシュ>/<提出物のハッシュ>.json に保存するので、
+    テストも提出物も変わっていなければ、再起動した後も実行し直さない。
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def _path(self, suite_hash, submission_hash):
+        return os.path.join(self.cache_dir, suite_hash, f"{submission_hash}.json")
+
+    def get(self, suite_hash, submission_hash):
+        try:
+            with open(self._path(suite_hash, submission_hash), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put(self, suite_hash, submission_hash, results):
+        path = self._path(suite_hash, submission_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file_atomic(path, json.dumps(results, ensure_ascii=False).encode('utf-8'))
+
+    def get_view(self, suite_hash, submission_hash):
+        """ノートブックを実行した結果の HTML（無ければ None）"""
+        try:
+            with open(self._path(suite_hash, submission_hash)[:-len(".json")] + ".html", 'r', encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put_view(self, suite_hash, submission_hash, html):
+        path = self._path(suite_hash, submission_hash)[:-len(".json")] + ".html"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file_atomic(path, html.encode('utf-8'))
+
+
+class CodeRunner:
+    """
+    プログラムの提出物を、テストケースごとにプロセスプールで並列に実行する。
+    1つのジョブは1人分の提出物で、プールのプロセスの中で subprocess を使い、テストケースを1つずつ実行する
+    （実行時間・CPU時間・メモリの制限と、sandbox ({"mode", "user", "hidden"}) での隔離は sandbox.run_submission で行う）。
+    テストの設定の mode が "notebook" なら、提出物は Jupyter ノートブックで、kernel_pool のカーネルを使って
+    スレッドで実行する（カーネルの数だけ並列に実行する）。セルの出力は HTML にして ResultCache に保存する。
+    結果は ResultCache に保存し、on_result(課題, 学生名, テストの設定, 結果) を呼ぶ。
+    """
+
+    def __init__(self, max_workers, cache, on_result=None, kernel_pool=None, sandbox=None):
+        self.max_workers = max_workers
+        self.cache = cache
+        self.sandbox = sandbox
+        self.on_result = on_result
+        self.kernel_pool = kernel_pool
+        self._lock = threading.Lock()
+        self._executor = None
+        self._notebook_executor = None
+        self._closed = False
+        self._running = {}   # (テストのハッシュ, 提出物のハッシュ) -> Future
+        self._progress = {}  # 課題 -> {"total", "done", "cached", "failed"}
+
+    def run_report(self, report, submissions, suite, suite_hash):
+        """
+        submissions ({学生名: (フォルダのパス, 提出物のハッシュ)}) を実行する。
+        結果がキャッシュにある提出物は実行せず、すぐに on_result を呼ぶ。
+        """
+        progress = {"total": len(submissions), "done": 0, "cached": 0, "failed": 0}
+        with self._lock:
+            self._progress[report] = progress
+        for student_name, (submission_dir, submission_hash) in submissions.items():
+            results = self.cache.get(suite_hash, submission_hash)
+            if results is not None:
+                with self._lock:
+                    progress["done"] += 1
+                    progress["cached"] += 1
+                self._report(report, student_name, suite, results)
+                continue
+            key = (suite_hash, submission_hash)
+            with self._lock:
+                if self._closed:
+                    return
+                future = self._running.get(key)
+                if future is None:
+                    try:
+                        future = self._submit(submission_dir, suite, key)
+                    except RuntimeError:
+                        # インタプリタの終了処理中はプールに投入できない
+                        self._closed = True
+                        return
+                    self._running[key] = future
+            future.add_done_callback(lambda f, s=student_name, k=key: self._finish(report, s, suite, k, progress, f))
+
+    def warm_up(self):
+        """ノートブックを実行するカーネルを起動しておく（起動を待たずに戻る）"""
+        if self.kernel_pool is not None:
+            self.kernel_pool.start()
+
+    def sandbox_available(self):
+        """提出されたプログラムを実行できるか（CODE_SANDBOX が "auto" で、隔離する方法が無ければ False）"""
+        return detect_sandbox(self.sandbox or {"mode": "none"})["mode"] is not None
+
+    def status(self, report):
+        """課題の実行の進み具合（実行したことがなければ None）"""
+        with self._lock:
+            progress = self._progress.get(report)
+            return dict(progress) if progress is not None else None
+
+    def running(self, report):
+        status = self.status(report)
+        return status is not None and status["done"] + status["failed"] < status["total"]
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+            executors = [self._executor, self._notebook_executor]
+            self._executor = self._notebook_executor = None
+        for executor in executors:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+        if self.kernel_pool is not None:
+            self.kernel_pool.shutdown()
+
+    def _submit(self, submission_dir, suite, key):
+        # self._lock を保持した状態で呼ぶこと
+        if suite.get("mode") == "notebook":
+            if self.kernel_pool is None:
+                raise ValueError("ノートブックを実行するカーネルがありません (NOTEBOOK_KERNELS)。")
+            if self._notebook_executor is None:
+                self._notebook_executor = ThreadPoolExecutor(max_workers=self.kernel_pool.size, thread_name_prefix="notebook")
+            return self._notebook_executor.submit(self._run_notebook, submission_dir, suite, key)
+        if self._executor is None:
+            # spawn にしておくと、Flaskのスレッドを抱えたままforkすることがない
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor.submit(run_submission, submission_dir, suite, self.sandbox)
+
+    def _run_notebook(self, submission_dir, suite, key):
+        results, cells = run_notebook(self.kernel_pool, submission_dir, suite)
+        self.cache.put_view(key[0], key[1], render_notebook(cells))
+        return results
+
+    def _finish(self, report, student_name, suite, key, progress, future):
+        with self._lock:
+            self._running.pop(key, None)
+            failed = future.cancelled() or future.exception() is not None
+            progress["failed" if failed else "done"] += 1
+        if failed:
+            if not future.cancelled():
+                print(f"エラー: {report} の {student_name} の実行に失敗しました。エラー: {future.exception()}")
+            return
+        results = future.result()
+        self.cache.put(key[0], key[1], results)
+        self._report(report, student_name, suite, results)
+
+    def _report(self, report, student_name, suite, results):
+        if self.on_result is None:
+            return
+        try:
+            self.on_result(report, student_name, suite, results)
+        except Exception as e:
+            print(f"エラー: {report} の {student_name} の結果を保存できませんでした。エラー: {e}")
+
+
+def create_code_runner(app):
+    """CodeRunner を作成し、app.config に登録する（プロセスプールは最初に実行するときに作る）"""
+
+    def on_result(report, student_name, suite, results):
+        # テストの結果を、PDFと同じ採点結果のJSONに保存する（変わった評価だけ書き込む）
+        from grader_app.utils import apply_grade_changes, load_grades_from_json
+        from grader_app.code_grader.utils import result_grades
+        with app.app_context():
+            grades = load_grades_from_json('code', report, student_name)
+            changes = {k: v for k, v in result_grades(suite, results).items() if grades.get(k) != v}
+            if changes:
+                apply_grade_changes('code', report, student_name, changes)
+
+    sandbox = {
+        "mode": app.config.get('CODE_SANDBOX', 'auto'),
+        "user": app.config.get('CODE_SANDBOX_USER', 'nobody'),
+        # 隔離した環境でも見えないようにするフォルダ（テストの期待出力・採点結果・他の学生の提出物）
+        "hidden": [os.path.abspath(app.config[key]) for key in SANDBOX_HIDDEN_DIRS if app.config.get(key)],
+    }
+    kernel_pool = None
+    if app.config.get('NOTEBOOK_KERNELS', 0) > 0:
+        # ノートブックのカーネルも、プログラムの提出物と同じように隔離して起動する
+        kernel_pool = KernelPool(app.config['NOTEBOOK_KERNELS'], app.config.get('NOTEBOOK_MEMORY_MB', 2048), sandbox)
+    runner = CodeRunner(
+        app.config.get('CODE_RUN_WORKERS', 1), ResultCache(app.config['CODE_RESULT_CACHE_DIR']), on_result, kernel_pool, sandbox,
+    )
+    atexit.register(runner.shutdown)
+    app.config['CODE_RUNNER'] = runner
+    return runner
@@ -0,0 +1,454 @@
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import ctypes
+import tempfile
+import subprocess
+
+try:
+    import resource
+    import pwd
+except ImportError:  # Windows
+    resource = None
+    pwd = None
+
+# テストの設定ファイルで省略された項目の既定値
+DEFAULT_LIMITS = {
+    "timeout": 5.0,       # 実行時間（秒）
+    "cpu_seconds": 2,     # CPU時間（秒）
+    "memory_mb": 512,     # メモリ（アドレス空間, MB）
+    "output_kb": 1024,    # 標準出力・標準エラー出力の大きさ (KB)
+}
+# 結果に残す出力の長さ（文字数）
+KEEP_OUTPUT_CHARS = 2000
+
+# 隔離した環境 (bwrap / unshare) で、読み込み専用で見せるシステムのファイル・フォルダ
+# （Python の場所 sys.prefix・sys.base_prefix も加える）。それ以外は見えない
+SYSTEM_PATHS = [
+    "/usr", "/bin", "/sbin", "/lib", "/lib32", "/lib64",
+    "/etc/alternatives", "/etc/ld.so.cache", "/etc/ld.so.conf", "/etc/ld.so.conf.d", "/etc/localtime",
+]
+DEVICES = ["/dev/null", "/dev/zero", "/dev/random", "/dev/urandom"]
+# 隔離した環境での作業フォルダの場所
+SANDBOX_WORKDIR = "/work"
+# 隔離の方法を確かめた結果（プロセスごと）: (CODE_SANDBOX, CODE_SANDBOX_USER) -> 方法
+_detected = {}
+SANDBOX_UNAVAILABLE = (
+    "提出されたプログラムを隔離して実行する方法 (bwrap, unshare, user) がこの環境にないため、実行しません。"
+    "隔離せずに実行する場合は CODE_SANDBOX を \"none\" にしてください。"
+)
+
+
+def normalize_output(text):
+    """行末の空白と末尾の空行を無視して比べる"""
+    return "\n".join(line.rstrip() for line in text.rstrip().splitlines())
+
+
+def find_main_file(workdir, pattern=".py"):
+    """提出物の中で最初に見つかった pattern で終わるファイル（{main} に入れる）"""
+    for root, dirs, files in os.walk(workdir):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(pattern):
+                return os.path.relpath(os.path.join(root, name), workdir)
+    return None
+
+
+def _limit_resources(limits):
+    """子プロセスで exec する前に呼ばれ、CPU時間・メモリ・書き込めるファイルの大きさを制限する"""
+    def apply():
+        cpu = int(limits["cpu_seconds"])
+        memory = int(limits["memory_mb"]) * 1024 * 1024
+        output = int(limits["output_kb"]) * 1024
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+        resource.setrlimit(resource.RLIMIT_FSIZE, (output, output))
+        resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+    return apply
+
+
+def sandbox_user(sandbox):
+    """root で動かしているときに、提出物を実行するユーザーの (uid, gid)。root でなければ None"""
+    if pwd is None or os.geteuid() != 0:
+        return None
+    entry = pwd.getpwnam(sandbox.get("user") or "nobody")
+    return entry.pw_uid, entry.pw_gid
+
+
+def _inside(path, parent):
+    return path == parent or path.startswith(parent.rstrip("/") + "/")
+
+
+def visible_paths(hidden=()):
+    """
+    隔離した環境で見せるパス [(パス, シンボリックリンクの指す先 または None)] と、
+    その中にあるので空のフォルダで隠す hidden のフォルダのリストを返す。
+    """
+    paths = []
+    for path in SYSTEM_PATHS + [sys.prefix, sys.base_prefix, os.path.dirname(os.path.realpath(sys.executable))]:
+        path = os.path.abspath(path)
+        if not os.path.lexists(path) or any(_inside(path, p) for p, _ in paths):
+            continue
+        paths.append((path, os.readlink(path) if os.path.islink(path) else None))
+    # Python の場所が保存フォルダを含んでいても、保存フォルダは見せない
+    masked = [h for h in hidden if any(_inside(h, p) for p, target in paths if target is None)]
+    return paths, masked
+
+
+def wrap_command(command, workdir, sandbox):
+    """
+    command を、sandbox の方法で隔離して実行するコマンドにする。
+      - "bwrap" / "unshare": 新しい名前空間（マウント・PID・ネットワークなど）で、読み込み専用のシステムのフォルダと、
+        SANDBOX_WORKDIR に置いた workdir だけが見える環境にする（保存フォルダや他の学生の提出物は見えない）。
+        root で動かしているときは CODE_SANDBOX_USER に、そうでなければ全ての特権を捨ててから実行する。
+      - "user": root で動かしているときに CODE_SANDBOX_USER で実行する（ファイルは見えたまま）。
+      - "none": そのまま実行する。
+    sandbox の "binds" のフォルダは、隔離した環境でも同じパスに書き込めるようにして見せる（カーネルの接続用のソケットなど）。
+    戻り値: (コマンド, Popen に渡す user, group)
+    """
+    mode = sandbox["mode"]
+    user = sandbox_user(sandbox)
+    hidden = sandbox.get("hidden", [])
+    binds = sandbox.get("binds", [])
+    if mode == "bwrap":
+        args = ["bwrap", "--unshare-all", "--die-with-parent", "--new-session", "--cap-drop", "ALL"]
+        if user is not None:
+            args += ["--unshare-user", "--uid", str(user[0]), "--gid", str(user[1])]
+        paths, masked = visible_paths(hidden)
+        for path, target in paths:
+            args += ["--symlink", target, path] if target is not None else ["--ro-bind", path, path]
+        for path in masked:
+            args += ["--tmpfs", path]
+        for path in binds:
+            args += ["--bind", path, path]
+        args += ["--dev", "/dev", "--proc", "/proc", "--bind", workdir, SANDBOX_WORKDIR, "--chdir", SANDBOX_WORKDIR, "--"]
+        return args + list(command), None, None
+    if mode == "unshare":
+        paths, masked = visible_paths(hidden)
+        spec = {
+            "root": os.path.join(os.path.dirname(workdir), "root"),
+            "workdir": workdir,
+            "paths": paths,
+            "masked": masked,
+            "binds": binds,
+            "user": user,
+            "command": list(command),
+        }
+        args = ["unshare", "--mount", "--pid", "--net", "--ipc", "--uts"]
+        if user is None:
+            args[1:1] = ["--user", "--map-root-user"]
+        return args + [sys.executable, "-I", "-S", os.path.abspath(__file__), json.dumps(spec)], None, None
+    if mode == "user" and user is not None:
+        return list(command), user[0], user[1]
+    return list(command), None, None
+
+
+def run_command(command, workdir, stdin, limits, sandbox=None):
+    """
+    command を workdir で実行し、{"returncode", "stdout", "stderr", "time", "timeout"} を返す。
+    sandbox ({"mode", "user", "hidden"}) を渡すと、その方法で隔離して実行する (wrap_command)。
+    標準出力は一時ファイルに書かせるので、RLIMIT_FSIZE で出力の大きさも制限される。
+    時間切れになったら、子プロセスが起動したプロセスもまとめて止める（新しいセッションで起動する）。
+    """
+    sandbox = sandbox or {"mode": "none"}
+    command, uid, gid = wrap_command(command, workdir, sandbox)
+    isolated = sandbox["mode"] in ("bwrap", "unshare")
+    home = SANDBOX_WORKDIR if isolated else workdir
+    env = {
+        "PATH": os.environ.get("PATH", ""),
+        "HOME": home,
+        "TMPDIR": home,
+        "LANG": "C.UTF-8",
+        "PYTHONDONTWRITEBYTECODE": "1",
+        "PYTHONIOENCODING": "utf-8",
+    }
+    with tempfile.TemporaryFile() as stdin_file, tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+        stdin_file.write(stdin.encode('utf-8'))
+        stdin_file.seek(0)
+        start = time.monotonic()
+        proc = subprocess.Popen(
+            command, cwd=workdir, env=env, stdin=stdin_file, stdout=out, stderr=err,
+            preexec_fn=_limit_resources(limits) if resource is not None else None,
+            start_new_session=True,
+            user=uid, group=gid, extra_groups=[] if uid is not None else None,
+        )
+        timed_out = False
+        try:
+            proc.wait(timeout=limits["timeout"])
+        except subprocess.TimeoutExpired:
+            timed_out = True
+        # 終了していても、バックグラウンドに残したプロセスがあれば止める
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError, AttributeError):
+            pass
+        proc.wait()
+        elapsed = time.monotonic() - start
+        # CPU時間の制限 (RLIMIT_CPU) で止められた場合も、時間切れとして扱う
+        if proc.returncode == -getattr(signal, "SIGXCPU", 0):
+            timed_out = True
+        out.seek(0)
+        err.seek(0)
+        max_bytes = int(limits["output_kb"]) * 1024
+        return {
+            "returncode": proc.returncode,
+            "stdout": out.read(max_bytes).decode('utf-8', errors='replace'),
+            "stderr": err.read(max_bytes).decode('utf-8', errors='replace'),
+            "time": round(elapsed, 3),
+            "timeout": timed_out,
+        }
+
+
+def detect_sandbox(sandbox):
+    """
+    CODE_SANDBOX が "auto" なら、この環境で使える隔離の方法を bwrap, unshare, user の順に選ぶ
+    （実際に Python を起動してみて確かめる。結果はプロセスごとに覚えておく）。
+    どれも使えなければ mode を None にして返す（隔離せずに実行するのは "none" を指定したときだけ）。
+    """
+    mode = sandbox.get("mode", "auto")
+    if mode != "auto":
+        return dict(sandbox, mode=mode)
+    key = (mode, sandbox.get("user"))
+    if key not in _detected:
+        _detected[key] = None
+        candidates = [m for m, tool in (("bwrap", "bwrap"), ("unshare", "unshare")) if shutil.which(tool)]
+        if sandbox_user(sandbox) is not None:
+            candidates.append("user")
+        for candidate in candidates:
+            if _sandbox_works(dict(sandbox, mode=candidate)):
+                _detected[key] = candidate
+                break
+        if _detected[key] is None:
+            print(f"エラー: {SANDBOX_UNAVAILABLE}")
+    return dict(sandbox, mode=_detected[key])
+
+
+def _sandbox_works(sandbox):
+    limits = dict(DEFAULT_LIMITS, timeout=10.0)
+    with tempfile.TemporaryDirectory(prefix="code_run_") as tmp:
+        workdir = _prepare_workdir(tmp, None, sandbox)
+        try:
+            run = run_command([sys.executable, "-c", "pass"], workdir, "", limits, sandbox)
+        except OSError:
+            return False
+    return run["returncode"] == 0
+
+
+def _prepare_workdir(tmp, submission_dir, sandbox, name="submission"):
+    """提出物を tmp/name にコピーする（実行するユーザーが書き込めるようにする）"""
+    workdir = os.path.join(tmp, name)
+    if submission_dir is None:
+        os.makedirs(workdir)
+    else:
+        shutil.copytree(submission_dir, workdir)
+    chown_for_sandbox(workdir, sandbox)
+    return workdir
+
+
+def chown_for_sandbox(path, sandbox):
+    """path 以下を、提出物を実行するユーザーのものにする（root で動かしていて、隔離するときだけ）"""
+    user = sandbox_user(sandbox) if sandbox["mode"] != "none" else None
+    if user is None:
+        return
+    os.lchown(path, *user)
+    for root, dirs, files in os.walk(path):
+        for entry in [os.path.join(root, n) for n in dirs + files]:
+            os.lchown(entry, *user)
+
+
+def effective_limits(suite):
+    return dict(DEFAULT_LIMITS, **suite.get("limits", {}))
+
+
+def run_submission(submission_dir, suite, sandbox=None):
+    """
+    1人分の提出物を、テストケースごとに実行した結果 {テストID: 結果} を返す（プロセスプールから呼ぶ）。
+    提出物はテストケースごとに一時フォルダにコピーし直してから実行するので、元のファイルは書き換えられず、
+    前のテストケースで書き出したファイルも残らない。sandbox は run_command を参照。
+    結果の status は "pass"（期待した出力と一致）, "fail"（一致しない）, "timeout", "error"（異常終了）のいずれか。
+    """
+    sandbox = detect_sandbox(sandbox or {"mode": "none"})
+    if sandbox["mode"] is None:
+        return {test["id"]: {"status": "error", "message": SANDBOX_UNAVAILABLE} for test in suite.get("tests", [])}
+    limits = effective_limits(suite)
+    command = suite.get("command") or [sys.executable, "{main}"]
+    main_file = find_main_file(submission_dir, suite.get("main", ".py"))
+    if main_file is None and any("{main}" in arg for arg in command):
+        message = f"{suite.get('main', '.py')} のファイルが提出されていません。"
+        return {test["id"]: {"status": "error", "message": message} for test in suite.get("tests", [])}
+    args = [arg.replace("{main}", main_file or "") for arg in command]
+    results = {}
+    for test in suite.get("tests", []):
+        with tempfile.TemporaryDirectory(prefix="code_run_") as tmp:
+            try:
+                workdir = _prepare_workdir(tmp, submission_dir, sandbox)
+                run = run_command(args, workdir, test.get("stdin", ""), limits, sandbox)
+            except OSError as e:
+                results[test["id"]] = {"status": "error", "message": str(e)}
+                continue
+        if run["timeout"]:
+            status = "timeout"
+        elif run["returncode"] != 0:
+            status = "error"
+        elif normalize_output(run["stdout"]) == normalize_output(test.get("expected", "")):
+            status = "pass"
+        else:
+            status = "fail"
+        results[test["id"]] = {
+            "status": status,
+            "returncode": run["returncode"],
+            "time": run["time"],
+            "stdout": run["stdout"][:KEEP_OUTPUT_CHARS],
+            "stderr": run["stderr"][:KEEP_OUTPUT_CHARS],
+        }
+    return results
+
+
+# ---- unshare で作った名前空間の中で実行する部分（wrap_command の "unshare"）----
+
+MS_RDONLY, MS_NOSUID, MS_NODEV, MS_NOEXEC = 1, 2, 4, 8
+MS_REMOUNT, MS_BIND, MS_REC, MS_PRIVATE = 32, 4096, 16384, 1 << 18
+MS_NOATIME, MS_NODIRATIME, MS_RELATIME = 1024, 2048, 1 << 21
+# 名前空間の中では、元のマウントの nosuid などは外せないので、読み込み専用にするときも引き継ぐ
+STATVFS_FLAGS = [
+    ("ST_NOSUID", MS_NOSUID), ("ST_NODEV", MS_NODEV), ("ST_NOEXEC", MS_NOEXEC),
+    ("ST_NOATIME", MS_NOATIME), ("ST_NODIRATIME", MS_NODIRATIME), ("ST_RELATIME", MS_RELATIME),
+]
+PR_CAPBSET_DROP, PR_SET_SECUREBITS, PR_SET_NO_NEW_PRIVS, PR_CAP_AMBIENT = 24, 28, 38, 47
+PR_CAP_AMBIENT_CLEAR_ALL = 4
+# SECBIT_NOROOT・SECBIT_NO_SETUID_FIXUP・SECBIT_KEEP_CAPS とそれぞれのロック（exec で root の特権を得ない）
+SECUREBITS_NOROOT = 0x2f
+
+
+def _libc_call(name, *args):
+    libc = ctypes.CDLL(None, use_errno=True)
+    if getattr(libc, name)(*args) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, f"{name}: {os.strerror(errno)}")
+
+
+def _mount(source, target, fstype, flags, data=None):
+    encode = lambda v: v.encode() if v is not None else None
+    _libc_call("mount", encode(source), encode(target), encode(fstype), ctypes.c_ulong(flags), encode(data))
+
+
+def _bind_readonly(path, target):
+    if os.path.isdir(path):
+        os.makedirs(target, exist_ok=True)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        open(target, "a").close()
+    _mount(path, target, None, MS_BIND | MS_REC)
+    flags = MS_BIND | MS_REMOUNT | MS_RDONLY
+    st = os.statvfs(target)
+    for name, flag in STATVFS_FLAGS:
+        if st.f_flag & getattr(os, name, 0):
+            flags |= flag
+    _mount(None, target, None, flags)
+
+
+def _drop_capabilities():
+    """root の特権を全て捨てる（ユーザー名前空間の root のまま exec しても、特権は戻らない）"""
+    with open("/proc/sys/kernel/cap_last_cap") as f:
+        last_cap = int(f.read())
+    for cap in range(last_cap + 1):
+        _libc_call("prctl", PR_CAPBSET_DROP, cap, 0, 0, 0)
+    _libc_call("prctl", PR_SET_SECUREBITS, SECUREBITS_NOROOT, 0, 0, 0)
+    _libc_call("prctl", PR_CAP_AMBIENT, PR_CAP_AMBIENT_CLEAR_ALL, 0, 0, 0)
+    header = (ctypes.c_uint32 * 2)(0x20080522, 0)  # _LINUX_CAPABILITY_VERSION_3, 自分自身
+    data = (ctypes.c_uint32 * 6)()
+    _libc_call("capset", header, data)
+
+
+def enter_sandbox(spec):
+    """
+    unshare で作った名前空間の中で spec["command"] を実行し、同じ終了コード（シグナルで止められたら同じシグナル）で終わる。
+    子プロセスが新しいPID名前空間の最初のプロセスになって環境を作り、その子プロセスで command を実行する
+    （最初のプロセスが終わると、名前空間に残ったプロセスも止まる）。command の終了の状態はパイプで受け取る。
+    """
+    status_read, status_write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(status_read)
+        try:
+            _run_in_sandbox(spec, status_write)
+        except BaseException as e:
+            print(f"sandbox: {e}", file=sys.stderr)
+        os._exit(127)
+    os.close(status_write)
+    with os.fdopen(status_read) as f:
+        reported = f.read()
+    _, status = os.waitpid(pid, 0)
+    if reported:
+        status = int(reported)
+    if os.WIFSIGNALED(status):
+        # RLIMIT_CPU (SIGXCPU) などで止められたことが run_command にわかるように
+        sig = os.WTERMSIG(status)
+        if sig != signal.SIGKILL:
+            signal.signal(sig, signal.SIG_DFL)
+        os.kill(os.getpid(), sig)
+    sys.exit(os.waitstatus_to_exitcode(status))
+
+
+def _run_in_sandbox(spec, status_write):
+    """
+    spec["root"] に見せるものだけをマウントして chroot し、特権を捨ててから spec["command"] を子プロセスで実行して、
+    終了の状態 (waitpid の status) を status_write に書く。
+    """
+    root = spec["root"]
+    _mount(None, "/", None, MS_REC | MS_PRIVATE)
+    os.makedirs(root, exist_ok=True)
+    _mount("tmpfs", root, "tmpfs", MS_NOSUID | MS_NODEV, "mode=0755")
+    for path, target in spec["paths"]:
+        if target is not None:
+            os.makedirs(os.path.dirname(root + path), exist_ok=True)
+            os.symlink(target, root + path)
+        else:
+            _bind_readonly(path, root + path)
+    for path in spec["masked"]:
+        if os.path.isdir(root + path):
+            _mount("tmpfs", root + path, "tmpfs", MS_NOSUID | MS_NODEV | MS_RDONLY, "mode=0755")
+    for device in DEVICES:
+        if os.path.exists(device):
+            os.makedirs(os.path.dirname(root + device), exist_ok=True)
+            open(root + device, "a").close()
+            _mount(device, root + device, None, MS_BIND)
+    os.makedirs(root + "/proc")
+    try:
+        _mount("proc", root + "/proc", "proc", MS_NOSUID | MS_NODEV | MS_NOEXEC)
+    except OSError:
+        pass  # コンテナの中などで proc をマウントできなければ、/proc なしで実行する
+    for path in spec["binds"]:
+        os.makedirs(root + path, exist_ok=True)
+        _mount(path, root + path, None, MS_BIND | MS_REC)
+    os.makedirs(root + SANDBOX_WORKDIR)
+    _mount(spec["workdir"], root + SANDBOX_WORKDIR, None, MS_BIND | MS_REC)
+    _mount(None, root, None, MS_REMOUNT | MS_RDONLY | MS_NOSUID | MS_NODEV)
+    os.chroot(root)
+    os.chdir(SANDBOX_WORKDIR)
+    if spec["user"] is not None:
+        uid, gid = spec["user"]
+        os.setgroups([])
+        os.setgid(gid)
+        os.setuid(uid)
+    else:
+        _drop_capabilities()
+    _libc_call("prctl", PR_SET_NO_NEW_PRIVS, 1, 0, 0, 0)
+    pid = os.fork()
+    if pid == 0:
+        # status_write は exec で閉じられる (os.pipe は継承しない)
+        try:
+            os.execvp(spec["command"][0], spec["command"])
+        except OSError as e:
+            print(f"sandbox: {e}", file=sys.stderr)
+        os._exit(127)
+    _, status = os.waitpid(pid, 0)
+    os.write(status_write, str(status).encode())
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    enter_sandbox(json.loads(sys.argv[1]))
@@ -0,0 +1,380 @@
+import os
+import io
+import re
+import json
+import heapq
+import atexit
+import hashlib
+import keyword
+import tokenize
+import threading
+import multiprocessing
+from itertools import chain, combinations
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from grader_app.models import write_file_atomic
+from grader_app.code_grader.utils import get_code_hash_index
+
+# 類似度を調べるソースファイルの拡張子
+SOURCE_EXTENSIONS = (".py", ".ipynb", ".c", ".h", ".cpp", ".hpp", ".java", ".js")
+
+# Python 以外のソースを字句に分ける正規表現（コメントは読み飛ばす）
+C_LIKE_TOKEN = re.compile(r"""
+    (?P<comment>//[^\n]*|/\*.*?\*/)
+  | (?P<string>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+  | (?P<number>\d[\w.]*)
+  | (?P<name>[A-Za-z_]\w*)
+  | (?P<op>\S)
+""", re.VERBOSE | re.DOTALL)
+
+C_LIKE_KEYWORDS = frozenset("""
+    auto break case catch char class const continue default delete do double else enum extern
+    false final float for function goto if import include int let long new null private protected
+    public return short signed sizeof static struct switch this throw true try typedef union
+    unsigned var void volatile while
+""".split())
+
+
+def read_source(path):
+    """
+    ソースファイルの中身を返す。ノートブックはコードのセルを "# In[n]" の行で区切ってつなげる
+    （一致した箇所の行番号は、このテキストの行番号）。
+    """
+    if path.endswith(".ipynb"):
+        from grader_app.code_grader.notebook import load_notebook
+        cells = [cell["source"] for cell in load_notebook(path) if cell["cell_type"] == "code"]
+        return "\n".join(f"# In[{n}]\n{source}" for n, source in enumerate(cells, 1))
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        return f.read()
+
+
+def tokenize_source(text, ext):
+    """
+    ソースを [(正規化した字句, 行番号), ...] にする。
+    変数名・関数名は "V"、数値は "N"、文字列は "S" にまとめ、コメントと空白は捨てる
+    （名前を付け替えただけのコピーも同じ字句の列になる）。
+    """
+    if ext in (".py", ".ipynb"):
+        try:
+            return _tokenize_python(text)
+        except (tokenize.TokenError, IndentationError, SyntaxError):
+            pass  # 構文の誤りがあるファイルは、C と同じ規則で分ける
+    tokens = []
+    for m in C_LIKE_TOKEN.finditer(text):
+        kind = m.lastgroup
+        if kind == "comment":
+            continue
+        line = text.count("\n", 0, m.start()) + 1
+        value = m.group()
+        if kind == "name":
+            value = value if value in C_LIKE_KEYWORDS else "V"
+        elif kind == "number":
+            value = "N"
+        elif kind == "string":
+            value = "S"
+        tokens.append((value, line))
+    return tokens
+
+
+def _tokenize_python(text):
+    tokens = []
+    skip = (tokenize.COMMENT, tokenize.NL, tokenize.NEWLINE, tokenize.INDENT, tokenize.DEDENT,
+            tokenize.ENCODING, tokenize.ENDMARKER,
+            # Python 3.12 からの f 文字列の中身（f 文字列全体を "S" にする）
+            getattr(tokenize, "FSTRING_MIDDLE", -1), getattr(tokenize, "FSTRING_END", -1))
+    for tok in tokenize.generate_tokens(io.StringIO(text).readline):
+        if tok.type in skip:
+            continue
+        if tok.type == tokenize.NAME:
+            value = tok.string if keyword.iskeyword(tok.string) else "V"
+        elif tok.type == tokenize.NUMBER:
+            value = "N"
+        elif tok.type in (tokenize.STRING, getattr(tokenize, "FSTRING_START", -1)):
+            value = "S"
+        else:
+            value = tok.string
+        tokens.append((value, tok.start[0]))
+    return tokens
+
+
+def winnow(tokens, k, window):
+    """
+    字句の k-gram のハッシュから、winnowing で指紋を選ぶ (MOSS と同じ方法)。
+    連続する window 個のハッシュごとに最小のもの（同じなら右端）を選ぶので、
+    window + k - 1 字句以上一致する箇所は必ず共通の指紋を持つ。
+    指紋は [ハッシュ, 開始行, 終了行] のリスト。
+    """
+    if len(tokens) < k:
+        return []
+    hashes = []
+    for i in range(len(tokens) - k + 1):
+        gram = "\0".join(value for value, _ in tokens[i:i + k]).encode('utf-8')
+        # hash() はプロセスごとに値が変わるので、保存できるハッシュを使う
+        hashes.append(int.from_bytes(hashlib.blake2b(gram, digest_size=8).digest(), "big"))
+    fingerprints = []
+    selected = -1
+    for start in range(max(1, len(hashes) - window + 1)):
+        end = min(start + window, len(hashes))
+        position = min(range(start, end), key=lambda i: (hashes[i], -i))
+        if position != selected:
+            selected = position
+            fingerprints.append([hashes[position], tokens[position][1], tokens[position + k - 1][1]])
+    return fingerprints
+
+
+def fingerprint_file(path, k, window):
+    """ファイルの指紋（プロセスプールで実行する）"""
+    return winnow(tokenize_source(read_source(path), os.path.splitext(path)[1].lower()), k, window)
+
+
+def source_files(submission_dir, extensions=SOURCE_EXTENSIONS):
+    """提出物のフォルダの中のソースファイルを {相対パス: パス} で返す"""
+    files = {}
+    for root, dirs, names in os.walk(submission_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith(".") and d != "__pycache__")
+        for name in sorted(names):
+            if name.lower().endswith(tuple(extensions)):
+                path = os.path.join(root, name)
+                files[os.path.relpath(path, submission_dir)] = path
+    return files
+
+
+def _merge_regions(matches):
+    """一致した指紋の [(ファイルA, 開始, 終了, ファイルB, 開始, 終了), ...] を、隣り合うものごとにまとめる"""
+    regions = []
+    for file_a, start_a, end_a, file_b, start_b, end_b in sorted(matches):
+        last = regions[-1] if regions else None
+        if (last and last["file_a"] == file_a and last["file_b"] == file_b
+                and start_a <= last["lines_a"][1] + 1
+                and start_b <= last["lines_b"][1] + 1 and end_b >= last["lines_b"][0] - 1):
+            last["lines_a"][1] = max(last["lines_a"][1], end_a)
+            last["lines_b"] = [min(last["lines_b"][0], start_b), max(last["lines_b"][1], end_b)]
+            last["fingerprints"] += 1
+            continue
+        regions.append({"file_a": file_a, "lines_a": [start_a, end_a],
+                        "file_b": file_b, "lines_b": [start_b, end_b], "fingerprints": 1})
+    return regions
+
+
+def find_similar(index, top_k, max_share=0.1, max_holders=10):
+    """
+    索引 (SimilarityIndex.load の形式) から、共通の指紋が多い学生の組を top_k 組返す。
+    max_holders 人より多くの学生、または max_share より多くの割合の学生が持つ指紋は、
+    配布したコードなど共通の部分とみなして数えない（MOSS の -m と同じ）。
+    1つの指紋から数える組は多くても max_holders 人の中の組なので、学生が増えても組の数え上げが膨らまない。
+    組ごとに {"a", "b", "shared", "percent_a", "percent_b", "regions"} を返す
+    （percent_a は a の指紋のうち b と共通のものの割合、regions は一致した箇所）。
+    全ての組を比べるのではなく、指紋ごとにそれを持つ学生の組だけを数える。
+    """
+    students = sorted(index.get("students", {}))
+    postings = defaultdict(dict)  # 指紋のハッシュ -> {学生の番号: (ファイル, 開始行, 終了行)}
+    for number, name in enumerate(students):
+        for relpath, entry in sorted(index["students"][name]["files"].items()):
+            for h, start, end in entry["fingerprints"]:
+                postings[h].setdefault(number, (relpath, start, end))
+
+    max_students = max(2, min(max_holders, int(len(students) * max_share)))
+    shared_postings = [holders for holders in postings.values() if 2 <= len(holders) <= max_students]
+    # 割合は、共通の部分とみなした指紋を除いた数に対して求める
+    sizes = Counter(chain.from_iterable(holders for holders in postings.values() if len(holders) <= max_students))
+    # postings の学生の番号は小さい順に入っているので、組は (a, b) で a < b になる
+    counts = Counter(chain.from_iterable(combinations(holders, 2) for holders in shared_postings))
+    top = heapq.nsmallest(top_k, counts.items(), key=lambda item: (-item[1], item[0]))
+
+    # 一致した箇所は、上位の組の分だけ集める
+    own = defaultdict(list)  # 学生の番号 -> その学生が持つ指紋の、学生の一覧
+    top_students = {number for pair, _ in top for number in pair}
+    for holders in shared_postings:
+        for number in top_students.intersection(holders):
+            own[number].append(holders)
+    matches = {
+        (a, b): [holders[a] + holders[b] for holders in own[a] if b in holders]
+        for (a, b), _ in top
+    }
+
+    pairs = []
+    for (a, b), shared in top:
+        pairs.append({
+            "a": students[a], "b": students[b], "shared": shared,
+            "percent_a": round(100 * shared / sizes[a]) if sizes[a] else 0,
+            "percent_b": round(100 * shared / sizes[b]) if sizes[b] else 0,
+            "regions": _merge_regions(matches[(a, b)]),
+        })
+    return pairs
+
+
+class SimilarityIndex:
+    """
+    課題ごとの提出物の指紋の索引。index_dir/<課題>.json に
+      {"params": {"k", "window"}, "students": {学生名: {"files": {相対パス: {"sha1", "fingerprints"}}}}}
+    の形式で保存する。update では内容 (sha1) が変わったファイルだけ、プロセスプールで指紋を作り直すので、
+    遅れて提出された1人分を加えても、その人のファイルしか読み直さない。
+    ファイルの sha1 は hashes (ContentHashIndex) から引くので、サイズと更新時刻が変わっていなければ読み直さない。
+    """
+
+    def __init__(self, index_dir, max_workers, hashes, k=12, window=8):
+        self.index_dir = index_dir
+        self.hashes = hashes
+        self.max_workers = max_workers
+        self.params = {"k": k, "window": window}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._closed = False
+        self._progress = {}  # 課題 -> {"total", "done", "fingerprinted", "failed"}
+        self._pairs = {}     # (課題, top_k, max_share, max_holders) -> (索引の更新時刻, 組のリスト)
+
+    def _sha1(self, path):
+        return self.hashes.digest(path).split("-", 1)[1]  # 「サイズ-SHA-1」の SHA-1
+
+    def _path(self, report):
+        return os.path.join(self.index_dir, f"{report}.json")
+
+    def load(self, report):
+        """保存してある索引（無いか設定が違えば、空の索引）"""
+        try:
+            with open(self._path(report), 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            index = None
+        if not index or index.get("params") != self.params:
+            return {"params": dict(self.params), "students": {}}
+        return index
+
+    def stale(self, report, submissions):
+        """索引に入っていない・内容が変わった提出物の学生名のリスト"""
+        students = self.load(report)["students"]
+        changed = [name for name in submissions if name not in students]
+        for name in submissions:
+            if name in students:
+                files = {relpath: self._sha1(path) for relpath, path in source_files(submissions[name]).items()}
+                if files != {relpath: entry["sha1"] for relpath, entry in students[name]["files"].items()}:
+                    changed.append(name)
+        self.hashes.save()
+        return sorted(set(changed) | (set(students) - set(submissions)))
+
+    def update(self, report, submissions):
+        """
+        submissions ({学生名: フォルダのパス}) で索引を更新する（別のスレッドで行い、すぐに戻る）。
+        すでに更新中なら何もしない。
+        """
+        with self._lock:
+            current = self._progress.get(report)
+            if self._closed or (current is not None and not current.get("finished")):
+                return
+            progress = {"total": 0, "done": 0, "fingerprinted": 0, "failed": 0}
+            self._progress[report] = progress
+        threading.Thread(
+            target=self._update, args=(report, submissions, progress), name="similarity-index", daemon=True,
+        ).start()
+
+    def status(self, report):
+        with self._lock:
+            progress = self._progress.get(report)
+            return dict(progress) if progress is not None else None
+
+    def running(self, report):
+        progress = self.status(report)
+        return progress is not None and not progress.get("finished")
+
+    def similar_pairs(self, report, top_k, max_share=0.1, max_holders=10):
+        """保存してある索引から、似ている組を top_k 組返す（索引が変わるまで結果を覚えておく）"""
+        try:
+            mtime = os.stat(self._path(report)).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        key = (report, top_k, max_share, max_holders)
+        with self._lock:
+            cached = self._pairs.get(key)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        pairs = find_similar(self.load(report), top_k, max_share, max_holders)
+        with self._lock:
+            self._pairs[key] = (mtime, pairs)
+        return pairs
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("終了処理中です。")
+            if self._executor is None:
+                # spawn にしておくと、Flaskのスレッドを抱えたままforkすることがない
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._executor
+
+    def _update(self, report, submissions, progress):
+        try:
+            old = self.load(report)["students"]
+            known = {}  # sha1 -> 指紋（同じ内容のファイルは1回だけ指紋を作る）
+            for student in old.values():
+                for entry in student["files"].values():
+                    known[entry["sha1"]] = entry["fingerprints"]
+
+            students = {}
+            pending = defaultdict(list)  # sha1 -> [(学生名, 相対パス), ...]
+            paths = {}
+            for name, submission_dir in submissions.items():
+                students[name] = {"files": {}}
+                for relpath, path in source_files(submission_dir).items():
+                    sha1 = self._sha1(path)
+                    if sha1 in known:
+                        students[name]["files"][relpath] = {"sha1": sha1, "fingerprints": known[sha1]}
+                    else:
+                        pending[sha1].append((name, relpath))
+                        paths[sha1] = path
+            self.hashes.save()
+            with self._lock:
+                progress["total"] = len(pending)
+
+            if pending:
+                executor = self._get_executor()
+                futures = {
+                    sha1: executor.submit(fingerprint_file, paths[sha1], self.params["k"], self.params["window"])
+                    for sha1 in pending
+                }
+                for sha1, future in futures.items():
+                    try:
+                        fingerprints = future.result()
+                    except Exception as e:
+                        print(f"エラー: {paths[sha1]} の指紋を作れませんでした。エラー: {e}")
+                        fingerprints = None
+                    with self._lock:
+                        progress["done"] += 1
+                        progress["fingerprinted" if fingerprints is not None else "failed"] += 1
+                    for name, relpath in pending[sha1]:
+                        if fingerprints is not None:
+                            students[name]["files"][relpath] = {"sha1": sha1, "fingerprints": fingerprints}
+
+            os.makedirs(self.index_dir, exist_ok=True)
+            index = {"params": self.params, "students": students}
+            write_file_atomic(self._path(report), json.dumps(index, ensure_ascii=False).encode('utf-8'))
+            print(f"{report}: 類似度の索引を更新しました（{len(students)} 人、指紋を作ったファイル {progress['fingerprinted']} 個）")
+        except Exception as e:
+            print(f"エラー: {report} の類似度の索引を更新できませんでした。エラー: {e}")
+        finally:
+            with self._lock:
+                progress["finished"] = True
+
+
+def create_similarity_index(app):
+    """SimilarityIndex を作成し、app.config に登録する（プロセスプールは最初に更新するときに作る）"""
+    index = SimilarityIndex(
+        app.config['SIMILARITY_INDEX_DIR'],
+        app.config.get('SIMILARITY_WORKERS', 1),
+        get_code_hash_index(app),
+        app.config.get('SIMILARITY_KGRAM', 12),
+        app.config.get('SIMILARITY_WINDOW', 8),
+    )
+    atexit.register(index.shutdown)
+    app.config['SIMILARITY_INDEX'] = index
+    return index
@@ -1,6 +1,120 @@
+import os
+import json
+import hashlib
+from flask import current_app
+
+from grader_app.models import write_file_atomic
+from grader_app.pdf_grader.hashes import ContentHashIndex
+
+
 def extract_keys(task_name):
     name = task_name.split("課題")[1]
     split_name = name.split("-")
     numbers = [int(n) for n in split_name if n.isdigit()]
     numbers = numbers[:-1]
     return numbers
+
+def get_submissions(report):
+    """
+    提出フォルダ (CODE_BASE_DIR/<課題>) の学生ごとのフォルダを {学生名: フォルダのパス} で返す。
+    学生名は PDF と同じく、フォルダ名の "_" より前の部分。
+    """
+    report_dir = os.path.join(current_app.config['CODE_BASE_DIR'], report)
+    submissions = {}
+    try:
+        entries = sorted(os.scandir(report_dir), key=lambda e: e.name)
+    except FileNotFoundError:
+        return submissions
+    for entry in entries:
+        if entry.is_dir():
+            submissions.setdefault(entry.name.split("_")[0], entry.path)
+    return dict(sorted(submissions.items()))
+
+def submission_digest(submission_dir, hashes):
+    """
+    提出物のフォルダの中身（相対パスとファイルの内容）のハッシュ。
+    ファイルの内容のハッシュは hashes (ContentHashIndex) から引くので、変わっていないファイルは読み直さない。
+    """
+    h = hashlib.sha1()
+    for root, dirs, files in os.walk(submission_dir):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            h.update(os.path.relpath(path, submission_dir).encode('utf-8') + b"\0")
+            h.update(hashes.digest(path).encode('utf-8') + b"\0")
+    return h.hexdigest()
+
+def get_code_hash_index(app):
+    """app.config のプログラムの提出物用の ContentHashIndex を返す（無ければ作る）"""
+    index = app.config.get('CODE_HASH_INDEX')
+    if index is None:
+        index = ContentHashIndex(app.config['CODE_HASH_INDEX_PATH'], app.config['CODE_BASE_DIR'])
+        app.config['CODE_HASH_INDEX'] = index
+    return index
+
+def suite_digest(suite):
+    """テストの設定のハッシュ（テストケースや制限を変えると変わる）"""
+    from grader_app.code_grader.sandbox import effective_limits
+    data = dict(suite, limits=effective_limits(suite))
+    return hashlib.sha1(json.dumps(data, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def get_tests_path(report):
+    return os.path.join(current_app.config['CODE_SAVE_DIR'], f"{report}_tests.json")
+
+def load_test_suite(report):
+    """
+    CODE_SAVE_DIR/<課題>_tests.json のテストの設定を返す。形式は
+      {"command": ["python3", "{main}"], "main": ".py", "limits": {"timeout": 5.0, ...},
+       "tests": [{"id": "t1", "description": "...", "stdin": "...", "expected": "...", "points": 10}, ...]}
+    command の {main} は、提出物の中で最初に見つかった main で終わるファイルに置き換える。
+    "mode": "notebook" なら提出物は Jupyter ノートブック (main の既定は .ipynb) で、
+    テストケースは stdin・expected の代わりに、ノートブックを実行した後に実行する code（assert など）を持つ。
+    """
+    try:
+        with open(get_tests_path(report), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"tests": []}
+
+def validate_test_suite(suite):
+    """テストの設定に誤りがあれば、そのメッセージを返す（なければ None）"""
+    if not isinstance(suite, dict) or not isinstance(suite.get("tests"), list):
+        return "tests（テストケースのリスト）がありません。"
+    if suite.get("mode", "program") not in ("program", "notebook"):
+        return 'mode は "program" か "notebook" で指定してください。'
+    ids = set()
+    for test in suite["tests"]:
+        if not isinstance(test, dict) or not test.get("id"):
+            return "id のないテストケースがあります。"
+        if test["id"] in ids:
+            return f"テストケースの id が重複しています: {test['id']}"
+        ids.add(test["id"])
+        if suite.get("mode") == "notebook" and not isinstance(test.get("code", ""), str):
+            return f"テストケース {test['id']} の code は文字列で指定してください。"
+    command = suite.get("command")
+    if command is not None and not (isinstance(command, list) and command and all(isinstance(a, str) for a in command)):
+        return "command は文字列のリストで指定してください。"
+    return None
+
+def test_problems(suite):
+    """テストケースを、採点結果の問題 ({課題}_problems.json の形式) として返す"""
+    tests = suite.get("tests", [])
+    return {
+        "order": [test["id"] for test in tests],
+        "problems": {test["id"]: test.get("description", test["id"]) for test in tests},
+        "points": {test["id"]: test.get("points", 1) for test in tests},
+    }
+
+def save_test_suite(report, suite):
+    """テストの設定を保存し、問題の設定 ({課題}_problems.json) もテストケースに合わせる"""
+    from grader_app.utils import save_problems_to_json
+    os.makedirs(current_app.config['CODE_SAVE_DIR'], exist_ok=True)
+    write_file_atomic(get_tests_path(report), json.dumps(suite, ensure_ascii=False, indent=4).encode('utf-8'))
+    save_problems_to_json('code', report, test_problems(suite))
+
+def result_grades(suite, results):
+    """テストの結果を、採点結果の評価 {"grade_{テストID}": "circle" / "cross"} にする"""
+    return {
+        f"grade_{test['id']}": "circle" if results.get(test["id"], {}).get("status") == "pass" else "cross"
+        for test in suite.get("tests", [])
+    }
@@ -0,0 +1,202 @@
+import os
+import json
+import threading
+
+# 採点の評価の種類
+GRADE_MARKS = ["circle", "triangle", "cross"]
+
+
+def compute_point(order, points, grades):
+    """学生の得点を求める（get_point と同じ計算）"""
+    student_point = 0
+    for problem_id in order:
+        point = points.get(problem_id, 0)
+        grade = grades.get(f"grade_{problem_id}", 0)
+        if grade == "circle":
+            student_point += point
+        elif grade == "triangle":
+            student_point += point / 2
+        # else: 0点として加算しない
+    return student_point
+
+
+def is_finished(order, grades):
+    """全ての問題の評価が入力されているか（check_all_grades_entered と同じ判定）"""
+    return all(f"grade_{problem_id}" in grades for problem_id in order)
+
+
+def count_marks(grades):
+    """{問題ID: {"seen", "circle", "triangle", "cross"}} の形で、学生1人分の評価を数える"""
+    counts = {}
+    for k, v in grades.items():
+        c = counts.setdefault(k.replace("grade_", ""), dict.fromkeys(["seen"] + GRADE_MARKS, 0))
+        c["seen"] += 1
+        if v in GRADE_MARKS:
+            c[v] += 1
+    return counts
+
+
+class GradeIndex:
+    """
+    レポートごとの採点結果の集計の索引。
+    学生ごとの完了フラグ・得点と、問題ごとの ○/△/× の数をメモリ上に持っておき、
+    save_grades_to_json から呼ばれる update で差分だけを更新する。
+    保存フォルダの更新時刻が変わったとき（新しい学生のファイルができたときなど）は、
+    更新時刻が変わったファイルだけを読み直す。
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._reports = {}  # (save_dir, report_name) -> 集計
+
+    def update(self, save_dir, report_name, student_name, grades):
+        """学生の採点結果が保存されたときに呼ぶ"""
+        with self._lock:
+            report = self._sync(save_dir, report_name)
+            self._set_student(report, student_name, grades)
+            path = os.path.join(save_dir, report_name, f"{student_name}.json")
+            try:
+                report["files"][student_name] = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                report["files"][student_name] = None
+            report["dir_mtime"] = self._dir_mtime(save_dir, report_name)
+
+    def update_problems(self, save_dir, report_name, problems):
+        """問題の設定が保存されたときに呼ぶ（完了フラグと得点を計算し直す）"""
+        with self._lock:
+            report = self._sync(save_dir, report_name)
+            self._set_problems(report, problems)
+            report["problems_mtime"] = self._problems_mtime(save_dir, report_name)
+
+    def finished(self, save_dir, report_name, student_names):
+        with self._lock:
+            report = self._sync(save_dir, report_name)
+            return [report["finished"].get(s, len(report["order"]) == 0) for s in student_names]
+
+    def all_finished(self, save_dir, report_name, student_names):
+        return all(self.finished(save_dir, report_name, student_names))
+
+    def point(self, save_dir, report_name, student_name):
+        """(学生の得点, 満点) を返す"""
+        with self._lock:
+            report = self._sync(save_dir, report_name)
+            return report["point"].get(student_name, 0), report["total_point"]
+
+    def summary(self, save_dir, report_name, student_names):
+        """summarize_problems と同じ形の集計を返す"""
+        with self._lock:
+            report = self._sync(save_dir, report_name)
+            counts = {problem_id: dict(c) for problem_id, c in report["counts"].items()}
+            # 名簿にない学生の分を除く
+            for student_name in report["grades"].keys() - set(student_names):
+                for problem_id, c in count_marks(report["grades"][student_name]).items():
+                    for key in c:
+                        counts[problem_id][key] -= c[key]
+            summary = {"total": {}, "correct": {}}
+            for problem_id, c in counts.items():
+                if c["seen"] == 0:
+                    continue
+                summary["total"][problem_id] = c["circle"] + c["triangle"] + c["cross"]
+                summary["correct"][problem_id] = c["circle"]
+            return summary
+
+    def clear(self):
+        with self._lock:
+            self._reports.clear()
+
+    def _dir_mtime(self, save_dir, report_name):
+        try:
+            return os.stat(os.path.join(save_dir, report_name)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _problems_mtime(self, save_dir, report_name):
+        try:
+            return os.stat(os.path.join(save_dir, f"{report_name}_problems.json")).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _sync(self, save_dir, report_name):
+        key = (save_dir, report_name)
+        report = self._reports.get(key)
+        if report is None:
+            report = {
+                "dir_mtime": False,
+                "problems_mtime": False,
+                "order": [],
+                "points": {},
+                "total_point": 0,
+                "files": {},        # 学生名 -> ファイルの更新時刻
+                "grades": {},       # 学生名 -> 採点結果
+                "finished": {},     # 学生名 -> 完了フラグ
+                "point": {},        # 学生名 -> 得点
+                "counts": {},       # 問題ID -> {"seen", "circle", "triangle", "cross"}
+            }
+            self._reports[key] = report
+
+        problems_mtime = self._problems_mtime(save_dir, report_name)
+        if problems_mtime != report["problems_mtime"]:
+            problems = {"order": [], "problems": {}}
+            if problems_mtime is not None:
+                with open(os.path.join(save_dir, f"{report_name}_problems.json"), 'r', encoding='utf-8') as f:
+                    problems = json.load(f)
+            self._set_problems(report, problems)
+            report["problems_mtime"] = problems_mtime
+
+        dir_mtime = self._dir_mtime(save_dir, report_name)
+        if dir_mtime != report["dir_mtime"]:
+            dirname = os.path.join(save_dir, report_name)
+            seen = set()
+            if dir_mtime is not None:
+                for entry in os.scandir(dirname):
+                    if not entry.name.endswith(".json") or not entry.is_file():
+                        continue
+                    student_name = entry.name[:-len(".json")]
+                    seen.add(student_name)
+                    mtime = entry.stat().st_mtime_ns
+                    if report["files"].get(student_name) != mtime:
+                        with open(entry.path, 'r', encoding='utf-8') as f:
+                            self._set_student(report, student_name, json.load(f))
+                        report["files"][student_name] = mtime
+            for student_name in list(report["files"]):
+                if student_name not in seen:
+                    self._remove_student(report, student_name)
+            report["dir_mtime"] = dir_mtime
+        return report
+
+    def _set_problems(self, report, problems):
+        report["order"] = list(problems.get("order", []))
+        report["points"] = dict(problems.get("points", {}))
+        report["total_point"] = sum(report["points"].get(problem_id, 0) for problem_id in report["order"])
+        for student_name, grades in report["grades"].items():
+            report["finished"][student_name] = is_finished(report["order"], grades)
+            report["point"][student_name] = compute_point(report["order"], report["points"], grades)
+
+    def _remove_student(self, report, student_name):
+        grades = report["grades"].pop(student_name, None)
+        report["files"].pop(student_name, None)
+        report["point"].pop(student_name, None)
+        report["finished"].pop(student_name, None)
+        if grades is not None:
+            for problem_id, c in count_marks(grades).items():
+                for key in c:
+                    report["counts"][problem_id][key] -= c[key]
+
+    def _set_student(self, report, student_name, grades):
+        self._remove_student(report, student_name)
+        report["grades"][student_name] = dict(grades)
+        report["finished"][student_name] = is_finished(report["order"], grades)
+        report["point"][student_name] = compute_point(report["order"], report["points"], grades)
+        for problem_id, c in count_marks(grades).items():
+            counts = report["counts"].setdefault(problem_id, dict.fromkeys(["seen"] + GRADE_MARKS, 0))
+            for key in c:
+                counts[key] += c[key]
+
+
+def get_grade_index(app):
+    """app.config の GradeIndex を返す（無ければ作る）"""
+    index = app.config.get('GRADE_INDEX')
+    if index is None:
+        index = GradeIndex()
+        app.config['GRADE_INDEX'] = index
+    return index
@@ -1,10 +1,37 @@
-from flask import Blueprint, render_template, current_app
+from flask import Blueprint, render_template, current_app, jsonify
 from grader_app.utils import refresh_app_config
+from grader_app.shared import start_background_services, sync_shared_state, notify_change
+from grader_app.startup import is_report_scan_done, wait_for_report_scan
 from flask import redirect, request, url_for
 
 
 main_bp = Blueprint('main', __name__)
 
+@main_bp.before_app_request
+def start_background():
+    # Werkzeugのリローダーの親プロセスで画像の事前生成・zipの展開・監視が走らないよう、最初のリクエストで起動する
+    # （gunicorn では gunicorn.conf.py の post_worker_init で起動する）
+    start_background_services(current_app)
+
+# 起動時のフォルダのスキャンを待たずに表示するページ（課題一覧は「読み込み中」と表示する）
+SCAN_OPTIONAL_ENDPOINTS = {'main.index', 'main.extract_status', 'pdf.index', 'code.index'}
+
+@main_bp.before_app_request
+def wait_report_scan():
+    # レポートの番号を使うページは、レポートの一覧ができるまで待つ
+    endpoint = request.endpoint or ''
+    if endpoint not in SCAN_OPTIONAL_ENDPOINTS and not endpoint.endswith('static'):
+        wait_for_report_scan(current_app)
+
+@main_bp.app_context_processor
+def report_scan_state():
+    return {"report_scanning": not is_report_scan_done(current_app)}
+
+@main_bp.before_app_request
+def sync_shared():
+    # 他のワーカープロセスでの変更（レポートの一覧・設定・採点結果）を取り込む
+    sync_shared_state(current_app)
+
 @main_bp.route('/')
 def index():
     return render_template("index.html")
@@ -12,5 +39,22 @@ def index():
 @main_bp.route('/reload_reports/')
 def reload_reports():
     """PDFとCodeのリストを再読み込みするルート"""
+    from grader_app.pdf_grader.utils import get_roster_cache
+    from grader_app.models import get_grade_store
+    from grader_app.pdf_grader.overview import get_report_overview
     refresh_app_config()
-    return redirect(request.referrer or url_for('main.index'))
\ No newline at end of file
+    # レポート番号が変わることがあるので、学生名簿のキャッシュも捨てる
+    get_roster_cache(current_app).clear()
+    # 採点結果のファイルを直接編集した場合にも読み直されるよう、集計の索引も捨てる
+    get_grade_store(current_app).clear_cache()
+    get_report_overview(current_app).clear()
+    notify_change(current_app, "reload")
+    return redirect(request.referrer or url_for('main.index'))
+
+@main_bp.route('/extract_status/')
+def extract_status():
+    """zipの展開の進み具合を返す"""
+    extractor = current_app.config.get('ZIP_EXTRACTOR')
+    if extractor is None:
+        return jsonify({"enabled": False, "zips": []})
+    return jsonify({"enabled": True, "workers": extractor.max_workers, "zips": extractor.status()})
@@ -0,0 +1,543 @@
+import os
+import json
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import click
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from grader_app.grade_index import get_grade_index
+
+# 採点結果を保存するレポートの種類（{種類}_SAVE_DIR に対応する）
+REPORT_TYPES = ["pdf", "code"]
+
+
+# 採点結果が保存されていない学生のバージョン
+NO_VERSION = ""
+
+
+class GradeConflict(Exception):
+    """採点結果を読み込んだ後に、他の採点者（別のタブ）が同じ学生の採点結果を保存していた"""
+
+    def __init__(self, version, grades):
+        super().__init__(f"採点結果のバージョンが一致しません（現在のバージョン: {version!r}）")
+        # 保存されている最新のバージョンと採点結果
+        self.version = version
+        self.grades = grades
+
+
+class GradeStore:
+    """
+    採点結果の保存先のインターフェース。
+    採点結果は学生ごとに {"grade_{問題ID}": "circle" など} の dict で扱う。
+    学生ごとの採点結果にはバージョン（文字列）があり、保存するたびに変わる。
+    save に読み込んだときのバージョンを渡すと、その後に他から保存されていた場合は GradeConflict を送出する。
+    """
+
+    def load(self, report_type, report_name, student_name):
+        """学生の採点結果を返す。保存されていなければ {}"""
+        return self.load_versioned(report_type, report_name, student_name)[0]
+
+    def load_versioned(self, report_type, report_name, student_name):
+        """(学生の採点結果, バージョン) を返す。保存されていなければ ({}, NO_VERSION)"""
+        raise NotImplementedError
+
+    def save(self, report_type, report_name, student_name, grades, expected_version=None):
+        """
+        学生の採点結果を保存し、新しいバージョンを返す。
+        expected_version が None でなく、保存されているバージョンと違う場合は保存せずに GradeConflict を送出する。
+        """
+        raise NotImplementedError
+
+    def apply_changes(self, report_type, report_name, student_name, changes):
+        """
+        変更された評価だけを書き込み、(書き込んだ後の採点結果, 新しいバージョン) を返す。
+        changes は {"grade_{問題ID}": 評価} で、評価が None のものは取り消す。
+        他から同時に保存されても、変更していない問題の評価はそのまま残る。
+        """
+        while True:
+            grades, version = self.load_versioned(report_type, report_name, student_name)
+            for key, grade in changes.items():
+                if grade is None:
+                    grades.pop(key, None)
+                else:
+                    grades[key] = grade
+            try:
+                return grades, self.save(report_type, report_name, student_name, grades, version)
+            except GradeConflict:
+                continue
+
+    def reports(self, report_type):
+        """採点結果が保存されているレポート名のリスト"""
+        raise NotImplementedError
+
+    def report_grades(self, report_type, report_name):
+        """{学生名: 採点結果} を返す（書き出し用）"""
+        raise NotImplementedError
+
+    def problems_saved(self, report_type, report_name, problems):
+        """問題の設定が保存されたときに呼ばれる"""
+        pass
+
+    def finished(self, report_type, report_name, student_names, problems):
+        """学生ごとに、全ての問題の採点が終わっているかどうかのリスト"""
+        raise NotImplementedError
+
+    def point(self, report_type, report_name, student_name, problems):
+        """(学生の得点, 満点) を返す"""
+        raise NotImplementedError
+
+    def summary(self, report_type, report_name, student_names):
+        """問題ごとの採点数 (total) と正答数 (correct) を返す"""
+        raise NotImplementedError
+
+    def clear_cache(self):
+        pass
+
+
+def content_version(data):
+    """JSONファイルの中身 (bytes) から、採点結果のバージョンを求める"""
+    return hashlib.sha1(data).hexdigest()[:16]
+
+
+def write_file_atomic(path, data):
+    """
+    data (bytes) を path に書き込む。
+    同じフォルダの一時ファイルに書いてから置き換えるので、読み込む側が書きかけのファイルを見ることはない。
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+class JsonGradeStore(GradeStore):
+    """
+    {種類}_SAVE_DIR/<レポート名>/<学生名>.json に1人1ファイルで保存する（従来の形式）。
+    集計は GradeIndex がメモリ上で行う。
+    バージョンはファイルの中身のハッシュ。保存はレポートのフォルダをロックしてから行う
+    （fcntl が使える環境では flock も使うので、複数のプロセスから保存しても壊れない）。
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._lock = threading.Lock()
+        self._dir_locks = {}  # レポートのフォルダ -> threading.Lock
+
+    def _save_dir(self, report_type):
+        return self.app.config[f'{report_type.upper()}_SAVE_DIR']
+
+    @contextmanager
+    def _locked(self, dirname):
+        with self._lock:
+            lock = self._dir_locks.setdefault(dirname, threading.Lock())
+        with lock:
+            if fcntl is None:
+                yield
+                return
+            fd = os.open(dirname, os.O_RDONLY)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return {}, NO_VERSION
+        return json.loads(data.decode('utf-8')), content_version(data)
+
+    def load_versioned(self, report_type, report_name, student_name):
+        return self._read(os.path.join(self._save_dir(report_type), report_name, f"{student_name}.json"))
+
+    def save(self, report_type, report_name, student_name, grades, expected_version=None):
+        dirname = os.path.join(self._save_dir(report_type), report_name)
+        os.makedirs(dirname, exist_ok=True)
+        GRADES_FILE = os.path.join(dirname, f"{student_name}.json")
+        data = json.dumps(grades, ensure_ascii=False, indent=4).encode('utf-8')
+        with self._locked(dirname):
+            if expected_version is not None:
+                current, version = self._read(GRADES_FILE)
+                if version != expected_version:
+                    raise GradeConflict(version, current)
+            write_file_atomic(GRADES_FILE, data)
+            get_grade_index(self.app).update(self._save_dir(report_type), report_name, student_name, grades)
+        return content_version(data)
+
+    def reports(self, report_type):
+        save_dir = self._save_dir(report_type)
+        if not os.path.exists(save_dir):
+            return []
+        return sorted(e.name for e in os.scandir(save_dir) if e.is_dir())
+
+    def report_grades(self, report_type, report_name):
+        dirname = os.path.join(self._save_dir(report_type), report_name)
+        grades = {}
+        for entry in sorted(os.scandir(dirname), key=lambda e: e.name):
+            if entry.is_file() and entry.name.endswith(".json"):
+                with open(entry.path, 'r', encoding='utf-8') as f:
+                    grades[entry.name[:-len(".json")]] = json.load(f)
+        return grades
+
+    def problems_saved(self, report_type, report_name, problems):
+        get_grade_index(self.app).update_problems(self._save_dir(report_type), report_name, problems)
+
+    def finished(self, report_type, report_name, student_names, problems):
+        return get_grade_index(self.app).finished(self._save_dir(report_type), report_name, student_names)
+
+    def point(self, report_type, report_name, student_name, problems):
+        return get_grade_index(self.app).point(self._save_dir(report_type), report_name, student_name)
+
+    def summary(self, report_type, report_name, student_names):
+        return get_grade_index(self.app).summary(self._save_dir(report_type), report_name, student_names)
+
+    def clear_cache(self):
+        get_grade_index(self.app).clear()
+
+
+class SqliteGradeStore(GradeStore):
+    """
+    SQLiteのデータベース1つに保存する。1行が (レポート, 学生, 問題) の1つの評価。
+    WALモードにしておくと、自動保存の書き込み中でも集計の読み込みが止まらない。
+    バージョンは grade_sheets の version 列（保存するたびに1増える）。
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS grade_sheets (
+        report_type TEXT NOT NULL,
+        report TEXT NOT NULL,
+        student TEXT NOT NULL,
+        version INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (report_type, report, student)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS grades (
+        report_type TEXT NOT NULL,
+        report TEXT NOT NULL,
+        student TEXT NOT NULL,
+        key TEXT NOT NULL,
+        problem TEXT NOT NULL,
+        grade,
+        position INTEGER NOT NULL,
+        PRIMARY KEY (report_type, report, student, key)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS grades_report_problem ON grades (report_type, report, problem);
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        # フォークしたワーカー (gunicorn の preload_app) で、親プロセスの接続を使い回さない
+        os.register_at_fork(after_in_child=self._reset_connections)
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+            # version 列が無い、以前のデータベースに列を追加する
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(grade_sheets)")]
+            if "version" not in columns:
+                conn.execute("ALTER TABLE grade_sheets ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+    def _reset_connections(self):
+        self._local = threading.local()
+
+    def _connect(self):
+        # sqlite3 の接続はスレッドをまたいで使えないので、スレッドごとに作る
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _version(self, conn, report_type, report_name, student_name):
+        row = conn.execute(
+            "SELECT version FROM grade_sheets WHERE report_type = ? AND report = ? AND student = ?",
+            (report_type, report_name, student_name),
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def load(self, report_type, report_name, student_name):
+        rows = self._connect().execute(
+            "SELECT key, grade FROM grades WHERE report_type = ? AND report = ? AND student = ? ORDER BY position",
+            (report_type, report_name, student_name),
+        )
+        return {key: grade for key, grade in rows}
+
+    def load_versioned(self, report_type, report_name, student_name):
+        conn = self._connect()
+        with conn:
+            # 採点結果とバージョンを同じスナップショットから読む
+            conn.execute("BEGIN")
+            version = self._version(conn, report_type, report_name, student_name)
+            grades = self.load(report_type, report_name, student_name)
+        return grades, NO_VERSION if version is None else str(version)
+
+    def save(self, report_type, report_name, student_name, grades, expected_version=None):
+        conn = self._connect()
+        with conn:
+            # 確認してから書き込むまでの間に、他から書き込まれないようにする
+            conn.execute("BEGIN IMMEDIATE")
+            version = self._version(conn, report_type, report_name, student_name)
+            current = NO_VERSION if version is None else str(version)
+            if expected_version is not None and expected_version != current:
+                raise GradeConflict(current, self.load(report_type, report_name, student_name))
+            new_version = 1 if version is None else version + 1
+            conn.execute(
+                "INSERT INTO grade_sheets (report_type, report, student, version) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (report_type, report, student) DO UPDATE SET version = excluded.version",
+                (report_type, report_name, student_name, new_version),
+            )
+            conn.execute(
+                "DELETE FROM grades WHERE report_type = ? AND report = ? AND student = ?",
+                (report_type, report_name, student_name),
+            )
+            conn.executemany(
+                "INSERT INTO grades (report_type, report, student, key, problem, grade, position) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (report_type, report_name, student_name, key, key.replace("grade_", ""), grade, position)
+                    for position, (key, grade) in enumerate(grades.items())
+                ],
+            )
+        return str(new_version)
+
+    def apply_changes(self, report_type, report_name, student_name, changes):
+        # 変更された問題の行だけを書き換える
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            version = self._version(conn, report_type, report_name, student_name)
+            new_version = 1 if version is None else version + 1
+            conn.execute(
+                "INSERT INTO grade_sheets (report_type, report, student, version) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (report_type, report, student) DO UPDATE SET version = excluded.version",
+                (report_type, report_name, student_name, new_version),
+            )
+            position = conn.execute(
+                "SELECT COALESCE(MAX(position), -1) + 1 FROM grades WHERE report_type = ? AND report = ? AND student = ?",
+                (report_type, report_name, student_name),
+            ).fetchone()[0]
+            for key, grade in changes.items():
+                if grade is None:
+                    conn.execute(
+                        "DELETE FROM grades WHERE report_type = ? AND report = ? AND student = ? AND key = ?",
+                        (report_type, report_name, student_name, key),
+                    )
+                    continue
+                conn.execute(
+                    "INSERT INTO grades (report_type, report, student, key, problem, grade, position) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (report_type, report, student, key) DO UPDATE SET grade = excluded.grade",
+                    (report_type, report_name, student_name, key, key.replace("grade_", ""), grade, position),
+                )
+                position += 1
+            grades = self.load(report_type, report_name, student_name)
+        return grades, str(new_version)
+
+    def reports(self, report_type):
+        rows = self._connect().execute(
+            "SELECT DISTINCT report FROM grade_sheets WHERE report_type = ? ORDER BY report", (report_type,)
+        )
+        return [report for report, in rows]
+
+    def report_grades(self, report_type, report_name):
+        conn = self._connect()
+        grades = {
+            student: {} for student, in conn.execute(
+                "SELECT student FROM grade_sheets WHERE report_type = ? AND report = ? ORDER BY student",
+                (report_type, report_name),
+            )
+        }
+        rows = conn.execute(
+            "SELECT student, key, grade FROM grades WHERE report_type = ? AND report = ? ORDER BY student, position",
+            (report_type, report_name),
+        )
+        for student, key, grade in rows:
+            grades.setdefault(student, {})[key] = grade
+        return grades
+
+    def finished(self, report_type, report_name, student_names, problems):
+        order = problems['order']
+        if len(order) == 0:
+            return [True for _ in student_names]
+        keys = [f"grade_{problem_id}" for problem_id in order]
+        rows = self._connect().execute(
+            f"SELECT student FROM grades WHERE report_type = ? AND report = ? AND key IN ({','.join('?' * len(keys))}) "
+            "GROUP BY student HAVING COUNT(*) = ?",
+            (report_type, report_name, *keys, len(set(keys))),
+        )
+        finished_students = {student for student, in rows}
+        return [student_name in finished_students for student_name in student_names]
+
+    def point(self, report_type, report_name, student_name, problems):
+        order = problems['order']
+        points = problems.get('points', {})
+        total_point = 0
+        for problem_id in order:
+            total_point += points.get(problem_id, 0)
+        if len(order) == 0:
+            return 0, total_point
+        values = ",".join("(?, ?)" for _ in order)
+        params = [v for problem_id in order for v in (f"grade_{problem_id}", points.get(problem_id, 0))]
+        row = self._connect().execute(
+            f"WITH p (key, point) AS (VALUES {values}) "
+            "SELECT SUM(CASE g.grade WHEN 'circle' THEN p.point WHEN 'triangle' THEN p.point / 2.0 ELSE 0 END) "
+            "FROM grades g JOIN p ON g.key = p.key "
+            "WHERE g.report_type = ? AND g.report = ? AND g.student = ?",
+            (*params, report_type, report_name, student_name),
+        ).fetchone()
+        return row[0] or 0, total_point
+
+    def summary(self, report_type, report_name, student_names):
+        summary = {"total": {}, "correct": {}}
+        if len(student_names) == 0:
+            return summary
+        # 名簿は一時テーブルに入れて結合する（IN句の変数の数の上限を避けるため）
+        conn = self._connect()
+        with conn:
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS roster (student TEXT PRIMARY KEY)")
+            conn.execute("DELETE FROM roster")
+            conn.executemany("INSERT OR IGNORE INTO roster (student) VALUES (?)", [(s,) for s in student_names])
+            rows = conn.execute(
+                "SELECT g.problem, "
+                "COALESCE(SUM(g.grade IN ('circle', 'triangle', 'cross')), 0), COALESCE(SUM(g.grade = 'circle'), 0) "
+                "FROM grades g JOIN roster r ON g.student = r.student "
+                "WHERE g.report_type = ? AND g.report = ? GROUP BY g.problem",
+                (report_type, report_name),
+            ).fetchall()
+        for problem_id, total, correct in rows:
+            summary["total"][problem_id] = total
+            summary["correct"][problem_id] = correct
+        return summary
+
+
+def create_grade_store(app):
+    """設定 (GRADE_STORE) に応じて採点結果の保存先を作成し、app.config に登録する"""
+    backend = app.config.get('GRADE_STORE', 'json')
+    if backend == 'json':
+        store = JsonGradeStore(app)
+    elif backend == 'sqlite':
+        store = SqliteGradeStore(app.config['GRADE_DB_PATH'])
+    else:
+        raise ValueError(f"GRADE_STORE には 'json' か 'sqlite' を指定してください: {backend}")
+    app.config['GRADE_STORE_INSTANCE'] = store
+    return store
+
+
+def get_grade_store(app):
+    store = app.config.get('GRADE_STORE_INSTANCE')
+    if store is None:
+        store = create_grade_store(app)
+    return store
+
+
+class ClientSequences:
+    """
+    差分の自動保存で、ビューアのタブ (client) ごとに最後に反映した変更の通し番号を覚えておく。
+    通信エラーで送り直された変更や、遅れて届いた古い変更を反映しないために使う。
+    覚えておくのは最近の maxsize 件だけ（プロセスごと）。
+    複数のワーカープロセスで動かすときは、代わりに SharedClientSequences を使う。
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._seqs = OrderedDict()  # (client, 種類, レポート名, 学生名) -> 通し番号
+
+    def claim(self, client, report_type, report_name, student_name, seq):
+        """
+        seq の変更をまだ反映していなければ、反映することを記録して (True, 前の通し番号) を返す。
+        反映済み（それより新しい変更を反映済み）なら (False, 前の通し番号) を返す。
+        確認と記録を1つのロックの中で行うので、同じ変更が同時に送り直されても反映するのは1回だけになる。
+        """
+        key = (client, report_type, report_name, student_name)
+        with self._lock:
+            previous = self._seqs.get(key)
+            if previous is not None and seq <= previous:
+                return False, previous
+            self._seqs[key] = seq
+            self._seqs.move_to_end(key)
+            while len(self._seqs) > self.maxsize:
+                self._seqs.popitem(last=False)
+            return True, previous
+
+    def release(self, client, report_type, report_name, student_name, seq, previous):
+        """claim した seq の変更を反映できなかったので、記録を前の通し番号に戻す（その後に新しい seq を claim していればそのまま）"""
+        key = (client, report_type, report_name, student_name)
+        with self._lock:
+            if self._seqs.get(key) != seq:
+                return
+            if previous is None:
+                del self._seqs[key]
+            else:
+                self._seqs[key] = previous
+
+
+class SharedClientSequences:
+    """
+    ClientSequences と同じことを、SharedState の表 (client_seqs) で行う。
+    再送された変更が前回と別のワーカープロセスに届いても、反映済みだとわかる。
+    """
+
+    def __init__(self, shared):
+        self.shared = shared
+
+    def claim(self, client, report_type, report_name, student_name, seq):
+        return self.shared.claim_client_seq(client, report_type, report_name, student_name, seq)
+
+    def release(self, client, report_type, report_name, student_name, seq, previous):
+        self.shared.release_client_seq(client, report_type, report_name, student_name, seq, previous)
+
+
+def get_client_sequences(app):
+    sequences = app.config.get('CLIENT_SEQUENCES')
+    if sequences is None:
+        shared = app.config.get('SHARED_STATE')
+        sequences = SharedClientSequences(shared) if shared is not None else ClientSequences()
+        app.config['CLIENT_SEQUENCES'] = sequences
+    return sequences
+
+
+def copy_grades(src, dst):
+    """src の採点結果を全て dst に書き込み、書き込んだ学生数を返す"""
+    count = 0
+    for report_type in REPORT_TYPES:
+        for report_name in src.reports(report_type):
+            for student_name, grades in src.report_grades(report_type, report_name).items():
+                dst.save(report_type, report_name, student_name, grades)
+                count += 1
+    return count
+
+
+def register_commands(app):
+    """採点結果の移行用のコマンド (flask --app run import-grades / export-grades) を登録する"""
+
+    @app.cli.command("import-grades")
+    @click.option("--db", default=None, help="書き込み先のSQLiteファイル（省略時は GRADE_DB_PATH）")
+    def import_grades(db):
+        """JSONファイルの採点結果をSQLiteに取り込む"""
+        count = copy_grades(JsonGradeStore(app), SqliteGradeStore(db or app.config['GRADE_DB_PATH']))
+        click.echo(f"{count}人分の採点結果を取り込みました。")
+
+    @app.cli.command("export-grades")
+    @click.option("--db", default=None, help="読み込むSQLiteファイル（省略時は GRADE_DB_PATH）")
+    def export_grades(db):
+        """SQLiteの採点結果を、JSONファイル ({種類}_SAVE_DIR/<レポート名>/<学生名>.json) に書き出す"""
+        count = copy_grades(SqliteGradeStore(db or app.config['GRADE_DB_PATH']), JsonGradeStore(app))
+        click.echo(f"{count}人分の採点結果を書き出しました。")
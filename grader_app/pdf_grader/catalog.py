@@ -0,0 +1,211 @@
+import os
+import time
+import threading
+
+from grader_app.archive import list_zip_folders
+
+# 提出フォルダ名に含まれる提出物の種類
+SUBMISSION_KINDS = ["詳細", "解答のみ"]
+
+
+def get_report_name(raw):
+    """提出フォルダ名（例: 第1回レポート-xxxの提出(詳細)）からレポート名を取り出す"""
+    return raw.split("の提出")[0]
+
+
+def get_kind_name(raw):
+    for kind_name in SUBMISSION_KINDS:
+        if kind_name in raw:
+            return kind_name
+    return None
+
+
+class SubmissionCatalog:
+    """
+    PDF_BASE_DIR 以下の提出物の索引。
+    (レポート名, 種類, 学生名) から提出フォルダとPDFのパスを辞書で引けるようにしておき、
+    フォルダの更新時刻 (mtime) が変わったフォルダだけを読み直す。
+    学生名は get_students が返すもの（フォルダ名の "_" より前）を使う。
+    """
+
+    def __init__(self, base_dir, check_interval=2.0):
+        self.base_dir = base_dir
+        self.check_interval = check_interval
+        self._lock = threading.RLock()
+        self._folders = {}   # raw -> {"mtime", "report", "kind", "authors", "students"}
+        self._reports = {}   # report -> [raw, ...]
+        self._students = {}  # report -> ソート済みの学生名のリスト
+        self._base_mtime = None
+        self._base_files = []
+        self._last_check = 0.0
+
+    def update(self, raw_folders):
+        """提出フォルダの一覧を差し替える。新しいフォルダと更新されたフォルダだけを読み込む"""
+        with self._lock:
+            for raw in list(self._folders):
+                if raw not in raw_folders:
+                    self._remove_folder(raw)
+            for raw in raw_folders:
+                self._scan_folder(raw)
+            self._scan_base()
+            self._last_check = time.monotonic()
+
+    def refresh(self, force=False):
+        """前回の確認から check_interval 秒以上経っていれば、更新時刻を見て変更を取り込む"""
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._last_check < self.check_interval:
+                return
+            for raw in list(self._folders):
+                self._scan_folder(raw)
+            self._scan_base()
+            self._last_check = now
+
+    def students(self, report):
+        """レポートに提出した学生名のソート済みリスト"""
+        with self._lock:
+            self.refresh()
+            students = self._students.get(report)
+            if students is None:
+                names = set()
+                for raw in self._reports.get(report, []):
+                    names.update(self._folders[raw]["students"])
+                students = sorted(names)
+                self._students[report] = students
+            return students
+
+    def report_mtime(self, report):
+        """レポートの提出フォルダの更新時刻の組（名簿が変わったかどうかの判定用）"""
+        with self._lock:
+            self.refresh()
+            return tuple((raw, self._folders[raw]["mtime"]) for raw in self._reports.get(report, []))
+
+    def report_signature(self, report):
+        """レポートの提出フォルダと学生のフォルダの更新時刻の組（提出物が変わったかどうかの判定用）"""
+        with self._lock:
+            self.refresh()
+            return tuple(
+                (raw, self._folders[raw]["mtime"], tuple((a, e["mtime"]) for a, e in sorted(self._folders[raw]["authors"].items())))
+                for raw in self._reports.get(report, [])
+            )
+
+    def find(self, report, kind_name, student_name):
+        """(提出フォルダ名, 学生のフォルダ名) を返す。提出されていなければ (None, None)"""
+        with self._lock:
+            self.refresh()
+            raws = [raw for raw in self._reports.get(report, []) if self._folders[raw]["kind"] == kind_name]
+            if len(raws) > 1:
+                raise Exception(f"警告: {student_name} の {kind_name} に該当するディレクトリが複数見つかりました。")
+            if len(raws) == 0:
+                return None, None
+            authors = self._folders[raws[0]]["students"].get(student_name, [])
+            if len(authors) > 1:
+                raise Exception(f"警告: {student_name} の提出物が複数見つかりました。")
+            if len(authors) == 0:
+                return None, None
+            return raws[0], authors[0]
+
+    def has_kind(self, report, kind_name):
+        with self._lock:
+            return any(self._folders[raw]["kind"] == kind_name for raw in self._reports.get(report, []))
+
+    def pdf_names(self, raw, author):
+        """学生のフォルダにあるファイル名のソート済みリスト"""
+        with self._lock:
+            self.refresh()
+            folder = self._folders.get(raw)
+            if folder is None or author not in folder["authors"]:
+                return []
+            return list(folder["authors"][author]["pdfs"])
+
+    def pdf_paths(self, raw, author):
+        return [os.path.join(self.base_dir, raw, author, pdf) for pdf in self.pdf_names(raw, author)]
+
+    def base_files(self, suffix=""):
+        """PDF_BASE_DIR 直下のファイル名のうち、suffix で終わるもの"""
+        with self._lock:
+            self.refresh()
+            return [f for f in self._base_files if f.endswith(suffix)]
+
+    def _scan_base(self):
+        try:
+            mtime = os.stat(self.base_dir).st_mtime_ns
+        except FileNotFoundError:
+            self._base_files = []
+            return
+        if mtime != self._base_mtime:
+            self._base_files = sorted(e.name for e in os.scandir(self.base_dir) if e.is_file())
+            self._base_mtime = mtime
+
+    def _remove_folder(self, raw):
+        folder = self._folders.pop(raw)
+        raws = self._reports.get(folder["report"], [])
+        if raw in raws:
+            raws.remove(raw)
+        self._students.pop(folder["report"], None)
+
+    def _scan_folder(self, raw):
+        path = os.path.join(self.base_dir, raw)
+        zip_path = None
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            # 展開せずに使う場合は、同じ名前のzipの中身を読む (UNZIP_MODE = "direct")
+            zip_path = path + ".zip"
+            try:
+                mtime = os.stat(zip_path).st_mtime_ns
+            except FileNotFoundError:
+                if raw in self._folders:
+                    self._remove_folder(raw)
+                return
+
+        folder = self._folders.get(raw)
+        if folder is None:
+            folder = {
+                "mtime": None,
+                "report": get_report_name(raw),
+                "kind": get_kind_name(raw),
+                "authors": {},
+                "students": {},
+            }
+            self._folders[raw] = folder
+            self._reports.setdefault(folder["report"], []).append(raw)
+
+        if folder["mtime"] != mtime:
+            authors = {}
+            if zip_path is not None:
+                for author, names in list_zip_folders(zip_path).items():
+                    authors[author] = {"mtime": mtime, "pdfs": names}
+            else:
+                for entry in os.scandir(path):
+                    if entry.is_dir():
+                        authors[entry.name] = folder["authors"].get(entry.name, {"mtime": None, "pdfs": []})
+            students = {}
+            for author in sorted(authors):
+                students.setdefault(author.split("_")[0], []).append(author)
+            folder["authors"] = authors
+            folder["students"] = students
+            folder["mtime"] = mtime
+            self._students.pop(folder["report"], None)
+
+        if zip_path is not None:
+            return
+        # 学生のフォルダの中身（PDF）の追加・差し替えは、学生のフォルダの更新時刻でわかる
+        for author, entry in folder["authors"].items():
+            author_path = os.path.join(path, author)
+            try:
+                author_mtime = os.stat(author_path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            if entry["mtime"] != author_mtime:
+                entry["pdfs"] = sorted(os.listdir(author_path))
+                entry["mtime"] = author_mtime
+
+
+def get_catalog(app):
+    """app.config の SubmissionCatalog を返す（無ければ作る）"""
+    catalog = app.config.get('SUBMISSION_CATALOG')
+    if catalog is None:
+        catalog = SubmissionCatalog(app.config['PDF_BASE_DIR'], app.config.get('CATALOG_CHECK_INTERVAL', 2.0))
+        app.config['SUBMISSION_CATALOG'] = catalog
+    return catalog
@@ -0,0 +1,73 @@
+import os
+import json
+import threading
+
+from grader_app.archive import file_stat
+from grader_app.models import write_file_atomic
+from grader_app.pdf_grader.render import file_sha1
+
+HASH_INDEX_VERSION = 1
+
+
+class ContentHashIndex:
+    """
+    提出されたファイルの内容のハッシュの索引。
+    パスごとに (サイズ, 更新時刻) と「サイズ-SHA-1」を覚えておき、ファイルが変わっていなければ読み直さない。
+    索引は JSON ファイルに保存するので、再起動後もファイルを読み直す必要がない。
+    パスは base_dir からの相対パスで保存する。
+    """
+
+    def __init__(self, index_path, base_dir):
+        self.index_path = index_path
+        self.base_dir = base_dir
+        self._lock = threading.Lock()
+        self._entries = self._load()  # 相対パス -> [サイズ, 更新時刻, ハッシュ]
+        self._dirty = False
+
+    def digest(self, path):
+        """ファイルの内容のハッシュ（「サイズ-SHA-1」の文字列）を返す（展開していないzipの中のファイルにも使える）"""
+        st = file_stat(path)
+        key = os.path.relpath(path, self.base_dir)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+                return entry[2]
+        digest = f"{st.st_size}-{file_sha1(path)}"
+        with self._lock:
+            self._entries[key] = [st.st_size, st.st_mtime_ns, digest]
+            self._dirty = True
+        return digest
+
+    def same(self, path_a, path_b):
+        """2つのファイルの内容が同じかどうか"""
+        return self.digest(path_a) == self.digest(path_b)
+
+    def save(self):
+        """変更があれば索引をファイルに書き出す"""
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {"version": HASH_INDEX_VERSION, "files": self._entries}
+            # 書きかけの索引を読まれないよう、一時ファイルに書いてから置き換える
+            # （一時ファイルの名前は毎回変えるので、複数のプロセスが同時に保存しても混ざらない）
+            write_file_atomic(self.index_path, json.dumps(data, ensure_ascii=False).encode('utf-8'))
+            self._dirty = False
+
+    def _load(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+        if data.get("version") != HASH_INDEX_VERSION:
+            return {}
+        return data.get("files", {})
+
+
+def get_content_hash_index(app):
+    """app.config の ContentHashIndex を返す（無ければ作る）"""
+    index = app.config.get('CONTENT_HASH_INDEX')
+    if index is None:
+        index = ContentHashIndex(app.config['CONTENT_HASH_INDEX_PATH'], app.config['PDF_BASE_DIR'])
+        app.config['CONTENT_HASH_INDEX'] = index
+    return index
@@ -0,0 +1,251 @@
+import os
+import fnmatch
+import threading
+
+from grader_app.scoring_core import (
+    build_fact_table, compute_submissions, build_views, add_averages, build_view_records, grade_scores, patch_scores,
+    count_absences, DEFAULT_SETTINGS, RATIO_SETTINGS, THRESHOLD_SETTINGS,
+)
+from grader_app.pdf_grader.catalog import get_catalog
+from grader_app.pdf_grader.hashes import get_content_hash_index
+
+
+def file_signature(path):
+    """ファイルが変わったかどうかの判定に使う (更新時刻, サイズ)。無ければ None"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+class ReportOverview:
+    """
+    レポート一覧 (report_scores/, download_report_xlsx/) の計算結果のキャッシュ。
+    計算を次の段階に分け、段階ごとに入力の鍵（ファイルの更新時刻や設定の値）を覚えておき、
+    鍵が変わった段階とその後の段階だけをやり直す。
+      1. レポートごとの提出物の情報と、同じ内容の提出物: 提出フォルダ・締切のJSON
+      2. レポートごとの得点: *_problems.json
+         （保存された採点結果は grade_changed で学生ごとに無効化し、その学生の行と、表のその学生の得点だけを計算し直す。
+          採点結果のファイルを直接編集した場合は、reload_reports で clear を呼ぶ）
+      3. 倍率の適用と表の作成: 1, 2 と倍率の設定・名簿 (seiseki)
+      4. 評価と欠席回数: 3 と評価の閾値・出席の記録
+    評価の閾値だけを変えた場合は 4 だけをやり直す。
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._report_list = None
+            self._reports = {}        # report -> {"key", "rows", "identical", "scores_key", "scores", "dirty"}
+            self._roster_key = False
+            self._roster = None
+            self._attendance_key = False
+            self._absences = None
+            self._submissions_key = None
+            self._submissions = None
+            self._submissions_version = 0
+            self._positions = {}      # (report_index, student_index) -> self._submissions の行番号
+            self._views_key = None
+            self._views = None
+            self._context_key = None
+            self._context = None
+
+    def grade_changed(self, report_name, student_name):
+        """学生の採点結果が保存されたときに呼ぶ"""
+        with self._lock:
+            entry = self._reports.get(report_name)
+            if entry is not None:
+                entry["dirty"].add(student_name)
+
+    def problems_changed(self, report_name):
+        """問題の設定（配点）が保存されたときに呼ぶ（レポートの全員の得点を計算し直す）"""
+        with self._lock:
+            entry = self._reports.get(report_name)
+            if entry is not None:
+                entry["scores_key"] = False
+
+    def context(self, app, mode='scores'):
+        """report_overview.html に渡す context を返す。名簿が見つからなければ None"""
+        with self._lock:
+            settings = {key: app.config.get(key, default) for key, default in DEFAULT_SETTINGS.items()}
+
+            self._sync_roster(app)
+            if self._roster is None:
+                return None
+            changed = self._sync_reports(app, list(app.config['PDF_LIST']))
+            # 削除されたレポート (None) は列にしない。ビューアへのリンクには PDF_LIST の番号を使う
+            report_indices = [i for i, report_name in enumerate(self._report_list) if report_name is not None]
+            report_list = [self._report_list[i] for i in report_indices]
+
+            ratio_key = tuple(settings[key] for key in RATIO_SETTINGS)
+            patched = []
+            if changed or self._submissions_key != ratio_key:
+                self._build_submissions(settings)
+                self._submissions_key = ratio_key
+                self._views_key = None
+            else:
+                patched = self._patch_submissions(settings)
+
+            views_key = (self._submissions_version, self._roster_key)
+            if self._views_key != views_key:
+                enrolled, unlisted = build_views(self._roster, self._submissions, report_list)
+                add_averages(enrolled, report_list)
+                add_averages(unlisted, report_list)
+                self._views = (enrolled, unlisted, build_view_records(enrolled, unlisted))
+                self._views_key = views_key
+                self._context_key = None
+            elif patched:
+                # 得点が変わった学生のセルだけを書き換える（提出状況・遅延・学生番号の表は変わらない）
+                for views in self._views[:2]:
+                    patch_scores(views, self._submissions, patched, report_list)
+                self._context_key = None
+
+            self._sync_attendance(app)
+            context_key = (views_key, self._attendance_key, tuple(settings[key] for key in THRESHOLD_SETTINGS), mode)
+            if self._context_key != context_key:
+                enrolled, unlisted, records = self._views
+                context = grade_scores(enrolled["score"], unlisted["score"], self._absences, settings)
+                context.update(records)
+                context["report_list"] = report_list
+                context["report_indices"] = report_indices
+                context["identical"] = [
+                    {"report": report_name, "report_index": i, "students": group}
+                    for i, report_name in zip(report_indices, report_list)
+                    for group in self._reports[report_name]["identical"]
+                ]
+                context["mode"] = mode
+                self._context = context
+                self._context_key = context_key
+            return self._context
+
+    def _base_files(self, app, pattern):
+        catalog = get_catalog(app)
+        base_dir = app.config['PDF_BASE_DIR']
+        return tuple(
+            (f, file_signature(os.path.join(base_dir, f)))
+            for f in catalog.base_files() if fnmatch.fnmatch(f, pattern)
+        )
+
+    def _sync_roster(self, app):
+        """名簿 (seiseki) が変わっていれば読み直す"""
+        from grader_app.utils import get_enrolled_students
+        key = self._base_files(app, "*seiseki*.xls*")
+        if key == self._roster_key:
+            return
+        self._roster = get_enrolled_students('pdf')
+        self._roster_key = key
+
+    def _sync_attendance(self, app):
+        from grader_app.utils import get_attendance
+        key = (self._base_files(app, "*出席*.xls*"), self._roster_key)
+        if key == self._attendance_key:
+            return
+        attendance = get_attendance('pdf')
+        self._absences = (count_absences(attendance['enrolled']), count_absences(attendance['unlisted']))
+        self._attendance_key = key
+
+    def _sync_reports(self, app, report_list):
+        """
+        レポートごとの提出物の情報と得点を、変わったものだけ読み直す。
+        提出物の情報か、レポートの全員の得点が変わったら True を返す
+        （学生ごとの得点の変更は dirty に残しておき、_patch_submissions で反映する）。
+        """
+        from grader_app.pdf_grader.utils import collect_report_facts, find_deadline_files, find_identical_submissions, get_scores
+
+        if report_list != self._report_list:
+            # レポート番号が変わるので、全て読み直す
+            self._reports = {}
+            self._report_list = report_list
+        catalog = get_catalog(app)
+        base_dir = app.config['PDF_BASE_DIR']
+        save_dir = app.config['PDF_SAVE_DIR']
+
+        changed = False
+        for i, report_name in enumerate(report_list):
+            if report_name is None:
+                continue  # 削除されたレポート
+            deadline_files = sorted((f, file_signature(os.path.join(base_dir, f))) for f in find_deadline_files(report_name).values() if f is not None)
+            key = (catalog.report_signature(report_name), tuple(deadline_files))
+            entry = self._reports.get(report_name)
+            if entry is None or entry["key"] != key:
+                entry = {
+                    "key": key,
+                    "rows": collect_report_facts(i, report_name),
+                    "identical": find_identical_submissions(i),
+                    "scores_key": False,
+                    "scores": {},
+                    "dirty": set(),
+                }
+                self._reports[report_name] = entry
+                changed = True
+
+            scores_key = file_signature(os.path.join(save_dir, f"{report_name}_problems.json"))
+            if entry["scores_key"] != scores_key:
+                entry["scores"] = get_scores(i)
+                entry["scores_key"] = scores_key
+                entry["dirty"].clear()
+                changed = True
+        # 新しく計算したPDFのハッシュを保存しておく
+        get_content_hash_index(app).save()
+        return changed
+
+    def _fact_rows(self, entry, student_names=None):
+        rows = []
+        for row in entry["rows"]:
+            if student_names is None or row["student"] in student_names:
+                rows.append(dict(row, base_score=entry["scores"].get(row["student"], 0)))
+        return rows
+
+    def _build_submissions(self, settings):
+        rows = []
+        for report_name in self._report_list:
+            if report_name is None:
+                continue
+            rows.extend(self._fact_rows(self._reports[report_name]))
+        self._submissions = compute_submissions(build_fact_table(rows), settings)
+        self._submissions_version += 1
+        self._positions = {
+            key: pos for pos, key in enumerate(zip(self._submissions["report_index"], self._submissions["student_index"]))
+        }
+
+    def _patch_submissions(self, settings):
+        """採点結果が保存された学生の行だけ、得点を計算し直し、得点が変わった行の番号のリストを返す"""
+        from grader_app.pdf_grader.utils import get_student_score
+        value_column = self._submissions.columns.get_loc("value")
+        patched = []
+        for report_name in self._report_list:
+            if report_name is None:
+                continue
+            entry = self._reports[report_name]
+            if not entry["dirty"]:
+                continue
+            students = set()
+            for student_name in entry["dirty"]:
+                if student_name not in entry["scores"]:
+                    continue
+                score = get_student_score(report_name, student_name)
+                if score != entry["scores"][student_name]:
+                    entry["scores"][student_name] = score
+                    students.add(student_name)
+            entry["dirty"].clear()
+            if not students:
+                continue
+            patch = compute_submissions(build_fact_table(self._fact_rows(entry, students)), settings)
+            for report_index, student_index, value in zip(patch["report_index"], patch["student_index"], patch["value"]):
+                pos = self._positions[(report_index, student_index)]
+                self._submissions.iat[pos, value_column] = value
+                patched.append(pos)
+        return patched
+
+
+def get_report_overview(app):
+    """app.config の ReportOverview を返す（無ければ作る）"""
+    overview = app.config.get('REPORT_OVERVIEW')
+    if overview is None:
+        overview = ReportOverview()
+        app.config['REPORT_OVERVIEW'] = overview
+    return overview
@@ -0,0 +1,190 @@
+import os
+import threading
+
+from grader_app.pdf_grader.render import get_manifest_path, load_manifest
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """
+    ハミング距離の BK 木。距離が radius 以内のハッシュを、全てと比べずに探せる
+    （三角不等式から、距離の範囲に入らない子の枝は調べない）。
+    ノードは [ハッシュ, {距離: 子のノード}, [要素, ...]]。要素を削除してもノードは残す（枝の道しるべになる）。
+    """
+
+    def __init__(self):
+        self._root = None
+
+    def add(self, h, item):
+        if self._root is None:
+            self._root = [h, {}, [item]]
+            return
+        node = self._root
+        while True:
+            d = hamming(h, node[0])
+            if d == 0:
+                node[2].append(item)
+                return
+            child = node[1].get(d)
+            if child is None:
+                node[1][d] = [h, {}, [item]]
+                return
+            node = child
+
+    def remove(self, h, item):
+        node = self._root
+        while node is not None:
+            d = hamming(h, node[0])
+            if d == 0:
+                if item in node[2]:
+                    node[2].remove(item)
+                return
+            node = node[1].get(d)
+
+    def search(self, h, radius):
+        """距離が radius 以内の [(距離, 要素), ...]"""
+        results = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            d = hamming(h, node[0])
+            if d <= radius:
+                results.extend((d, item) for item in node[2])
+            for distance, child in node[1].items():
+                if d - radius <= distance <= d + radius:
+                    stack.append(child)
+        return results
+
+
+class PageHashIndex:
+    """
+    レポートごとに、提出物のページ画像の知覚ハッシュ（pHash をキーにした BKTree）を持つ索引。
+    ハッシュは画像を作るときにマニフェストに記録されている (render.page_hashes) ので、
+    マニフェストの更新時刻が変わった提出物の分だけ読み直して、木に加える・取り除く。
+    """
+
+    def __init__(self, image_dir, max_distance=8, max_share=0.5):
+        self.image_dir = image_dir
+        self.max_distance = max_distance
+        self.max_share = max_share
+        self._lock = threading.Lock()
+        self._reports = {}  # レポート名 -> {"tree", "submissions": {savedir: (更新時刻, 学生番号, [ページ])}, "version", "pairs"}
+
+    def update(self, report, submissions):
+        """
+        submissions ([(学生番号, 学生名, 種類, savedir), ...]) のマニフェストから、変わった分だけ読み直す。
+        画像をまだ作っていない提出物の数を返す。
+        """
+        with self._lock:
+            state = self._reports.setdefault(report, {"tree": BKTree(), "submissions": {}, "version": 0, "pairs": None})
+            tree = state["tree"]
+            seen = set()
+            missing = 0
+            for student_index, student, kind, savedir in submissions:
+                seen.add(savedir)
+                manifest_path = get_manifest_path(os.path.join(self.image_dir, savedir), os.path.basename(savedir))
+                try:
+                    mtime = os.stat(manifest_path).st_mtime_ns
+                except FileNotFoundError:
+                    mtime = None
+                    missing += 1
+                old = state["submissions"].get(savedir)
+                # 学生が増えて学生番号がずれた場合も読み直す
+                if old is not None and old[:2] == (mtime, student_index):
+                    continue
+                if old is not None:
+                    for page in old[2]:
+                        tree.remove(page["phash"], page)
+                pages = self._read_pages(manifest_path, student_index, student, kind, savedir) if mtime is not None else []
+                for page in pages:
+                    tree.add(page["phash"], page)
+                state["submissions"][savedir] = (mtime, student_index, pages)
+                state["version"] += 1
+            for savedir in set(state["submissions"]) - seen:
+                for page in state["submissions"].pop(savedir)[2]:
+                    tree.remove(page["phash"], page)
+                state["version"] += 1
+            return missing
+
+    def suspicious_pairs(self, report, submissions):
+        """
+        別の学生のページで、pHash と dHash のハミング距離がどちらも max_distance 以内のものを、学生の組ごとにまとめて返す。
+        max_share より多くの割合の学生に似たページがあるページ（配布した問題用紙など）は数えない。
+        戻り値: ([{"a", "b", "pages": [{"a", "b", "distance"}, ...]}, ...], 画像をまだ作っていない提出物の数)
+        似ているページが多い組から順に並べる。
+        """
+        missing = self.update(report, submissions)
+        with self._lock:
+            state = self._reports[report]
+            if state["pairs"] is not None and state["pairs"][0] == state["version"]:
+                return state["pairs"][1], missing
+            students = {student_index for student_index, _, _, _ in submissions}
+            max_students = max(2, int(len(students) * self.max_share))
+            pairs = {}
+            for _, _, pages in state["submissions"].values():
+                for page in pages:
+                    matches = []
+                    for d, other in state["tree"].search(page["phash"], self.max_distance):
+                        d = max(d, hamming(page["dhash"], other["dhash"]))
+                        if d <= self.max_distance:
+                            matches.append((d, other))
+                    if len({other["student_index"] for _, other in matches}) > max_students:
+                        continue
+                    for distance, other in matches:
+                        # 組は学生番号の小さい方を a にして、1回だけ数える
+                        if other["student_index"] <= page["student_index"]:
+                            continue
+                        pair = pairs.setdefault((page["student_index"], other["student_index"]), {
+                            "a": {"student": page["student"], "student_index": page["student_index"]},
+                            "b": {"student": other["student"], "student_index": other["student_index"]},
+                            "pages": [],
+                        })
+                        pair["pages"].append({"a": page, "b": other, "distance": distance})
+            result = sorted(
+                pairs.values(),
+                key=lambda p: (-len(p["pages"]), min(m["distance"] for m in p["pages"]), p["a"]["student_index"], p["b"]["student_index"]),
+            )
+            for pair in result:
+                pair["pages"].sort(key=lambda m: (m["distance"], m["a"]["page"]))
+            state["pairs"] = (state["version"], result)
+            return result, missing
+
+    def _read_pages(self, manifest_path, student_index, student, kind, savedir):
+        manifest = load_manifest(manifest_path)
+        if manifest is None:
+            return []
+        pages = []
+        number = 0
+        for entry in manifest["pdfs"].values():
+            hashes = entry.get("hashes", [])
+            for filename, hashed in zip(entry["images"], hashes + [None] * (len(entry["images"]) - len(hashes))):
+                number += 1
+                if hashed is None:
+                    continue  # 白紙のページ・ハッシュを記録する前の画像
+                pages.append({
+                    "phash": int(hashed["phash"], 16),
+                    "dhash": int(hashed["dhash"], 16),
+                    "student_index": student_index,
+                    "student": student,
+                    "kind": kind,
+                    "savedir": savedir,
+                    "image": filename,
+                    "page": number,
+                })
+        return pages
+
+
+def get_page_hash_index(app):
+    """app.config の PageHashIndex を返す（無ければ作る）"""
+    index = app.config.get('PAGE_HASH_INDEX')
+    if index is None:
+        index = PageHashIndex(
+            app.config['IMAGE_DIR'],
+            app.config.get('PAGE_HASH_DISTANCE', 8),
+            app.config.get('PAGE_HASH_MAX_SHARE', 0.5),
+        )
+        app.config['PAGE_HASH_INDEX'] = index
+    return index
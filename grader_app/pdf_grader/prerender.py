@@ -0,0 +1,237 @@
+import os
+import heapq
+import itertools
+import threading
+import atexit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from grader_app.pdf_grader.render import prerender_images, get_render_settings
+from grader_app.pdf_grader.catalog import get_catalog, get_report_name, get_kind_name
+
+
+class Prerenderer:
+    """
+    PDFのページ画像をプロセスプールで事前生成するワーカー。
+    ジョブは優先度（学生番号, レポート番号）の小さい順に投入されるので、
+    採点者が次に開く学生の画像から順に準備される。
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        # Condition のデフォルトのロックは RLock なので、コールバックから再入しても問題ない
+        self._cond = threading.Condition()
+        self._heap = []
+        self._counter = itertools.count()
+        self._queued = {}    # key -> job
+        self._running = {}   # key -> Future
+        self._claimed = {}   # key -> report（リクエスト側で生成中のもの）
+        self._progress = {}  # report -> {"total", "done", "failed"}
+        self._executor = None
+        self._thread = None
+        self._closed = False
+
+    def schedule(self, key, pdf_path_list, save_full_dir, img_name, report, priority, rotate=0, settings=None):
+        """
+        ジョブを登録する。登録済みの場合は優先度が高い方に更新する。
+        rotate を指定すると、回転済みの画像も合わせて生成する。
+        settings は画像の生成設定 (get_render_settings の戻り値)。
+        """
+        with self._cond:
+            if key in self._running or key in self._claimed:
+                return
+            job = self._queued.get(key)
+            if job is None:
+                job = {
+                    "key": key,
+                    "pdf_path_list": pdf_path_list,
+                    "save_full_dir": save_full_dir,
+                    "img_name": img_name,
+                    "report": report,
+                    "priority": priority,
+                    "rotate": rotate,
+                    "settings": settings,
+                }
+                self._queued[key] = job
+                progress = self._progress.setdefault(report, {"total": 0, "done": 0, "failed": 0})
+                progress["total"] += 1
+            else:
+                if rotate != 0:
+                    job["rotate"] = rotate
+                if priority >= job["priority"]:
+                    return
+                job["priority"] = priority
+            heapq.heappush(self._heap, (priority, next(self._counter), key))
+            self._cond.notify_all()
+
+    def start(self):
+        """ディスパッチ用のスレッドを起動する（2回目以降は何もしない）"""
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="pdf-prerender", daemon=True)
+            self._thread.start()
+
+    def wait(self, key):
+        """
+        key の画像生成が終わるまで待ち、生成された画像のファイル名リストを返す。
+        キューで待っているジョブは割り込みで即座に投入する。
+        ジョブが存在しない場合は None を返す。
+        """
+        with self._cond:
+            job = self._queued.get(key)
+            if job is not None:
+                self._submit(job)
+            future = self._running.get(key)
+        if future is None:
+            return None
+        return future.result()
+
+    def claim(self, key):
+        """
+        key の画像をリクエスト側で（1ページずつ）生成するために、キューから取り除く。
+        別プロセスで生成中の場合はその Future を返すので、呼び出し側は完了を待つこと。
+        生成が終わったら release を呼ぶ。
+        """
+        with self._cond:
+            future = self._running.get(key)
+            if future is not None:
+                return future
+            job = self._queued.pop(key, None)
+            self._claimed[key] = job["report"] if job is not None else None
+            return None
+
+    def release(self, key):
+        with self._cond:
+            if key not in self._claimed:
+                return
+            report = self._claimed.pop(key)
+            if report is not None:
+                self._progress[report]["done"] += 1
+
+    def status(self):
+        with self._cond:
+            reports = {report: dict(progress) for report, progress in self._progress.items()}
+            return {
+                "enabled": True,
+                "workers": self.max_workers,
+                "queued": len(self._queued),
+                "running": len(self._running),
+                "done": sum(p["done"] for p in reports.values()),
+                "failed": sum(p["failed"] for p in reports.values()),
+                "total": sum(p["total"] for p in reports.values()),
+                "reports": reports,
+            }
+
+    def shutdown(self):
+        with self._cond:
+            self._closed = True
+            executor = self._executor
+            self._executor = None
+            self._cond.notify_all()
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and (not self._heap or len(self._running) >= self.max_workers):
+                    self._cond.wait()
+                if self._closed:
+                    return
+                priority, _, key = heapq.heappop(self._heap)
+                job = self._queued.get(key)
+                # 割り込みで投入済み、または優先度が更新された古いエントリは読み飛ばす
+                if job is None or job["priority"] != priority:
+                    continue
+                self._submit(job)
+
+    def _submit(self, job):
+        # self._cond を保持した状態で呼ぶこと
+        if self._closed:
+            return
+        if self._executor is None:
+            # spawn にしておくと、Flaskのスレッドを抱えたままforkすることがない
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        try:
+            future = self._executor.submit(
+                prerender_images, job["pdf_path_list"], job["save_full_dir"], job["img_name"], job["rotate"], job["settings"]
+            )
+        except RuntimeError:
+            # インタプリタの終了処理中はプールに投入できないので、以降の生成をやめる
+            self._closed = True
+            return
+        del self._queued[job["key"]]
+        self._running[job["key"]] = future
+        future.add_done_callback(lambda f: self._finish(job, f))
+
+    def _finish(self, job, future):
+        with self._cond:
+            self._running.pop(job["key"], None)
+            progress = self._progress[job["report"]]
+            if future.cancelled() or future.exception() is not None:
+                progress["failed"] += 1
+                if not future.cancelled():
+                    print(f"エラー: {job['key']} の画像の事前生成に失敗しました。エラー: {future.exception()}")
+            else:
+                progress["done"] += 1
+            self._cond.notify_all()
+
+
+def create_prerenderer(app):
+    """設定に応じて Prerenderer を作成し、app.config に登録する"""
+    if not app.config.get('PRERENDER_ENABLED', False):
+        app.config['PRERENDERER'] = None
+        return None
+    prerenderer = Prerenderer(app.config.get('PRERENDER_WORKERS', 1))
+    atexit.register(prerenderer.shutdown)
+    app.config['PRERENDERER'] = prerenderer
+    return prerenderer
+
+
+def schedule_report_folders(app, raw_folders):
+    """
+    新しく見つかった提出フォルダ（PDF_BASE_DIR直下）について、
+    学生ごとの画像生成ジョブを登録する
+    """
+    prerenderer = app.config.get('PRERENDERER')
+    if prerenderer is None:
+        return
+
+    catalog = get_catalog(app)
+    image_root = app.config['IMAGE_DIR']
+    report_list = app.config['PDF_LIST']
+    settings = get_render_settings(app.config)
+
+    for raw in raw_folders:
+        if get_kind_name(raw) is None:
+            continue
+        report = get_report_name(raw)
+        if report not in report_list:
+            continue
+        report_index = report_list.index(report)
+
+        # get_students と同じ並び順で学生番号を決める
+        student_order = {s: i for i, s in enumerate(catalog.students(report))}
+
+        for student_name in student_order:
+            try:
+                raw_dir, author = catalog.find(report, get_kind_name(raw), student_name)
+            except Exception as e:
+                print(e)
+                continue
+            if raw_dir != raw:
+                continue
+            savedir = raw + "/" + author
+            prerenderer.schedule(
+                savedir,
+                catalog.pdf_paths(raw, author),
+                os.path.join(image_root, savedir),
+                author,
+                report,
+                (student_order[student_name], report_index),
+                settings=settings,
+            )
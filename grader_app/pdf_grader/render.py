@@ -0,0 +1,435 @@
+import os
+import re
+import json
+import hashlib
+from grader_app.archive import file_stat, open_file, local_file
+
+
+# マニフェストの形式を変えたら上げる（古いマニフェストは作り直される）
+MANIFEST_VERSION = 1
+
+# 画像の保存形式ごとの拡張子
+IMAGE_EXTENSIONS = {"PNG": ".png", "JPEG": ".jpg", "WEBP": ".webp"}
+
+# 画像の生成設定の既定値（Config の IMAGE_FORMAT などに対応する）
+DEFAULT_RENDER_SETTINGS = {
+    "format": "PNG",
+    "quality": 85,
+    "dpi": 200,
+    "thumbnail_width": 0,
+}
+
+
+def get_render_settings(config):
+    """app.config から画像の生成設定を取り出す（プロセス間で受け渡せるように dict にする）"""
+    image_format = str(config.get('IMAGE_FORMAT', DEFAULT_RENDER_SETTINGS["format"])).upper()
+    if image_format not in IMAGE_EXTENSIONS:
+        raise ValueError(f"IMAGE_FORMAT には {', '.join(IMAGE_EXTENSIONS)} のいずれかを指定してください: {image_format}")
+    return {
+        "format": image_format,
+        "quality": int(config.get('IMAGE_QUALITY', DEFAULT_RENDER_SETTINGS["quality"])),
+        "dpi": int(config.get('IMAGE_DPI', DEFAULT_RENDER_SETTINGS["dpi"])),
+        "thumbnail_width": int(config.get('THUMBNAIL_WIDTH', DEFAULT_RENDER_SETTINGS["thumbnail_width"])),
+    }
+
+
+def settings_key(settings):
+    """生成設定の短いハッシュ。画像のファイル名に含めて、設定を変えたら別のURLになるようにする"""
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:6]
+
+
+def derived_name(filename, suffix):
+    """page0.webp -> page0{suffix}.webp"""
+    root, ext = os.path.splitext(filename)
+    return f"{root}{suffix}{ext}"
+
+
+def thumbnail_name(filename):
+    return derived_name(filename, "_thumb")
+
+
+def save_image(img, path, settings):
+    """設定された形式で画像を保存する"""
+    image_format = settings["format"]
+    if image_format == "PNG":
+        img.save(path, "PNG")
+        return
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    if image_format == "JPEG":
+        img.save(path, "JPEG", quality=settings["quality"], optimize=True)
+    else:
+        img.save(path, "WEBP", quality=settings["quality"], method=4)
+
+
+def save_page_image(img, save_full_dir, filename, settings):
+    """ページ画像（原寸）と、設定されていればサムネイルを保存する"""
+    save_image(img, os.path.join(save_full_dir, filename), settings)
+    if settings["thumbnail_width"] > 0:
+        from PIL import Image
+        thumb = img.copy()
+        # 横幅が thumbnail_width 以下の画像は拡大しない
+        thumb.thumbnail((settings["thumbnail_width"], img.height), Image.LANCZOS)
+        save_image(thumb, os.path.join(save_full_dir, thumbnail_name(filename)), settings)
+        thumb.close()
+
+
+# ほとんど白紙のページ（縮小した画像の輝度の標準偏差がこれ未満）は、知覚ハッシュを作らない
+BLANK_PAGE_STDDEV = 4.0
+
+
+def page_hashes(img):
+    """
+    ページ画像の知覚ハッシュ {"dhash", "phash"}（64ビットを16進の文字列で）を返す。白紙のページは None。
+    dHash は 9x8 に縮小した画像の左右の画素の大小、pHash は 32x32 に縮小した画像の DCT の低周波の 8x8 成分と中央値の大小。
+    スキャンし直しや画質・解像度の違いでは、ハッシュのハミング距離が小さいままになる。
+    """
+    import numpy as np
+    from PIL import Image
+    gray = img.convert("L")
+    small = np.asarray(gray.resize((32, 32), Image.LANCZOS), dtype=np.float64)
+    if small.std() < BLANK_PAGE_STDDEV:
+        return None
+    d = np.asarray(gray.resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    dhash = d[:, 1:] > d[:, :-1]
+    # DCT-II の行列を掛けて、2次元の DCT を求める
+    n = np.arange(32)
+    dct = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / 64)
+    low = (dct @ small @ dct.T)[:8, :8]
+    phash = low > np.median(low.flatten()[1:])  # 直流成分は除いて中央値を求める
+
+    def to_hex(bits):
+        return f"{int(''.join('1' if b else '0' for b in bits.flatten()), 2):016x}"
+
+    return {"dhash": to_hex(dhash), "phash": to_hex(phash)}
+
+
+def image_file_hashes(save_full_dir, filenames):
+    """保存してあるページ画像の知覚ハッシュのリスト（ハッシュを記録する前に作った画像の分を補う）"""
+    from PIL import Image
+    hashes = []
+    for filename in filenames:
+        with Image.open(os.path.join(save_full_dir, filename)) as img:
+            hashes.append(page_hashes(img))
+    return hashes
+
+
+def file_sha1(path):
+    """ファイルの内容のSHA-1を、少しずつ読みながら計算する（zipの中のファイルにも使える）"""
+    h = hashlib.sha1()
+    with open_file(path) as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_manifest_path(save_full_dir, img_name):
+    return os.path.join(save_full_dir, f"{img_name}_manifest.json")
+
+
+def load_manifest(manifest_path):
+    """マニフェストを読み込む。無い・壊れている・形式が古い場合は None を返す"""
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def save_manifest(manifest_path, manifest):
+    # 書きかけのマニフェストを読まれないよう、一時ファイルに書いてから置き換える
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, manifest_path)
+
+
+def remove_images(save_full_dir, filenames):
+    """画像と、そのサムネイル・回転済みの画像を削除する"""
+    for filename in filenames:
+        names = [filename] + [derived_name(filename, f"_rotated{r}") for r in range(1, 4)]
+        for name in names + [thumbnail_name(name) for name in names]:
+            path = os.path.join(save_full_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def remove_legacy_images(save_full_dir, img_name):
+    """マニフェスト導入前の、ページ通し番号の画像 ({img_name}_page0.png など) を削除する"""
+    pattern = re.compile(rf"^{re.escape(img_name)}_page(\d+)(_rotated\d)?\.png$")
+    for img_file in os.listdir(save_full_dir):
+        if pattern.match(img_file):
+            os.remove(os.path.join(save_full_dir, img_file))
+
+
+def iter_render_pdf(pdf_path, save_full_dir, img_name, entry, settings):
+    """
+    1つのPDFを1ページずつ画像にして保存し、ファイル名を順に返すジェネレータ。
+    メモリ上に置くビットマップは常に1ページ分だけで済む。
+    entry にはページ数と画像のファイル名、ページの知覚ハッシュ (page_hashes) を書き込んでいく。
+    """
+    # PDFごとに画像のファイル名を分けておくと、他のPDFの画像に影響を与えずに作り直せる
+    pdf_key = hashlib.sha1(os.path.basename(pdf_path).encode('utf-8')).hexdigest()[:8]
+    ext = IMAGE_EXTENSIONS[settings["format"]]
+    # pdf2image と PIL は読み込みに時間がかかるので、起動時ではなく初めて使うときに読み込む
+    from pdf2image import convert_from_path, pdfinfo_from_path
+    # 展開していないzipの中のPDFは、一時ファイルに書き出してから変換する
+    with local_file(pdf_path) as local_path:
+        pages = pdfinfo_from_path(local_path)["Pages"]
+        for page in range(pages):
+            img = convert_from_path(local_path, dpi=settings["dpi"], first_page=page + 1, last_page=page + 1)[0]
+            filename = f"{img_name}_{pdf_key}_{settings_key(settings)}_page{page}{ext}"
+            save_page_image(img, save_full_dir, filename, settings)
+            # 似ているページを探すためのハッシュも、画像がメモリにあるうちに作っておく
+            entry["hashes"].append(page_hashes(img))
+            img.close()
+            entry["images"].append(filename)
+            entry["pages"] = len(entry["images"])
+            yield filename
+
+
+def iter_render_pdf_images(pdf_path_list, save_full_dir, img_name, settings=None):
+    """
+    PDFを画像に変換して save_full_dir に保存し、画像のファイル名を1枚ずつ順に返すジェネレータ。
+    PDFごとのサイズ・更新時刻・SHA-1・ページ数・ページの知覚ハッシュをマニフェストに記録しておき、
+    変更されたPDFの画像だけを作り直す（変更されていないPDFは開きもしない）。
+    生成設定 (settings) もマニフェストに記録し、設定が変わったら全て作り直す。
+    Flaskのアプリコンテキストに依存しないため、バックグラウンドのプロセスからも呼び出せる。
+    """
+    settings = settings or DEFAULT_RENDER_SETTINGS
+    os.makedirs(save_full_dir, exist_ok=True)
+
+    manifest_path = get_manifest_path(save_full_dir, img_name)
+    manifest = load_manifest(manifest_path)
+    changed = False
+    if manifest is None:
+        remove_legacy_images(save_full_dir, img_name)
+        manifest = {"version": MANIFEST_VERSION, "settings": settings, "pdfs": {}}
+        changed = True
+    elif manifest.get("settings") != settings:
+        print("画像の生成設定が変更されたため、画像を作り直します。")
+        for entry in manifest["pdfs"].values():
+            remove_images(save_full_dir, entry["images"])
+        manifest = {"version": MANIFEST_VERSION, "settings": settings, "pdfs": {}}
+        changed = True
+
+    old_entries = dict(manifest["pdfs"])
+    new_entries = {}
+    count = 0
+    for pdf_path in pdf_path_list:
+        name = os.path.basename(pdf_path)
+        stat = file_stat(pdf_path)
+        entry = old_entries.get(name)
+        digest = None
+
+        # サイズと更新時刻が変わっていれば、内容のハッシュで本当に変わったかを確かめる
+        if entry is not None and (entry["size"], entry["mtime"]) != (stat.st_size, stat.st_mtime_ns):
+            digest = file_sha1(pdf_path)
+            if entry["size"] == stat.st_size and entry["sha1"] == digest:
+                entry = dict(entry, mtime=stat.st_mtime_ns)
+            else:
+                entry = None
+            changed = True
+
+        if entry is not None and not all(os.path.exists(os.path.join(save_full_dir, f)) for f in entry["images"]):
+            entry = None
+
+        # 知覚ハッシュを記録する前に作った画像は、作り直さずにハッシュだけ求める
+        if entry is not None and len(entry.get("hashes", [])) != len(entry["images"]):
+            try:
+                entry = dict(entry, hashes=image_file_hashes(save_full_dir, entry["images"]))
+                changed = True
+            except (OSError, ValueError) as e:
+                print(f"警告: {name} のページのハッシュを作れませんでした。エラー: {e}")
+
+        if entry is None:
+            print(f"{name} の画像を生成します。")
+            if name in old_entries:
+                remove_images(save_full_dir, old_entries[name]["images"])
+            entry = {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime_ns,
+                "sha1": digest or file_sha1(pdf_path),
+                "pages": 0,
+                "images": [],
+                "hashes": [],
+            }
+            for filename in iter_render_pdf(pdf_path, save_full_dir, img_name, entry, settings):
+                count += 1
+                yield filename
+            new_entries[name] = entry
+            # 途中で打ち切られても、変換し終わったPDFの分は次回に使えるように保存しておく
+            manifest["pdfs"] = dict(old_entries, **new_entries)
+            save_manifest(manifest_path, manifest)
+            changed = True
+            continue
+
+        new_entries[name] = entry
+        for filename in entry["images"]:
+            count += 1
+            yield filename
+
+    # 削除されたPDFの画像を消す
+    for name, entry in old_entries.items():
+        if name not in new_entries:
+            remove_images(save_full_dir, entry["images"])
+            changed = True
+
+    if changed:
+        manifest["pdfs"] = new_entries
+        save_manifest(manifest_path, manifest)
+    else:
+        print(f"画像は既に生成済みです ({count}枚)。キャッシュを利用します。")
+
+    if count == 0:
+        print("処理するべきPDFページがありません。")
+
+
+def render_pdf_images(pdf_path_list, save_full_dir, img_name, settings=None):
+    """PDFを画像に変換して save_full_dir に保存し、画像のファイル名のリストを返す"""
+    return list(iter_render_pdf_images(pdf_path_list, save_full_dir, img_name, settings))
+
+
+# 画像のファイル名からページを特定するためのパターン（生成設定のハッシュ・回転・サムネイルの違いは無視する）
+PAGE_ID_PATTERN = re.compile(r"_([0-9a-f]{8})_[0-9a-f]{6}_page(\d+)(?:_rotated\d)?(?:_thumb)?\.[a-z]+$")
+
+# PILの rotate(r*90)（反時計回り）に相当する EXIF の Orientation の値
+EXIF_ORIENTATIONS = {1: 8, 2: 3, 3: 6}
+
+
+def page_id(filename):
+    """画像のファイル名から、ページの識別子 ({PDFのキー}_page{n}) を返す"""
+    match = PAGE_ID_PATTERN.search(filename)
+    if match is None:
+        return filename
+    return f"{match.group(1)}_page{match.group(2)}"
+
+
+def original_name(filename):
+    """回転済みの画像やサムネイルのファイル名から、元の画像のファイル名を返す"""
+    return re.sub(r"(?:_rotated\d)?(?:_thumb)?(\.[a-z]+)$", r"\1", filename)
+
+
+def get_rotation_path(save_full_dir, img_name):
+    return os.path.join(save_full_dir, f"{img_name}_rotation.json")
+
+
+def load_rotations(save_full_dir, img_name):
+    """ページごとの回転の設定 {ページの識別子: 回転数 (0-3)} を読み込む"""
+    try:
+        with open(get_rotation_path(save_full_dir, img_name), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_rotations(save_full_dir, img_name, rotations):
+    path = get_rotation_path(save_full_dir, img_name)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(rotations, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, path)
+
+
+def set_jpeg_orientation(src_path, dst_path, orientation):
+    """
+    JPEGのデータはそのままに、EXIF の Orientation だけを書き込んだファイルを作る（再圧縮しないので劣化しない）。
+    ブラウザは Orientation に従って回転して表示する。
+    """
+    with open(src_path, 'rb') as f:
+        data = f.read()
+    from PIL import Image
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    exif_bytes = exif.tobytes()
+    if not exif_bytes.startswith(b"Exif\x00\x00"):
+        exif_bytes = b"Exif\x00\x00" + exif_bytes
+    segment = b"\xff\xe1" + (len(exif_bytes) + 2).to_bytes(2, "big") + exif_bytes
+
+    # SOI の直後（JFIF の APP0 があればその後ろ）に APP1 (EXIF) を挟む
+    pos = 2
+    if data[pos:pos + 2] == b"\xff\xe0":
+        pos += 2 + int.from_bytes(data[pos + 2:pos + 4], "big")
+    tmp_path = dst_path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data[:pos] + segment + data[pos:])
+    os.replace(tmp_path, dst_path)
+
+
+def rotate_image(src_path, dst_path, rotate, settings):
+    """
+    画像を rotate*90 度（反時計回り）回転させた画像を作る。
+    JPEG は EXIF の Orientation を書き込むだけにし、それ以外はピクセルの並べ替え (transpose) で回転する。
+    """
+    if src_path.endswith(".jpg"):
+        set_jpeg_orientation(src_path, dst_path, EXIF_ORIENTATIONS[rotate])
+        return
+    from PIL import Image
+    with Image.open(src_path) as img:
+        rotated = img.transpose([None, Image.Transpose.ROTATE_90, Image.Transpose.ROTATE_180, Image.Transpose.ROTATE_270][rotate])
+    image_format = {ext: name for name, ext in IMAGE_EXTENSIONS.items()}[os.path.splitext(src_path)[1]]
+    tmp_path = dst_path + ".tmp"
+    save_image(rotated, tmp_path, dict(settings, format=image_format))
+    os.replace(tmp_path, dst_path)
+
+
+def rotate_pages(save_full_dir, filenames, rotations, settings=None, executor=None):
+    """
+    filenames の各画像（とサムネイル）を、rotations の対応する回転数だけ回転させた画像を作り、
+    表示に使う画像のファイル名のリストを返す。回転済みの画像があればそれを使う。
+    executor を渡すと、回転をスレッドプールで並列に行う。
+    """
+    settings = settings or DEFAULT_RENDER_SETTINGS
+    result = []
+    tasks = []
+    for filename, rotate in zip(filenames, rotations):
+        if rotate == 0:
+            result.append(filename)
+            continue
+        rotated_filename = derived_name(filename, f"_rotated{rotate}")
+        sources = [filename]
+        if os.path.exists(os.path.join(save_full_dir, thumbnail_name(filename))):
+            sources.append(thumbnail_name(filename))
+        for src in sources:
+            dst = rotated_filename if src == filename else thumbnail_name(rotated_filename)
+            dst_path = os.path.join(save_full_dir, dst)
+            if not os.path.exists(dst_path):
+                tasks.append((os.path.join(save_full_dir, src), dst_path, rotate, settings))
+        result.append(rotated_filename)
+
+    if executor is not None and len(tasks) > 1:
+        for future in [executor.submit(rotate_image, *task) for task in tasks]:
+            future.result()
+    else:
+        for task in tasks:
+            rotate_image(*task)
+    return result
+
+
+def rotate_image_files(save_full_dir, filenames, rotate, settings=None, executor=None):
+    """save_full_dir 内の画像（とサムネイル）を全て rotate*90 度回転させ、回転済みの画像のファイル名のリストを返す"""
+    return rotate_pages(save_full_dir, filenames, [rotate] * len(filenames), settings, executor)
+
+
+def apply_rotations(save_full_dir, img_name, filenames, rotate=0, settings=None, executor=None):
+    """全体の回転 rotate に、ページごとの回転の設定を加えた向きの画像のファイル名のリストを返す"""
+    rotations = load_rotations(save_full_dir, img_name)
+    if rotate == 0 and not rotations:
+        return list(filenames)
+    return rotate_pages(
+        save_full_dir,
+        filenames,
+        [(rotate + rotations.get(page_id(f), 0)) % 4 for f in filenames],
+        settings,
+        executor,
+    )
+
+
+def prerender_images(pdf_path_list, save_full_dir, img_name, rotate=0, settings=None):
+    """画像を生成し、全体の回転 rotate やページごとの回転の設定があれば回転済みの画像も作っておく（事前生成用）"""
+    filenames = render_pdf_images(pdf_path_list, save_full_dir, img_name, settings)
+    apply_rotations(save_full_dir, img_name, filenames, rotate, settings)
+    return filenames
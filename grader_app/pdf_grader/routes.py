@@ -1,14 +1,23 @@
-from flask import Blueprint, render_template, current_app, request, url_for
-from grader_app.pdf_grader.utils import get_students, get_submission, get_report_data_context
+from flask import Blueprint, render_template, current_app, request, url_for, Response, stream_with_context
+from grader_app.pdf_grader.utils import get_students, get_submission, get_report_data_context, prefetch_submissions, iter_submission_images, get_thumbnail_path, set_page_rotation
+from grader_app.pdf_grader.utils import find_similar_pages, get_image_url_path
+from grader_app.pdf_grader.catalog import SUBMISSION_KINDS
 from flask import jsonify
 import os
+import json
+from urllib.parse import urlparse, unquote
 import grader_app.pdf_grader.utils
-from grader_app.utils import load_problems_from_json, save_problems_to_json, load_grades_from_json, save_grades_to_json, check_all_grades_entered, find_next_unfinished_student
+from grader_app.utils import load_problems_from_json, save_problems_to_json, load_grades_from_json, save_grades_to_json, check_all_grades_entered, find_next_unfinished_students
+from grader_app.utils import get_problems, apply_grade_changes, abort_if_removed_report
+from grader_app.models import GradeConflict, get_client_sequences
 from grader_app.utils import load_report_settings, save_report_settings_to_file, summarize_problems, get_attendance
-import pandas as pd
+from grader_app.utils import get_finished_status
 from flask import make_response
 import io
 
+# URL の kind と提出フォルダ名に含まれる種類の対応
+KIND_NAMES = {"detail": "詳細", "answer": "解答のみ"}
+
 pdf_bp = Blueprint(
     'pdf', __name__, 
     template_folder='templates', 
@@ -16,33 +25,70 @@ pdf_bp = Blueprint(
     url_prefix='/pdf'
 )
 
+@pdf_bp.before_request
+def check_report_index():
+    abort_if_removed_report('PDF_LIST')
+
+@pdf_bp.app_template_filter('thumbnail')
+def thumbnail_filter(image_path):
+    return get_thumbnail_path(image_path)
+
 @pdf_bp.route('/')
 def index():
     sorted_dirlist = current_app.config['PDF_LIST']
     finished = [True for report in sorted_dirlist]
-    return render_template("pdf_grader/reportlist.html", dirlist=sorted_dirlist, finished=finished)
+    # zipを展開中のレポートは、展開が終わるまで一覧に入らないので別に表示する
+    extractor = current_app.config.get('ZIP_EXTRACTOR')
+    pending = extractor.pending(current_app.config['PDF_BASE_DIR']) if extractor is not None else []
+    return render_template("pdf_grader/reportlist.html", dirlist=sorted_dirlist, finished=finished, pending=pending)
 
 @pdf_bp.route('<int:report_index>/students/')
 def student_list(report_index):
     dirlist = current_app.config['PDF_LIST']
     students = get_students(report_index)
-    finished = [False for student in students]
     report = dirlist[report_index]
+    finished = get_finished_status('pdf', report, students)
     return render_template("studentlist.html", student_list=students, report_index=report_index, report=report, finished=finished)
 
+@pdf_bp.route('<int:report_index>/similar_pages/')
+def similar_pages(report_index):
+    """別の学生のページ画像がよく似ている組（書き写し・コピーの疑い）の一覧"""
+    pairs, missing = find_similar_pages(report_index)
+    # 結果は索引にキャッシュされていて他のリクエストと共有するので、書き換えずに画像のURLを付けた組を作る
+    pairs = [
+        dict(pair, pages=[
+            dict(match, **{side + "_image": get_image_url_path(match[side]["savedir"], match[side]["image"]) for side in ("a", "b")})
+            for match in pair["pages"]
+        ])
+        for pair in pairs
+    ]
+    return render_template(
+        "pdf_grader/similar_pages.html", report_index=report_index, report=current_app.config['PDF_LIST'][report_index],
+        pairs=pairs, missing=missing,
+    )
+
 @pdf_bp.route('<int:report_index>/<int:student_index>/')
 def viewer(report_index, student_index):
     rotate = request.args.get("rotate", default=0, type=int) % 4
     problems = load_problems_from_json('pdf', current_app.config['PDF_LIST'][report_index])
-    grades = load_grades_from_json('pdf', current_app.config['PDF_LIST'][report_index], get_students(report_index)[student_index])
     student_names = get_students(report_index)
-    next_unfinished_index, next_unfinished_name = find_next_unfinished_student(
+    grades = load_grades_from_json('pdf', current_app.config['PDF_LIST'][report_index], student_names[student_index])
+    # 次の未完了の学生から PREFETCH_COUNT 人分を先読みする
+    unfinished_indices = find_next_unfinished_students(
         'pdf',
         current_app.config['PDF_LIST'][report_index],
         student_names,
         problems,
-        student_index
+        student_index,
+        max(1, current_app.config.get('PREFETCH_COUNT', 0))
     )
+    next_unfinished_index = unfinished_indices[0] if unfinished_indices else None
+    prefetch_indices = unfinished_indices[:current_app.config.get('PREFETCH_COUNT', 0)]
+    prefetch_submissions(report_index, prefetch_indices, rotate=rotate)
+    prefetch_urls = [
+        url_for('pdf.prefetch', report_index=report_index, student_index=i, rotate=rotate)
+        for i in prefetch_indices
+    ]
     return render_template(
         "pdf_grader/viewer.html",
         report_index=report_index,
@@ -55,20 +101,19 @@ def viewer(report_index, student_index):
         gardes=grades,
         rotate=rotate,
         next_unfinished_index=next_unfinished_index,
+        prefetch_urls=prefetch_urls,
     )
 
 @pdf_bp.route('generate/<int:report_index>/<int:student_index>/<kind>/')
 def generate(report_index, student_index, kind):
+    rotate = request.args.get("rotate", default=0, type=int) % 4
     report_name = current_app.config['PDF_LIST'][report_index]
     student_list = get_students(report_index)
     student_name = student_list[student_index]
     print(f"Generating images for report: {report_name}, student: {student_name}, kind: {kind}")
-    if kind == "detail":
-        kind_name = "詳細"
-    elif kind == "answer":
-        kind_name = "解答のみ"
+    kind_name = KIND_NAMES[kind]
 
-    submission = get_submission(report_name, student_name, kind_name)
+    submission = get_submission(report_name, student_name, kind_name, rotate=rotate)
     print(submission)
 
     html = render_template(
@@ -78,6 +123,77 @@ def generate(report_index, student_index, kind):
     )
     return jsonify({'html': html})
 
+@pdf_bp.route('generate_stream/<int:report_index>/<int:student_index>/<kind>/')
+def generate_stream(report_index, student_index, kind):
+    """
+    generate のストリーミング版 (Server-Sent Events)。
+    1ページ変換するごとに page イベントで画像のHTMLを送り、最後に done イベントを送る。
+    """
+    rotate = request.args.get("rotate", default=0, type=int) % 4
+    report_name = current_app.config['PDF_LIST'][report_index]
+    student_name = get_students(report_index)[student_index]
+    kind_name = KIND_NAMES[kind]
+    print(f"Streaming images for report: {report_name}, student: {student_name}, kind: {kind}")
+
+    def sse(event, data):
+        return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    def events():
+        count = 0
+        for image_path in iter_submission_images(report_name, student_name, kind_name, rotate=rotate):
+            count += 1
+            yield sse("page", {"html": render_template("pdf_grader/image.html", image_path=image_path)})
+        html = ""
+        if count == 0:
+            html = render_template("pdf_grader/images.html", kind_name=kind_name, images=[])
+        yield sse("done", {"count": count, "html": html})
+
+    response = Response(stream_with_context(events()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # nginx などのリバースプロキシにバッファリングさせない
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@pdf_bp.route('prefetch/<int:report_index>/<int:student_index>/')
+def prefetch(report_index, student_index):
+    """先読み用に、学生の全画像（ビューアに表示するサムネイル）のURLを返す（画像が無ければ生成を待つ）"""
+    rotate = request.args.get("rotate", default=0, type=int) % 4
+    report_name = current_app.config['PDF_LIST'][report_index]
+    student_name = get_students(report_index)[student_index]
+    images = []
+    for kind_name in SUBMISSION_KINDS:
+        submission = get_submission(report_name, student_name, kind_name, rotate=rotate)
+        images.extend(url_for('static', filename=get_thumbnail_path(image_path)) for image_path in submission)
+    return jsonify({"images": images}), 200
+
+@pdf_bp.route('rotate_page/', methods=['POST'])
+def rotate_page():
+    """
+    ビューアで回転させたページの向きを保存する。
+    {"image": 画像のURL, "degree": 回転させた角度（時計回りが正, 90の倍数）}
+    """
+    data = request.get_json()
+    # "/static/pdf_images/..." から static 以下のパスを取り出す
+    static_prefix = url_for('static', filename='')
+    image_path = unquote(urlparse(data["image"]).path)
+    if not image_path.startswith(static_prefix):
+        return jsonify({"error": "invalid image"}), 400
+    # PILの回転は反時計回りが正
+    quarter_turns = (-int(data["degree"]) // 90) % 4
+    try:
+        rotate = set_page_rotation(image_path[len(static_prefix):], quarter_turns)
+    except (ValueError, FileNotFoundError) as e:
+        print(e)
+        return jsonify({"error": "invalid image"}), 400
+    return jsonify({"rotate": rotate}), 200
+
+@pdf_bp.route('prerender_status/')
+def prerender_status():
+    prerenderer = current_app.config.get('PRERENDERER')
+    if prerenderer is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify(prerenderer.status()), 200
+
 @pdf_bp.route('<int:report_index>/edit_problems/')
 def edit_problems(report_index):
     back_url = request.args.get('back_url', url_for('pdf.index'))
@@ -125,54 +241,125 @@ def save_grades(report_index, student_index):
     try:
         received = request.json
         grades = received.get('grades', {}) # {"grade_q_1": "circle", "grade_q_2": "cross", ...}
+        # 呼び出し側が読み込んだときのバージョン（送られてこなければ確認せずに上書きする）。ビューアの自動保存は save_grade_changes を使う
+        expected_version = received.get('version')
 
         student_name = get_students(report_index)[student_index]
         report_name = current_app.config['PDF_LIST'][report_index]
-        save_grades_to_json('pdf', report_name, student_name, grades)
-        finished = check_all_grades_entered(load_problems_from_json('pdf', report_name), grades)
+        version = save_grades_to_json('pdf', report_name, student_name, grades, expected_version)
+        finished = check_all_grades_entered(get_problems('pdf', report_name), grades)
         if finished:
             print(f"All grades entered for student: {student_name} in report: {report_name}")
-            return jsonify({"status": "finished"}), 200
+            return jsonify({"status": "finished", "version": version}), 200
         else:
-            return jsonify({"status": "success"}), 200
+            return jsonify({"status": "success", "version": version}), 200
+    except GradeConflict as e:
+        # 他の採点者が先に保存していた。最新の採点結果を返し、ビューア側で取り込んでから保存し直してもらう
+        print(f"Grade conflict for student: {student_name} in report: {report_name}")
+        return jsonify({"status": "conflict", "version": e.version, "grades": e.grades}), 409
     except Exception as e:
         print(f"Error saving grades: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
-@pdf_bp.route('<int:report_index>/check_finished/')
-def check_finished(report_index):
-    try:
-        report_name = current_app.config['PDF_LIST'][report_index]
-        student_list = get_students(report_index)
-        finished_status = []
-        problems = load_problems_from_json('pdf', report_name)
-        for student_name in student_list:
-            grades = load_grades_from_json('pdf', report_name, student_name)
-            finished = check_all_grades_entered(problems, grades)
-            finished_status.append(finished)
-        return jsonify({"finished": finished_status}), 200
-    except Exception as e:
-        print(f"Error checking finished status: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
-    
-@pdf_bp.route('<int:report_index>/check_all_finished/')
-def check_all_finished(report_index):
+@pdf_bp.route('<int:report_index>/save_grade_changes/', methods=['POST'])
+def save_grade_changes(report_index):
+    """
+    ビューアの自動保存。変更された評価だけを、複数の学生の分をまとめて受け取る。
+    {"client": タブごとのID, "students": [{"student_index": 0, "seq": 通し番号, "changes": {"grade_q_1": "circle", "grade_q_2": null}}, ...]}
+    学生ごとに、保存した後の採点結果と、全ての問題の採点が終わったかどうかを返す。
+    seq が前回反映したもの以下の変更（送り直されたものなど）は反映しない。
+    client・seq が無い、学生番号が範囲外などの項目が1つでもあれば、何も反映せずに 400 を返す。
+    同じ学生を複数の採点者が同時に採点したときは、問題ごとに後から届いた評価が残る
+    （バージョンによる競合の検出 (409) は、採点結果の全体を保存する save_grades だけで行う）。
+    """
+    received = request.get_json(silent=True)
+    report_name = current_app.config['PDF_LIST'][report_index]
+    student_names = get_students(report_index)
+    error = validate_grade_changes(received, len(student_names))
+    if error is not None:
+        print(f"Invalid grade changes for report {report_name}: {error}")
+        return jsonify({"status": "error", "message": error}), 400
     try:
-        report_name = current_app.config['PDF_LIST'][report_index]
-        student_list = get_students(report_index)
-        problems = load_problems_from_json('pdf', report_name)
-        all_finished = True
-        for student_name in student_list:
-            grades = load_grades_from_json('pdf', report_name, student_name)
+        client = received['client']
+        problems = get_problems('pdf', report_name)
+        sequences = get_client_sequences(current_app)
+        results = []
+        for item in received['students']:
+            student_index = item['student_index']
+            seq = item['seq']
+            student_name = student_names[student_index]
+            applied, previous = sequences.claim(client, 'pdf', report_name, student_name, seq)
+            if applied:
+                try:
+                    grades, _ = apply_grade_changes('pdf', report_name, student_name, item['changes'])
+                except Exception:
+                    # 反映できなかったので、送り直されたときに反映済みとして捨てないようにする
+                    sequences.release(client, 'pdf', report_name, student_name, seq, previous)
+                    raise
+            else:
+                grades = load_grades_from_json('pdf', report_name, student_name)
             finished = check_all_grades_entered(problems, grades)
-            if not finished:
-                all_finished = False
-                break
-        return jsonify({"all_finished": all_finished}), 200
+            results.append({
+                "student_index": student_index,
+                "seq": seq,
+                "applied": applied,
+                "status": "finished" if finished else "success",
+                "grades": grades,
+            })
+        return jsonify({"results": results}), 200
     except Exception as e:
-        print(f"Error checking all finished status: {e}")
+        print(f"Error saving grade changes: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
-    
+
+def validate_grade_changes(received, student_count):
+    """save_grade_changes に送られてきたものがおかしければ、その理由を返す（問題なければ None）"""
+    def is_int(value):
+        return isinstance(value, int) and not isinstance(value, bool)
+
+    if not isinstance(received, dict):
+        return "JSON のオブジェクトを送ってください。"
+    if not isinstance(received.get('client'), str) or not received['client']:
+        return "client がありません。"
+    if not isinstance(received.get('students'), list):
+        return "students がありません。"
+    for item in received['students']:
+        if not isinstance(item, dict):
+            return "students の項目がオブジェクトではありません。"
+        if not is_int(item.get('student_index')) or not 0 <= item['student_index'] < student_count:
+            return f"学生番号が正しくありません: {item.get('student_index')!r}"
+        if not is_int(item.get('seq')):
+            return f"seq がありません: 学生番号 {item['student_index']}"
+        if not isinstance(item.get('changes'), dict):
+            return f"changes がありません: 学生番号 {item['student_index']}"
+    return None
+
+@pdf_bp.route('finished_status/')
+def finished_status():
+    """
+    全てのレポートの採点の進み具合（採点が終わった学生の数 finished / 学生の数 total）を1回で返す。
+    report_index を指定すると、そのレポートの学生ごとの完了フラグ (students) も返す。
+    """
+    selected = request.args.get("report_index", type=int)
+    reports = []
+    students = None
+    for report_index, report_name in enumerate(current_app.config['PDF_LIST']):
+        if report_name is None:
+            continue  # 削除されたレポート
+        try:
+            finished = get_finished_status('pdf', report_name, get_students(report_index))
+        except Exception as e:
+            print(f"Error checking finished status of {report_name}: {e}")
+            reports.append({"report_index": report_index, "status": "error", "message": str(e)})
+            continue
+        reports.append({
+            "report_index": report_index,
+            "finished": sum(finished),
+            "total": len(finished),
+            "all_finished": all(finished),
+        })
+        if report_index == selected:
+            students = finished
+    return jsonify({"reports": reports, "students": students}), 200
 
 @pdf_bp.route('report_scores/')
 def report_scores():
@@ -196,6 +383,7 @@ def download_report_xlsx():
     if not context:
         return "Data not found", 404
     
+    import pandas as pd
     # 1. 名簿内と名簿外を結合するか、あるいは別シートにするか選べますが
     #    今回は管理しやすいよう、名簿内(enrolled)をメインに作成します。
     df = pd.DataFrame(context['enrolled'])
@@ -28,6 +28,15 @@ function rotateThisImage(element, degreeOffset) {
     // 3. 反映
     img.style.transform = `rotate(${currentDegree}deg) scale(${scale})`;
     container.style.height = containerHeight;
+
+    // 4. ページの向きをサーバーに保存（次からは回転済みの画像が表示される）
+    if (img.dataset.rotateUrl) {
+        fetch(img.dataset.rotateUrl, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ image: img.dataset.fullSrc || img.getAttribute('src'), degree: degreeOffset })
+        }).catch(err => console.error('回転の保存に失敗しました:', err));
+    }
 }
 
 /**
@@ -38,7 +47,8 @@ function openLightbox(img) {
     const content = document.getElementById('lightbox-content');
     const lbImg = document.getElementById('lightbox-image');
     
-    lbImg.src = img.src;
+    // ビューアにはサムネイルを表示しているので、原寸の画像は開いたときに読み込む
+    lbImg.src = img.dataset.fullSrc || img.src;
     
     const degree = parseInt(img.dataset.rotate || 0);
     const isHorizontal = (Math.abs(degree) / 90) % 2 === 1;
@@ -91,4 +101,45 @@ function closeLightbox() {
     overlay.style.display = 'none';
     
     // ★スクロール位置を一番上（0）にリセット
-}
\ No newline at end of file
+}
+
+/**
+ * 画像を1ページずつ受け取って表示する (Server-Sent Events)
+ * 最初のページが届く前に接続に失敗した場合は、まとめて返す fallbackUrl を使う
+ */
+function streamImages(containerId, streamUrl, fallbackUrl) {
+    const container = document.getElementById(containerId);
+    const heading = container.querySelector('h2').outerHTML;
+    const source = new EventSource(streamUrl);
+    let received = 0;
+
+    source.addEventListener('page', (e) => {
+        const data = JSON.parse(e.data);
+        if (received === 0) {
+            // 処理中の表示を消して、見出しだけ残す
+            container.innerHTML = heading;
+        }
+        received += 1;
+        container.insertAdjacentHTML('beforeend', data.html);
+    });
+
+    source.addEventListener('done', (e) => {
+        const data = JSON.parse(e.data);
+        source.close();
+        if (data.count === 0) {
+            container.innerHTML = data.html;
+        }
+    });
+
+    source.onerror = () => {
+        source.close();
+        if (received > 0) {
+            return;
+        }
+        fetch(fallbackUrl)
+            .then(res => res.json())
+            .then(data => {
+                container.innerHTML = data.html;
+            });
+    };
+}
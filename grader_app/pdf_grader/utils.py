@@ -1,14 +1,17 @@
 import re
 import os
-from pdf2image import convert_from_path
-from PyPDF2 import PdfReader
-from flask import current_app
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app, g
 from pathlib import Path
-from PIL import Image
-import pandas as pd
 import json
 from datetime import datetime, timedelta
-from grader_app.utils import get_attendance
+from grader_app.pdf_grader.render import render_pdf_images, iter_render_pdf_images, apply_rotations, get_render_settings, thumbnail_name
+from grader_app.pdf_grader.render import load_rotations, save_rotations, page_id, original_name
+from grader_app.pdf_grader.catalog import get_catalog, SUBMISSION_KINDS
+from grader_app.pdf_grader.hashes import get_content_hash_index
+from grader_app.pdf_grader.pagehash import get_page_hash_index
 
 
 def extract_keys(filename):
@@ -20,410 +23,426 @@ def get_report_list(dirlist):
     dirlist = set([d.split("の提出")[0] for d in dirlist])
     return sorted(dirlist, key=extract_keys)
 
-def get_total_pdf_pages(pdf_path_list):
-    """PDFファイルのリストを受け取り、合計ページ数を返す"""
-    total_pages = 0
-    for pdf_path in pdf_path_list:
-        try:
-            with open(pdf_path, 'rb') as f:
-                reader = PdfReader(f)
-                total_pages += len(reader.pages)
-        except Exception as e:
-            print(f"警告: {pdf_path} のページ数を読み込めませんでした。エラー: {e}")
-            # エラーが発生したPDFは0ページとして扱うか、例外を投げるかを選択
-            pass
-    return total_pages
+def get_image_url_path(savedir, filename):
+    # ブラウザ用に "pdf_images/student_id/page0.png" のような形を作る
+    # OSの区切り文字 (\) を URLの区切り文字 (/) に置換
+    return Path(current_app.config['IMAGE_SUBPATH']).joinpath(savedir, filename).as_posix()
 
+def get_thumbnail_path(image_path):
+    """画像のURL用パスから、サムネイルのURL用パスを返す（サムネイルを作らない設定ならそのまま）"""
+    if current_app.config.get('THUMBNAIL_WIDTH', 0) <= 0:
+        return image_path
+    return thumbnail_name(image_path)
 
 def convert_pdf_to_images(pdf_path_list, savedir, img_name):
     """
     PDFを画像に変換する。
-    期待されるページ数と既存の画像数が一致しない場合は、再生成する。
+    変更されたPDFの画像だけを生成し直す。
+    バックグラウンドで生成中・生成待ちの場合は、そちらの完了を待つ。
     """
     # 保存先ディレクトリのフルパス
+    save_full_dir = os.path.join(current_app.config['IMAGE_DIR'], savedir)
 
-    image_root = current_app.config['IMAGE_DIR']
-    image_subpath = current_app.config['IMAGE_SUBPATH']
-
-    def get_url_path(filename):
-        # ブラウザ用に "pdf_images/student_id/page0.png" のような形を作る
-        # OSの区切り文字 (\) を URLの区切り文字 (/) に置換
-        return Path(image_subpath).joinpath(savedir, filename).as_posix()
-    
-    save_full_dir = os.path.join(image_root, savedir)
-    os.makedirs(save_full_dir, exist_ok=True)
-
-    # 1. 期待される総ページ数を計算
-    total_expected_pages = get_total_pdf_pages(pdf_path_list)
-    if total_expected_pages == 0:
-        print("処理するべきPDFページがありません。")
-        return []
+    prerenderer = current_app.config.get('PRERENDERER')
+    if prerenderer is not None:
+        try:
+            filenames = prerenderer.wait(savedir)
+            if filenames is not None:
+                return [get_image_url_path(savedir, f) for f in filenames]
+        except Exception as e:
+            print(f"警告: バックグラウンドでの画像生成に失敗したため、再度変換します。エラー: {e}")
 
-    # 2. 既存の画像ファイル数をカウント
-    pattern = re.compile(rf"^{re.escape(img_name)}_page(\d+)\.png$")
-    existing_images = [f for f in os.listdir(save_full_dir) if pattern.match(f)]
-    num_existing_images = len(existing_images)
+    try:
+        filenames = render_pdf_images(pdf_path_list, save_full_dir, img_name, get_render_settings(current_app.config))
+        return [get_image_url_path(savedir, f) for f in filenames]
 
-    # 3. ページ数と画像数を比較
-    if total_expected_pages == num_existing_images:
-        print(f"画像は既に生成済みです ({num_existing_images}枚)。キャッシュを利用します。")
-        # ファイル名順にソートしてパスのリストを返す
-        existing_images.sort(key=lambda x: int(pattern.match(x).group(1)))
-        return [get_url_path(f) for f in existing_images]
+    except Exception as e:
+        print(f"エラー: PDFから画像の変換中に問題が発生しました。エラー: {e}")
+        # エラー発生時は、専用のエラー画像パスを返す
+        return [get_image_url_path(savedir, "error.png")]
 
-    # 4. 不一致の場合、既存の画像を削除して再生成
-    print(f"ページ数/画像数に不一致を検出しました (期待: {total_expected_pages}, 既存: {num_existing_images})。画像を再生成します。")
-    for img_file in existing_images:
-        os.remove(os.path.join(save_full_dir, img_file))
+def iter_submission_images(report_name, student_name, kind_name, rotate=0):
+    """
+    get_submission のストリーミング版。
+    画像を1ページずつ生成し、できた順に画像のURL用パスを返すジェネレータ。
+    """
+    report, author = find_submission_dir(report_name, student_name, kind_name)
+    if report is None:
+        return
+    savedir = report + "/" + author
+    save_full_dir = os.path.join(current_app.config['IMAGE_DIR'], savedir)
+    settings = get_render_settings(current_app.config)
+
+    def to_url_path(filename):
+        filename = apply_rotations(save_full_dir, author, [filename], rotate, settings)[0]
+        return get_image_url_path(savedir, filename)
+
+    prerenderer = current_app.config.get('PRERENDERER')
+    if prerenderer is not None:
+        future = prerenderer.claim(savedir)
+        if future is not None:
+            # 別プロセスで生成中なので、終わるのを待ってからまとめて返す
+            try:
+                filenames = future.result()
+            except Exception as e:
+                print(f"警告: バックグラウンドでの画像生成に失敗したため、再度変換します。エラー: {e}")
+                filenames = None
+            if filenames is not None:
+                for filename in filenames:
+                    yield to_url_path(filename)
+                return
 
-    # --- 以下、画像の生成処理 ---
     try:
-        all_image_paths = []
-        page_counter = 0
-        for pdf_path in pdf_path_list:
-            images = convert_from_path(pdf_path)
-            for img in images:
-                img_path = os.path.join(save_full_dir, f"{img_name}_page{page_counter}.png")
-                img.save(img_path, "PNG")
-                all_image_paths.append(get_url_path(f"{img_name}_page{page_counter}.png"))
-                page_counter += 1
-        
-        return all_image_paths
-
+        for filename in iter_render_pdf_images(get_pdf_path_list(report, author), save_full_dir, author, settings):
+            yield to_url_path(filename)
     except Exception as e:
         print(f"エラー: PDFから画像の変換中に問題が発生しました。エラー: {e}")
-        # エラー発生時は、専用のエラー画像パスを返す
-        return [get_url_path("error.png")]
+        yield get_image_url_path(savedir, "error.png")
+    finally:
+        if prerenderer is not None:
+            prerenderer.release(savedir)
     
 
+class StudentRosterCache:
+    """(レポート番号, レポート名, 提出フォルダの更新時刻) をキーにした学生名簿のLRUキャッシュ"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            students = self._data.get(key)
+            if students is not None:
+                self._data.move_to_end(key)
+            return students
+
+    def put(self, key, students):
+        with self._lock:
+            self._data[key] = students
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def get_roster_cache(app):
+    cache = app.config.get('STUDENT_ROSTER_CACHE')
+    if cache is None:
+        cache = StudentRosterCache(app.config.get('STUDENT_ROSTER_CACHE_SIZE', 32))
+        app.config['STUDENT_ROSTER_CACHE'] = cache
+    return cache
+
 def get_students(report_index):
-    dirlist = current_app.config['PDF_LIST']
-    raw_dirlist = current_app.config['RAW_PDF_LIST']
-    students = []
-    report = dirlist[report_index]
-    for r in raw_dirlist:
-        if report in r:
-            students.extend(os.listdir(os.path.join(current_app.config['PDF_BASE_DIR'], r)))
-    students = [s.split("_")[0] for s in students]
-    students = sorted(list(set(students)))
+    # 同じリクエスト内では一度だけ求める
+    rosters = g.setdefault('student_rosters', {})
+    if report_index in rosters:
+        return rosters[report_index]
+
+    report = current_app.config['PDF_LIST'][report_index]
+    catalog = get_catalog(current_app)
+    cache = get_roster_cache(current_app)
+    key = (report_index, report, catalog.report_mtime(report))
+    students = cache.get(key)
+    if students is None:
+        students = catalog.students(report)
+        cache.put(key, students)
+    rosters[report_index] = students
     return students
 
+def get_pdf_path_list(report, author):
+    """提出フォルダ内の学生のフォルダにあるPDFのパスのリストを返す"""
+    return get_catalog(current_app).pdf_paths(report, author)
+
 def get_images(report, author, rotate):
     img_name = author
-    pdf_path_list = [
-        os.path.join(
-            current_app.config['PDF_BASE_DIR'],
-            report,
-            author,
-            pdf
-        ) for pdf in os.listdir(os.path.join(current_app.config['PDF_BASE_DIR'], report, author))
-    ]
+    pdf_path_list = get_pdf_path_list(report, author)
     images = convert_pdf_to_images(pdf_path_list, report + "/" + author, img_name)
-    if rotate != 0:
-        images = rotate_images(images, rotate)
+    images = rotate_images(images, rotate)
     return images
 
 def get_pdfs(report_index, author_index):
-    sorted_dirlist = current_app.config['PDF_LIST']
-    author_list = get_students(report_index)
-    author = author_list[author_index]
-    pdfs = os.listdir(os.path.join(current_app.config['PDF_BASE_DIR'], sorted_dirlist[report_index], author))
+    report_name = current_app.config['PDF_LIST'][report_index]
+    author = get_students(report_index)[author_index]
+    catalog = get_catalog(current_app)
+    pdfs = []
+    for kind_name in SUBMISSION_KINDS:
+        report, author_dir = catalog.find(report_name, kind_name, author)
+        if report is not None:
+            pdfs.extend(catalog.pdf_names(report, author_dir))
     return pdfs
 
+# ページごとの回転の設定ファイルを読み書きするときのロック
+ROTATION_LOCK = threading.Lock()
+
+def get_rotate_executor(app):
+    """画像の回転に使うスレッドプールを返す（無ければ作る）"""
+    executor = app.config.get('ROTATE_EXECUTOR')
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=app.config.get('ROTATE_WORKERS', 4), thread_name_prefix="pdf-rotate")
+        app.config['ROTATE_EXECUTOR'] = executor
+    return executor
+
+def resolve_image_path(img_path):
+    """URL用のパス (pdf_images/...) を、IMAGE_DIR 以下の (学生の画像フォルダ, ファイル名) に直す"""
+    relpath = Path(img_path).relative_to(current_app.config['IMAGE_SUBPATH'])
+    save_full_dir = os.path.join(current_app.config['IMAGE_DIR'], relpath.parent)
+    # IMAGE_DIR の外を指すパスは受け付けない
+    if os.path.commonpath([os.path.realpath(save_full_dir), os.path.realpath(current_app.config['IMAGE_DIR'])]) != os.path.realpath(current_app.config['IMAGE_DIR']):
+        raise ValueError(f"不正な画像のパスです: {img_path}")
+    return save_full_dir, relpath.name
+
 def rotate_images(images, rotate):
-    images_new = []
-    for img_path in images:
-        rotated_img_path = img_path.replace(".png", f"_rotated{rotate}.png")
-        if not os.path.exists(rotated_img_path):
-            img = Image.open(img_path)
-            img = img.rotate(rotate*90, expand=True)
-            img.save(rotated_img_path)
-        images_new.append(rotated_img_path)
+    """全体の回転 rotate とページごとの回転の設定に従って、回転済みの画像のURL用パスのリストを返す"""
+    settings = get_render_settings(current_app.config)
+    executor = get_rotate_executor(current_app)
+    images_new = list(images)
+
+    # 学生の画像フォルダごとにまとめて回転する
+    groups = OrderedDict()
+    for i, img_path in enumerate(images):
+        save_full_dir, filename = resolve_image_path(img_path)
+        if os.path.exists(os.path.join(save_full_dir, filename)):
+            groups.setdefault(save_full_dir, []).append((i, filename))
+    for save_full_dir, items in groups.items():
+        img_name = os.path.basename(save_full_dir)
+        rotated = apply_rotations(save_full_dir, img_name, [filename for _, filename in items], rotate, settings, executor)
+        for (i, _), rotated_filename in zip(items, rotated):
+            images_new[i] = Path(images[i]).with_name(rotated_filename).as_posix()
     return images_new
 
+def set_page_rotation(img_path, quarter_turns):
+    """
+    ページの回転の設定に quarter_turns*90 度（反時計回り）を加えて保存し、
+    次に表示するときのために回転済みの画像をスレッドプールで作っておく。
+    img_path は回転済みの画像やサムネイルのURL用パスでもよい。
+    """
+    save_full_dir, filename = resolve_image_path(img_path)
+    filename = original_name(filename)
+    if not os.path.exists(os.path.join(save_full_dir, filename)):
+        raise FileNotFoundError(f"画像が見つかりません: {img_path}")
+    img_name = os.path.basename(save_full_dir)
+    key = page_id(filename)
+    with ROTATION_LOCK:
+        rotations = load_rotations(save_full_dir, img_name)
+        rotations[key] = (rotations.get(key, 0) + quarter_turns) % 4
+        if rotations[key] == 0:
+            del rotations[key]
+        save_rotations(save_full_dir, img_name, rotations)
+
+    get_rotate_executor(current_app).submit(
+        apply_rotations, save_full_dir, img_name, [filename], 0, get_render_settings(current_app.config)
+    )
+    return rotations.get(key, 0)
+
+def find_submission_dir(report_name, student_name, kind_name):
+    """提出フォルダ名と学生のフォルダ名の組を返す。見つからない場合は (None, None) を返す"""
+    catalog = get_catalog(current_app)
+    report, author = catalog.find(report_name, kind_name, student_name)
+    if report is None:
+        if not catalog.has_kind(report_name, kind_name):
+            print(f"警告: {student_name} の {kind_name} に該当するディレクトリが見つかりませんでした。")
+        else:
+            print(f"警告: {student_name} の提出物が見つかりませんでした。")
+    return report, author
+
 def get_submission(report_name, student_name, kind_name, rotate=0):
-    base_dir = current_app.config['PDF_BASE_DIR']
-    raw_dir = current_app.config['RAW_PDF_LIST']
-    filtered_raw_dir = [s for s in raw_dir if report_name in s and kind_name in s]
-    if len(filtered_raw_dir) > 1:
-        raise Exception(f"警告: {student_name} の {kind_name} に該当するディレクトリが複数見つかりました。")
-    if len(filtered_raw_dir) == 0:
-        print(f"警告: {student_name} の {kind_name} に該当するディレクトリが見つかりませんでした。")
-        return []
-    
-    submissions = os.listdir(os.path.join(base_dir, filtered_raw_dir[0]))
-    filtered_submissions = [s for s in submissions if student_name in s]
-    if len(filtered_submissions) > 1:
-        raise Exception(f"警告: {student_name} の提出物が複数見つかりました。")
-    if len(filtered_submissions) == 0:
-        print(f"警告: {student_name} の提出物が見つかりませんでした。")
+    report, author = find_submission_dir(report_name, student_name, kind_name)
+    if report is None:
         return []
-    
-    report = filtered_raw_dir[0]
-    author = filtered_submissions[0]
     images = get_images(report, author, rotate=rotate)
     return images
 
+def prefetch_submissions(report_index, student_indices, rotate=0):
+    """
+    次に開かれる学生の画像（と回転済みの画像）の生成を、優先度を上げて予約する。
+    student_indices の先頭ほど優先される。
+    """
+    prerenderer = current_app.config.get('PRERENDERER')
+    if prerenderer is None:
+        return
+    report_name = current_app.config['PDF_LIST'][report_index]
+    student_names = get_students(report_index)
+    for rank, student_index in enumerate(student_indices):
+        student_name = student_names[student_index]
+        for kind_name in SUBMISSION_KINDS:
+            try:
+                report, author = find_submission_dir(report_name, student_name, kind_name)
+            except Exception as e:
+                print(e)
+                continue
+            if report is None:
+                continue
+            savedir = report + "/" + author
+            prerenderer.schedule(
+                savedir,
+                get_pdf_path_list(report, author),
+                os.path.join(current_app.config['IMAGE_DIR'], savedir),
+                author,
+                report_name,
+                # バックグラウンドのジョブ (学生番号, レポート番号) よりも先に処理させる
+                (-1, rank),
+                rotate=rotate,
+                settings=get_render_settings(current_app.config),
+            )
+
 def issubmitted(report_name, student_name, kind_name):
-    base_dir = current_app.config['PDF_BASE_DIR']
-    raw_dir = current_app.config['RAW_PDF_LIST']
-    filtered_raw_dir = [s for s in raw_dir if report_name in s and kind_name in s]
-    if len(filtered_raw_dir) != 1:
-        return False
-    submissions = os.listdir(os.path.join(base_dir, filtered_raw_dir[0]))
-    filtered_submissions = [s for s in submissions if student_name in s]
-    pdffile = os.listdir(os.path.join(base_dir, filtered_raw_dir[0], filtered_submissions[0])) if len(filtered_submissions) == 1 else []
-    return len(filtered_submissions) == 1, os.path.join(base_dir, filtered_raw_dir[0], filtered_submissions[0], pdffile[0]) if len(pdffile) > 0 else None
+    """(提出済みかどうか, 最初のPDFのパス) を返す"""
+    catalog = get_catalog(current_app)
+    try:
+        report, author = catalog.find(report_name, kind_name, student_name)
+    except Exception:
+        return False, None
+    if report is None:
+        return False, None
+    pdffile = catalog.pdf_paths(report, author)
+    return True, pdffile[0] if len(pdffile) > 0 else None
 
 
-def get_scores(report_index):
-    from flask import jsonify
+def get_student_score(report_name, student_name):
+    """学生の得点（満点に対する百分率）"""
     from grader_app.utils import get_point
+    point, total_point = get_point('pdf', report_name, student_name)
+    if total_point != 0:
+        point = round(point/total_point * 100, 2)
+    return point
+
+
+def get_scores(report_index):
     report_name = current_app.config['PDF_LIST'][report_index]
     student_list = get_students(report_index)
     scores = {}
     for student_name in student_list:
-        point, total_point = get_point('pdf', report_name, student_name)
-        if total_point != 0:
-            point = round(point/total_point * 100, 2)
-        scores[student_name] = point
+        scores[student_name] = get_student_score(report_name, student_name)
     return scores
 
 
-def get_report_data_context(mode='scores'):
+def find_deadline_files(report_name):
+    """{種類: 締切と提出日時のJSONのファイル名（PDF_BASE_DIR 直下, 無ければ None）}"""
+    submission_files = get_catalog(current_app).base_files(".json")
+    deadline_files = {}
+    for kind_name in SUBMISSION_KINDS:
+        files = [f for f in submission_files if report_name.split("-")[1] in f and kind_name in f]
+        deadline_files[kind_name] = files[0] if len(files) > 0 else None
+    return deadline_files
+
+
+def is_same_pdf(detail_file, answer_file):
+    """2つのPDFの内容が同じかどうか（内容のハッシュの索引で比べる）"""
+    return get_content_hash_index(current_app).same(detail_file, answer_file)
+
+
+def find_identical_submissions(report_index):
     """
-    提出状況またはスコアのデータを生成する共通ヘルパー関数
-    mode: 'status' (◎, 詳, 答, ×) または 'scores' (数値)
+    レポートの中で、複数の学生が同じ内容のファイルを提出しているものを探す。
+    内容のハッシュごとにまとめるので、学生同士を総当たりで比べる必要はない。
+    戻り値: 同じ内容のファイルを提出した学生のまとまりのリスト
+            [[{"student", "student_index", "kind", "file"}, ...], ...]
     """
-    from grader_app.utils import get_enrolled_students
-    ratio_detail_only = current_app.config.get('RATIO_DETAIL_ONLY', 0.5)
-    ratio_answer_only = current_app.config.get('RATIO_ANSWER_ONLY', 0.5)
-    ratio_duplicate = current_app.config.get('RATIO_DUPLICATE', 0.6)
-    ratio_late = current_app.config.get('RATIO_LATE', 0.8)
-    ratio_very_late = current_app.config.get('RATIO_VERY_LATE', 0.6)
-    large_delay_threshold = current_app.config.get('DELAY_THRESHOLD_DAYS', 15)
-    
-    df_students = get_enrolled_students('pdf')
-    if df_students is None:
-        return None
-
-    report_list = current_app.config['PDF_LIST']
-
-    submission_files = [f for f in os.listdir(current_app.config['PDF_BASE_DIR']) if f.endswith(".json")]
-    df_students_score = None  # スコア用のDataFrameを初期化
-    df_students_status = None  # 提出状況用のDataFrameを初期化
-    df_students_late = None  # 遅延状況用のDataFrameを初期化
-    df_students_id = None
-
-    df_unlisted_score = None
-    df_unlisted_status = None
-    df_unlisted_late = None
-    df_unlisted_id = None
-
-    for i, report_name in enumerate(report_list):
-        scores_data = get_scores(i)
-        # get_scoresの戻り値が辞書(scores["data"])か、直接辞書かで調整してください
-        scores = scores_data.get("data", scores_data) if isinstance(scores_data, dict) else scores_data
-        
-        students_names = get_students(i)
-        current_report_rows = []
-        current_report_late_rows = []
-        current_report_status_rows = []
-        id_rows = []
-        
-        submission_file_detail = [f for f in submission_files if report_name.split("-")[1] in f and '詳細' in f]
-        submission_file_answer = [f for f in submission_files if report_name.split("-")[1] in f and '解答のみ' in f]
-
-        if len(submission_file_detail) == 0:
-            submission_date_detail = {}
-        else:
-            submission_date_detail = json.load(open(os.path.join(current_app.config['PDF_BASE_DIR'], submission_file_detail[0]), 'r', encoding='utf-8') )
-        if len(submission_file_answer) == 0:
-            submission_date_answer = {}
-        else:
-            submission_date_answer = json.load(open(os.path.join(current_app.config['PDF_BASE_DIR'], submission_file_answer[0]), 'r', encoding='utf-8') )
-        
-        # print(submission_date_detail)
-        deadline_detail = submission_date_detail.get("deadline", "")
-        deadline_answer = submission_date_answer.get("deadline", "")
-
-        for i_st, student_name in enumerate(students_names):
-            parts = student_name.split()
-            number = parts[0].upper().strip()
-            name = " ".join(parts[1:]).strip() if len(parts) > 1 else ""
-            
-            sub_detail, detail_file = issubmitted(report_name, student_name, '詳細')
-            sub_answer, answer_file = issubmitted(report_name, student_name, '解答のみ')
-            
-            is_late = False
-            is_very_late = False
-            delay = None
-            if sub_detail:
-                date_detail = submission_date_detail["submissions"][number]
-                is_late, delay = check_delay(deadline_detail, date_detail)
-                    
-            if sub_answer:
-                date_answer = submission_date_answer["submissions"][number]
-                is_late_, delay_ = check_delay(deadline_answer, date_answer)
-                if not delay or (delay_ and delay_ > delay):
-                    delay = delay_
-            is_late = is_late or is_late_
-            is_very_late = delay is not None and delay > timedelta(days=large_delay_threshold)  # 例: 7日以上の遅延を「非常に遅い」とみなす
-
-            base_score = scores.get(student_name, 0)
-
-
-            if sub_detail and sub_answer:
-                import filecmp
-                is_same = filecmp.cmp(detail_file, answer_file, shallow=False)
-                if is_same:
-                    status= "同"
-                    val = base_score * ratio_duplicate
-                else:
-                    status = "◎"
-                    val = base_score
-            elif sub_detail:
-                status = "詳"
-                val = base_score * ratio_detail_only
-            elif sub_answer: 
-                status = "答"
-                val = base_score * ratio_answer_only
-            else: 
-                status = "×"
-                val = 0
-
-            if is_very_late:
-                val = val * ratio_very_late
-            elif is_late:
-                val = val * ratio_late
-
-            
-            val = round(val, 1)
-            
-            current_report_rows.append({'学籍番号': number, '氏名': name, report_name: val})
-            current_report_status_rows.append({'学籍番号': number, '氏名': name, report_name: status})
-            current_report_late_rows.append({'学籍番号': number, '氏名': name, report_name: "大遅" if is_very_late else ("遅" if is_late else "")})
-            id_rows.append({'学籍番号': number, '氏名': name, report_name: i_st})
-
-        score_df = pd.DataFrame(current_report_rows)
-        status_df = pd.DataFrame(current_report_status_rows)
-        late_df = pd.DataFrame(current_report_late_rows)
-        id_df = pd.DataFrame(id_rows)
-
-        # 名簿内へのマージ
-        if df_students_score is None:
-            df_students_score = pd.merge(df_students, score_df.drop(columns=['氏名']), on=['学籍番号'], how='left')
-        else:
-            df_students_score = pd.merge(df_students_score, score_df.drop(columns=['氏名']), on='学籍番号', how='left')
-        if df_students_status is None:
-            df_students_status = pd.merge(df_students, status_df.drop(columns=['氏名']), on=['学籍番号'], how='left')
-        else:
-            df_students_status = pd.merge(df_students_status, status_df.drop(columns=['氏名']), on='学籍番号', how='left')
-        if df_students_late is None:
-            df_students_late = pd.merge(df_students, late_df.drop(columns=['氏名']), on=['学籍番号'], how='left')
-        else:
-            df_students_late = pd.merge(df_students_late, late_df.drop(columns=['氏名']), on='学籍番号', how='left')
-        if df_students_id is None:
-            df_students_id = pd.merge(df_students, id_df.drop(columns=['氏名']), on='学籍番号', how='left')
-        else:
-            df_students_id = pd.merge(df_students_id, id_df.drop(columns=['氏名']), on='学籍番号', how='left')
-        # df_students = pd.merge(df_students, status_df.drop(columns=['氏名']), on='学籍番号', how='left')
+    catalog = get_catalog(current_app)
+    index = get_content_hash_index(current_app)
+    report_name = current_app.config['PDF_LIST'][report_index]
+    groups = {}
+    for i_st, student_name in enumerate(get_students(report_index)):
+        for kind_name in SUBMISSION_KINDS:
+            try:
+                raw, author = catalog.find(report_name, kind_name, student_name)
+            except Exception as e:
+                print(e)
+                continue
+            if raw is None:
+                continue
+            for pdf_path in catalog.pdf_paths(raw, author):
+                groups.setdefault(index.digest(pdf_path), []).append({
+                    "student": student_name,
+                    "student_index": i_st,
+                    "kind": kind_name,
+                    "file": os.path.basename(pdf_path),
+                })
+    return [
+        group for group in groups.values()
+        if len({entry["student"] for entry in group}) > 1
+    ]
 
-        df_students_score[report_name] = df_students_score[report_name].fillna(0)
-        df_students_status[report_name] = df_students_status[report_name].fillna("×")
-        df_students_late[report_name] = df_students_late[report_name].fillna("")
-        df_students_id[report_name] = df_students_id[report_name].fillna(-1)
 
-        if df_unlisted_score is None:
-            df_unlisted_score = score_df[~score_df['学籍番号'].isin(df_students['学籍番号'])]
-        else:
-            df_unlisted_score = pd.merge(df_unlisted_score, score_df[~score_df['学籍番号'].isin(df_students['学籍番号'])], on=['学籍番号', '氏名'], how='outer')
-        if df_unlisted_status is None:
-            df_unlisted_status = status_df[~status_df['学籍番号'].isin(df_students['学籍番号'])]
-        else:
-            df_unlisted_status = pd.merge(df_unlisted_status, status_df[~status_df['学籍番号'].isin(df_students['学籍番号'])], on=['学籍番号', '氏名'], how='outer')
-        if df_unlisted_late is None:
-            df_unlisted_late = late_df[~late_df['学籍番号'].isin(df_students['学籍番号'])]
-        else:
-            df_unlisted_late = pd.merge(df_unlisted_late, late_df[~late_df['学籍番号'].isin(df_students['学籍番号'])], on=['学籍番号', '氏名'], how='outer')
-        if df_unlisted_id is None:
-            df_unlisted_id = id_df[~id_df['学籍番号'].isin(df_students['学籍番号'])]
+def find_similar_pages(report_index):
+    """
+    レポートの中で、別の学生のページ画像がよく似ているもの（知覚ハッシュが近いもの）を、学生の組ごとに探す。
+    ハッシュは画像を作るときに記録するので、画像をまだ作っていない提出物は比べられない。
+    戻り値: (PageHashIndex.suspicious_pairs の組のリスト, 画像をまだ作っていない提出物の数)
+    """
+    catalog = get_catalog(current_app)
+    report_name = current_app.config['PDF_LIST'][report_index]
+    submissions = []
+    for i_st, student_name in enumerate(get_students(report_index)):
+        for kind_name in SUBMISSION_KINDS:
+            try:
+                raw, author = catalog.find(report_name, kind_name, student_name)
+            except Exception as e:
+                print(e)
+                continue
+            if raw is not None:
+                submissions.append((i_st, student_name, kind_name, raw + "/" + author))
+    return get_page_hash_index(current_app).suspicious_pairs(report_name, submissions)
+
+
+def collect_report_facts(report_index, report_name):
+    """
+    1つのレポートについて、(学生, 種類) ごとの提出物の情報の dict のリストを返す。
+    得点 (base_score) は入れないので、呼び出し側で入れること。
+    """
+    deadlines = {}
+    for kind_name, filename in find_deadline_files(report_name).items():
+        if filename is None:
+            deadlines[kind_name] = {}
         else:
-            df_unlisted_id = pd.merge(df_unlisted_id, id_df[~id_df['学籍番号'].isin(df_students['学籍番号'])], on=['学籍番号', '氏名'], how='outer')
-
-    stats = {}
-
-    if not df_students_score.empty:
-        # report_list に含まれる列（各課題の点数）だけで平均を計算
-        df_students_score['平均点'] = df_students_score[report_list].mean(axis=1).round(1)
-        
-        # 評価ロジック
-        def calculate_grade(score):
-            if score >= current_app.config.get('THRESHOLD_S', 90): return 'S' # 90以上をS、それ以外をA~Dに振り分け
-            if score >= current_app.config.get('THRESHOLD_A', 80): return 'A'
-            if score >= current_app.config.get('THRESHOLD_B', 70): return 'B'
-            if score >= current_app.config.get('THRESHOLD_C', 60): return 'C'
-            return 'D'
-        
-        df_students_score['評価'] = df_students_score['平均点'].apply(calculate_grade)
-        
-        counts = df_students_score['評価'].value_counts()
-        total = len(df_students_score)
-        
-        # S, A, B, C, D の順番で辞書を作成
-        for grade in ['S', 'A', 'B', 'C', 'D']:
-            count = int(counts.get(grade, 0))
-            ratio = round((count / total) * 100, 1) if total > 0 else 0
-            stats[grade] = {'count': count, 'ratio': ratio}
-
-    if not df_unlisted_score.empty:
-        df_unlisted_score['平均点'] = df_unlisted_score[report_list].mean(axis=1).round(1)
-
-        # 評価ロジック
-        def calculate_grade(score):
-            if score >= current_app.config.get('THRESHOLD_S', 90): return 'S' # 90以上をS、それ以外をA~Dに振り分け
-            if score >= current_app.config.get('THRESHOLD_A', 80): return 'A'
-            if score >= current_app.config.get('THRESHOLD_B', 70): return 'B'
-            if score >= current_app.config.get('THRESHOLD_C', 60): return 'C'
-            return 'D'
-        
-        df_unlisted_score['評価'] = df_unlisted_score['平均点'].apply(calculate_grade)
-
-    data = get_attendance("pdf")
-    attendance = pd.DataFrame(data['enrolled']).drop(columns=['判定'])
-    absences = (attendance == '×').sum(axis=1)
-    attendance["欠席回数"] = absences
-    df_students_score = pd.merge(df_students_score, attendance[["学籍番号", "欠席回数"]], on='学籍番号', how='left')
-
-    attendance = pd.DataFrame(data['unlisted'])
-    absences = (attendance == '×').sum(axis=1)
-    attendance["欠席回数"] = absences
-    df_unlisted_score = pd.merge(df_unlisted_score, attendance[["学籍番号", "欠席回数"]], on='学籍番号', how='left') if df_unlisted_score is not None else None
-    # if df_unlisted_score is not None:
-    #     df_unlisted_score["欠席回数"] = absences
-
-    # original_orderでソート
-    df_students_score = df_students_score.sort_values('original_order')
-    df_students_status = df_students_status.sort_values('original_order')
-    df_students_late = df_students_late.sort_values('original_order')
-    df_students_id = df_students_id.sort_values('original_order')
-
-    return {
-        "enrolled": df_students_score.to_dict(orient='records'),
-        "enrolled_status": df_students_status.to_dict(orient='records'),
-        "enrolled_late": df_students_late.to_dict(orient='records'),
-        "enrolled_id": df_students_id.to_dict(orient='records'),
-        "unlisted": df_unlisted_score.to_dict(orient='records') if df_unlisted_score is not None else [],
-        "unlisted_status": df_unlisted_status.to_dict(orient='records') if df_unlisted_status is not None else [],
-        "unlisted_late": df_unlisted_late.to_dict(orient='records') if df_unlisted_late is not None else [],
-        "unlisted_id": df_unlisted_id.to_dict(orient='records') if df_unlisted_id is not None else [],
-        "columns": df_students_score.columns.tolist(),
-        "report_list": report_list,
-        "stats": stats,
-        "mode": mode
-    }
+            with open(os.path.join(current_app.config['PDF_BASE_DIR'], filename), 'r', encoding='utf-8') as f:
+                deadlines[kind_name] = json.load(f)
+
+    rows = []
+    for i_st, student_name in enumerate(get_students(report_index)):
+        parts = student_name.split()
+        number = parts[0].upper().strip()
+        name = " ".join(parts[1:]).strip() if len(parts) > 1 else ""
+
+        submitted = {kind_name: issubmitted(report_name, student_name, kind_name) for kind_name in SUBMISSION_KINDS}
+        (sub_detail, detail_file), (sub_answer, answer_file) = submitted['詳細'], submitted['解答のみ']
+        is_same = None
+        if sub_detail and sub_answer:
+            is_same = is_same_pdf(detail_file, answer_file)
+
+        for kind_name in SUBMISSION_KINDS:
+            sub, _ = submitted[kind_name]
+            rows.append({
+                "report_index": report_index,
+                "report": report_name,
+                "student_index": i_st,
+                "student": student_name,
+                "number": number,
+                "name": name,
+                "kind": kind_name,
+                "submitted": sub,
+                "submitted_at": deadlines[kind_name]["submissions"][number] if sub else None,
+                "deadline": deadlines[kind_name].get("deadline", ""),
+                "is_same": is_same,
+                "base_score": None,
+            })
+    return rows
 
 
+def get_report_data_context(mode='scores'):
+    """
+    提出状況またはスコアのデータを生成する共通ヘルパー関数
+    mode: 'status' (◎, 詳, 答, ×) または 'scores' (数値)
+    入力が変わった部分だけを計算し直す（overview.ReportOverview を参照）
+    """
+    from grader_app.pdf_grader.overview import get_report_overview
+    return get_report_overview(current_app).context(current_app, mode)
+
 
 def parse_japanese_date(date_str):
     """
@@ -0,0 +1,309 @@
+"""
+レポート一覧 (report_overview.html) の得点・提出状況・遅延・学生番号の表を計算する。
+提出物の情報を (レポート, 学生, 種類) ごとに1行の縦長の表にまとめ、
+倍率の規則 (RATIO_DETAIL_ONLY など) を列単位の演算で適用してから、
+レポートを列にした表に一度だけ並べ替える。
+Flaskに依存しないので、単体でも呼び出せる。
+"""
+import numpy as np
+import pandas as pd
+
+KIND_DETAIL = "詳細"
+KIND_ANSWER = "解答のみ"
+
+# parse_japanese_date と同じ形式（例: 2025年 10月 9日(木曜日) 17:23）
+DATE_PATTERN = r'(\d{4})年\s*(\d{1,2})月\s*(\d{1,2})日.*?\s*(\d{1,2}):(\d{1,2})'
+
+GRADE_LETTERS = ['S', 'A', 'B', 'C', 'D']
+
+# 表の種類ごとの、提出していない学生の値（名簿内の学生の表で使う）
+VIEW_FILL_VALUES = {"score": 0, "status": "×", "late": "", "id": -1}
+
+# 設定の既定値（load_report_settings と同じ）
+DEFAULT_SETTINGS = {
+    'THRESHOLD_S': 90,
+    'THRESHOLD_A': 80,
+    'THRESHOLD_B': 70,
+    'THRESHOLD_C': 60,
+    'RATIO_DETAIL_ONLY': 0.5,
+    'RATIO_ANSWER_ONLY': 0.5,
+    'RATIO_LATE': 0.8,
+    'RATIO_DUPLICATE': 0.6,
+    'RATIO_VERY_LATE': 0.6,
+    'DELAY_THRESHOLD_DAYS': 15,
+}
+
+# 提出物の得点の計算に使う設定（変わったら倍率の適用からやり直す）
+RATIO_SETTINGS = [
+    'RATIO_DETAIL_ONLY', 'RATIO_ANSWER_ONLY', 'RATIO_LATE', 'RATIO_DUPLICATE', 'RATIO_VERY_LATE', 'DELAY_THRESHOLD_DAYS',
+]
+# 評価の閾値（変わったら評価をつけ直すだけでよい）
+THRESHOLD_SETTINGS = ['THRESHOLD_S', 'THRESHOLD_A', 'THRESHOLD_B', 'THRESHOLD_C']
+
+# 縦長の表の列
+FACT_COLUMNS = [
+    "report_index", "report", "student_index", "student", "number", "name",
+    "kind", "submitted", "submitted_at", "deadline", "is_same", "base_score",
+]
+
+
+def parse_japanese_dates(values):
+    """日付の文字列の Series を datetime の Series に変換する（読み取れないものは NaT）"""
+    parts = values.astype(object).where(values.notna(), "").astype(str).str.extract(DATE_PATTERN)
+    parts.columns = ["year", "month", "day", "hour", "minute"]
+    return pd.to_datetime(parts.astype(float), errors='coerce')
+
+
+def build_fact_table(rows):
+    """(レポート, 学生, 種類) ごとの提出物の情報の dict のリストから、縦長の表を作る"""
+    facts = pd.DataFrame(rows, columns=FACT_COLUMNS)
+    # 得点は int と float が混ざっているので、型を保つため object のまま持つ
+    facts["base_score"] = facts["base_score"].astype(object)
+    return facts
+
+
+def compute_submissions(facts, settings):
+    """
+    縦長の表に倍率の規則を適用し、(レポート, 学生) ごとに1行の表を返す。
+    列: report_index, report, student_index, number, name, status, late, value
+    """
+    keys = ["report_index", "student_index"]
+    submitted = facts["submitted"].astype(bool)
+    submitted_at = parse_japanese_dates(facts["submitted_at"])
+    deadline = parse_japanese_dates(facts["deadline"])
+    invalid = submitted & (submitted_at.isna() | deadline.isna())
+    if invalid.any():
+        row = facts[invalid].iloc[0]
+        raise ValueError(f"日付形式が正しくありません: {row['report']} {row['student']} {row['kind']}")
+    delay = (submitted_at - deadline).where(submitted & (submitted_at > deadline))
+
+    per_kind = facts[keys].assign(submitted=submitted, delay=delay)
+    detail = per_kind[facts["kind"] == KIND_DETAIL].set_index(keys)
+    answer = per_kind[facts["kind"] == KIND_ANSWER].set_index(keys)
+
+    table = facts.drop_duplicates(keys).set_index(keys)[["report", "number", "name", "is_same", "base_score"]]
+    sub_detail = detail["submitted"].reindex(table.index, fill_value=False).astype(bool).to_numpy()
+    sub_answer = answer["submitted"].reindex(table.index, fill_value=False).astype(bool).to_numpy()
+    is_same = table["is_same"].fillna(False).astype(bool).to_numpy()
+
+    # 遅延は、詳細と解答のみのうち遅い方
+    delay = pd.concat(
+        [detail["delay"].reindex(table.index), answer["delay"].reindex(table.index)], axis=1
+    ).max(axis=1)
+    is_late = delay.notna().to_numpy()
+    is_very_late = (delay > pd.Timedelta(days=settings['DELAY_THRESHOLD_DAYS'])).to_numpy()
+
+    conditions = [sub_detail & sub_answer & is_same, sub_detail & sub_answer, sub_detail, sub_answer]
+    status = np.select(conditions, ["同", "◎", "詳", "答"], default="×")
+    ratio = np.select(
+        conditions,
+        [settings['RATIO_DUPLICATE'], 1.0, settings['RATIO_DETAIL_ONLY'], settings['RATIO_ANSWER_ONLY']],
+        default=0.0,
+    )
+    late_ratio = np.where(is_very_late, settings['RATIO_VERY_LATE'], np.where(is_late, settings['RATIO_LATE'], 1.0))
+    late = np.where(is_very_late, "大遅", np.where(is_late, "遅", ""))
+
+    base_score = table["base_score"].to_numpy()
+    value = base_score.astype(float) * ratio * late_ratio
+    # 倍率を掛けない点数（全て提出・遅延なしの整数の点数と、未提出の0点）は整数のまま
+    is_int = ~is_late & ((status == "×") | ((status == "◎") & np.array([isinstance(v, int) for v in base_score], dtype=bool)))
+    # round(x, 1) は numpy の丸めと結果が異なることがあるので、Pythonの round を使う
+    value = [int(v) if i else round(float(v), 1) for v, i in zip(value, is_int)]
+
+    result = table[["report", "number", "name"]].reset_index()
+    result["status"] = status
+    result["late"] = late
+    result["value"] = pd.Series(value, dtype=object)
+    return result
+
+
+def pivot_values(submissions, column, index, rows, report_list, fill=None):
+    """
+    (レポート, 学生) ごとの表の column 列を、行が rows（index 列の値）・列がレポートの表にする。
+    提出していない学生の値は fill（None なら NaN のまま）で埋める。列の型は推論しない (object のまま)。
+    """
+    # 整数が float にならないよう、object のまま並べ替える
+    values = submissions[index + ["report", column]].astype({column: object})
+    wide = values.pivot(index=index, columns="report", values=column) if len(values) else pd.DataFrame()
+    wide = wide.reindex(index=rows, columns=report_list).astype(object)
+    if fill is not None:
+        # 未提出がある列は、元の値が整数でも float になる
+        wide = wide.fillna(float(fill) if isinstance(fill, int) else fill)
+    wide.columns.name = None
+    return wide.reset_index(drop=True)
+
+
+def pivot_view(submissions, column, index, rows, report_list, fill=None):
+    """
+    pivot_values の表の列ごとに型を推論させる。
+    列の型は、値が全て整数なら int、小数や NaN が混ざれば float になる（DataFrame の推論と同じ）。
+    """
+    return pivot_values(submissions, column, index, rows, report_list, fill).infer_objects()
+
+
+def split_view_rows(df_students, submissions, report_list):
+    """
+    (レポート, 学生) ごとの表を、名簿内の学生の行と名簿外の学生の行に分け、
+    (名簿内の行, 名簿外の行, 名簿外の学生の (学籍番号, 氏名) の並び) を返す
+    """
+    enrolled_rows = submissions[submissions["number"].isin(df_students["学籍番号"])]
+    # 同じ学籍番号の学生が複数いる場合は、最初の学生の値を使う
+    enrolled_rows = enrolled_rows.drop_duplicates(["number", "report"])
+    unlisted_rows = submissions[~submissions["number"].isin(df_students["学籍番号"])]
+
+    # 名簿外の学生は、レポートが2つ以上あれば (学籍番号, 氏名) の順、1つなら提出の順に並べる
+    keys = list(dict.fromkeys(zip(unlisted_rows["number"], unlisted_rows["name"])))
+    if len(report_list) > 1:
+        keys = sorted(keys)
+    return enrolled_rows, unlisted_rows, keys
+
+
+def build_views(df_students, submissions, report_list):
+    """
+    名簿内の学生と名簿外の学生それぞれについて、
+    得点 (score)・提出状況 (status)・遅延 (late)・学生番号 (id) の表を作る。
+    patch_scores で得点だけを書き換えられるよう、得点の表の型を推論する前の値 (score_values) と、
+    (レポート, 学生) ごとの表の行が得点の表のどの行に入るか (score_rows) も返す。
+    """
+    columns = {"score": "value", "status": "status", "late": "late", "id": "student_index"}
+    enrolled_rows, unlisted_rows, keys = split_view_rows(df_students, submissions, report_list)
+    unlisted_index = pd.MultiIndex.from_tuples(keys, names=["number", "name"]) if keys else pd.MultiIndex.from_arrays([[], []], names=["number", "name"])
+    df_unlisted = pd.DataFrame({"学籍番号": [k[0] for k in keys], "氏名": [k[1] for k in keys]}, dtype=object).infer_objects()
+
+    enrolled = {}
+    unlisted = {}
+    for view, column in columns.items():
+        wide = pivot_values(enrolled_rows, column, ["number"], df_students["学籍番号"], report_list, VIEW_FILL_VALUES[view])
+        enrolled[view] = pd.concat([df_students.reset_index(drop=True), wide.infer_objects()], axis=1)
+        if view == "score":
+            enrolled["score_values"] = wide
+        wide = pivot_values(unlisted_rows, column, ["number", "name"], unlisted_index, report_list)
+        unlisted[view] = pd.concat([df_unlisted, wide.infer_objects()], axis=1)
+        if view == "score":
+            unlisted["score_values"] = wide
+
+    # 名簿に同じ学籍番号が複数あれば、その全ての行に同じ値が入る
+    roster = {}
+    for pos, number in enumerate(df_students["学籍番号"]):
+        roster.setdefault(number, []).append(pos)
+    enrolled["score_rows"] = {i: roster[number] for i, number in zip(enrolled_rows.index, enrolled_rows["number"])}
+    unlisted_positions = {key: pos for pos, key in enumerate(keys)}
+    unlisted["score_rows"] = {
+        i: [unlisted_positions[key]] for i, key in zip(unlisted_rows.index, zip(unlisted_rows["number"], unlisted_rows["name"]))
+    }
+    return enrolled, unlisted
+
+
+def patch_scores(views, submissions, changed, report_list):
+    """
+    build_views と add_averages で作った表 (views) のうち、submissions の changed 行目
+    （得点が変わった (レポート, 学生)）が入る得点のセルだけを書き換え、その行の平均点を計算し直す。
+    得点を書き換えた列の型は、build_views で作り直した場合と同じになるよう推論し直す。
+    """
+    df, values = views["score"], views["score_values"]
+    rows = set()
+    columns = set()
+    for i in changed:
+        for pos in views["score_rows"].get(i, []):
+            values.iat[pos, values.columns.get_loc(submissions.at[i, "report"])] = submissions.at[i, "value"]
+            rows.add(pos)
+            columns.add(submissions.at[i, "report"])
+    for report in columns:
+        df[report] = values[report].infer_objects()
+    if rows:
+        rows = sorted(rows)
+        df.loc[rows, '平均点'] = df.loc[rows, report_list].mean(axis=1).round(1)
+
+
+def assign_grades(scores, settings):
+    """平均点から評価 (S/A/B/C/D) を求める"""
+    conditions = [
+        scores >= settings['THRESHOLD_S'],
+        scores >= settings['THRESHOLD_A'],
+        scores >= settings['THRESHOLD_B'],
+        scores >= settings['THRESHOLD_C'],
+    ]
+    return pd.Series(np.select(conditions, GRADE_LETTERS[:4], default='D'), index=scores.index, dtype=object)
+
+
+def count_absences(records):
+    """出席の記録 (get_attendance の enrolled / unlisted) から、学籍番号ごとの欠席回数の表を作る"""
+    attendance = pd.DataFrame(records)
+    if '判定' in attendance.columns:
+        attendance = attendance.drop(columns=['判定'])
+    attendance["欠席回数"] = (attendance == '×').sum(axis=1)
+    if '学籍番号' not in attendance.columns:
+        attendance['学籍番号'] = pd.Series(dtype=object)
+    return attendance[["学籍番号", "欠席回数"]]
+
+
+def add_averages(views, report_list):
+    """得点の表に平均点の列を加える（空の表はそのまま）"""
+    df = views["score"]
+    if not df.empty:
+        # report_list に含まれる列（各課題の点数）だけで平均を計算
+        df['平均点'] = df[report_list].mean(axis=1).round(1)
+
+
+def build_view_records(enrolled, unlisted):
+    """得点以外の表（提出状況・遅延・学生番号）を report_overview.html に渡す形にする"""
+    context = {}
+    for view in ["status", "late", "id"]:
+        context[f"enrolled_{view}"] = enrolled[view].sort_values('original_order').to_dict(orient='records')
+        context[f"unlisted_{view}"] = unlisted[view].to_dict(orient='records')
+    return context
+
+
+def grade_scores(enrolled_score, unlisted_score, absences, settings):
+    """
+    平均点から評価をつけ、欠席回数を加える。評価の閾値が変わったときはここだけをやり直せばよい。
+    absences: 名簿内と名簿外の count_absences の表の組。
+    引数の表は書き換えない。
+    """
+    stats = {}
+    df_students_score = enrolled_score.copy()
+    if not df_students_score.empty:
+        df_students_score['評価'] = assign_grades(df_students_score['平均点'], settings)
+
+        counts = df_students_score['評価'].value_counts()
+        total = len(df_students_score)
+        for grade in GRADE_LETTERS:
+            count = int(counts.get(grade, 0))
+            ratio = round((count / total) * 100, 1) if total > 0 else 0
+            stats[grade] = {'count': count, 'ratio': ratio}
+
+    df_unlisted_score = unlisted_score.copy()
+    if not df_unlisted_score.empty:
+        df_unlisted_score['評価'] = assign_grades(df_unlisted_score['平均点'], settings)
+
+    df_students_score = pd.merge(df_students_score, absences[0], on='学籍番号', how='left')
+    df_unlisted_score = pd.merge(df_unlisted_score, absences[1], on='学籍番号', how='left')
+    df_students_score = df_students_score.sort_values('original_order')
+
+    return {
+        "enrolled": df_students_score.to_dict(orient='records'),
+        "unlisted": df_unlisted_score.to_dict(orient='records'),
+        "columns": df_students_score.columns.tolist(),
+        "stats": stats,
+    }
+
+
+def build_overview_context(facts, df_students, report_list, attendance, settings, mode='scores'):
+    """
+    report_overview.html に渡す context を作る。
+    facts: build_fact_table の表, df_students: get_enrolled_students の名簿,
+    attendance: get_attendance の戻り値, settings: 倍率と評価の閾値
+    """
+    settings = dict(DEFAULT_SETTINGS, **settings)
+    submissions = compute_submissions(facts, settings)
+
+    enrolled, unlisted = build_views(df_students, submissions, report_list)
+    add_averages(enrolled, report_list)
+    add_averages(unlisted, report_list)
+
+    absences = (count_absences(attendance['enrolled']), count_absences(attendance['unlisted']))
+    context = grade_scores(enrolled["score"], unlisted["score"], absences, settings)
+    context.update(build_view_records(enrolled, unlisted))
+    context["report_list"] = report_list
+    context["mode"] = mode
+    return context
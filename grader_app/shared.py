@@ -0,0 +1,362 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# 古いイベントを消すときに残しておく件数
+EVENT_RETENTION = 10000
+# 自動保存の通し番号を覚えておく期間（秒）。これより長く使われていないタブのものは消す
+CLIENT_SEQ_RETENTION = 7 * 24 * 60 * 60
+
+
+class SharedState:
+    """
+    複数のワーカープロセス (gunicorn) で動かすときに、プロセス間で共有する状態。SQLite (WAL) のファイルに置く。
+      - 値: レポートの一覧 (PDF_LIST・RAW_PDF_LIST・CODE_LIST) と評価の設定。書き込むたびに version が1増える
+      - イベント: 採点結果・問題の設定の保存と、レポートの再読み込み。各プロセスは自分のキャッシュを無効化する
+      - zipの展開: フォロワーからリーダーへの展開の依頼（イベント "extract"）と、リーダーの展開の進み具合（値 "extract_status"）
+      - 自動保存の通し番号: ビューアのタブ・学生ごとに、最後に反映した変更の通し番号（どのプロセスが受け取っても同じ判定にする）
+    学生名簿・提出物の索引・採点結果の集計は、もともとファイルの更新時刻で変更を検出するので、ここには置かない。
+    各プロセスはリクエストの最初に changes を呼び、他のプロセスが書き込んだものを取り込む。
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS shared_values (
+        key TEXT PRIMARY KEY,
+        version INTEGER NOT NULL,
+        value TEXT NOT NULL
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS events (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        pid INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        report TEXT,
+        student TEXT
+    );
+    CREATE TABLE IF NOT EXISTS client_seqs (
+        client TEXT NOT NULL,
+        report_type TEXT NOT NULL,
+        report TEXT NOT NULL,
+        student TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        updated REAL NOT NULL,
+        PRIMARY KEY (client, report_type, report, student)
+    ) WITHOUT ROWID;
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+        self._versions = {}
+        self._last_seq = self._max_seq()
+        self._seq_writes = 0
+        # フォークしたワーカーで、親プロセスの接続を使い回さない
+        os.register_at_fork(after_in_child=self._reset_connections)
+
+    def _reset_connections(self):
+        self._local = threading.local()
+
+    def _connect(self):
+        # sqlite3 の接続はスレッドをまたいで使えないので、スレッドごとに作る
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _max_seq(self):
+        row = self._connect().execute("SELECT MAX(seq) FROM events").fetchone()
+        return row[0] or 0
+
+    def publish(self, key, value):
+        """値を書き込む（自分のプロセスには changes で返さない）"""
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT INTO shared_values (key, version, value) VALUES (?, 1, ?) "
+                "ON CONFLICT (key) DO UPDATE SET version = version + 1, value = excluded.value",
+                (key, json.dumps(value, ensure_ascii=False)),
+            )
+            version = conn.execute("SELECT version FROM shared_values WHERE key = ?", (key,)).fetchone()[0]
+        with self._lock:
+            self._versions[key] = version
+
+    def get(self, key, default=None):
+        """他のプロセスが書き込んだ値を、changes を待たずに読む"""
+        row = self._connect().execute("SELECT value FROM shared_values WHERE key = ?", (key,)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def notify(self, kind, report=None, student=None):
+        """イベントを書き込む（自分のプロセスには changes で返さない）"""
+        conn = self._connect()
+        with conn:
+            seq = conn.execute(
+                "INSERT INTO events (pid, kind, report, student) VALUES (?, ?, ?, ?)",
+                (os.getpid(), kind, report, student),
+            ).lastrowid
+            if seq % 1000 == 0:
+                conn.execute("DELETE FROM events WHERE seq <= ?", (seq - EVENT_RETENTION,))
+
+    def claim_client_seq(self, client, report_type, report, student, seq):
+        """
+        seq が最後に反映した変更の通し番号より新しければ、seq を記録して (True, 前の通し番号) を返す。
+        古ければ何も書かずに (False, 前の通し番号) を返す。比べて書くまでを1つのトランザクションで行うので、
+        同じ変更が別々のワーカープロセスに同時に届いても、記録できるのは片方だけになる。前の通し番号が無ければ None。
+        """
+        conn = self._connect()
+        now = time.time()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT seq FROM client_seqs WHERE client = ? AND report_type = ? AND report = ? AND student = ?",
+                (client, report_type, report, student),
+            ).fetchone()
+            previous = None if row is None else row[0]
+            if previous is not None and seq <= previous:
+                return False, previous
+            conn.execute(
+                "INSERT INTO client_seqs (client, report_type, report, student, seq, updated) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (client, report_type, report, student) DO UPDATE SET seq = excluded.seq, updated = excluded.updated",
+                (client, report_type, report, student, seq, now),
+            )
+            self._seq_writes += 1
+            if self._seq_writes % 1000 == 0:
+                conn.execute("DELETE FROM client_seqs WHERE updated < ?", (now - CLIENT_SEQ_RETENTION,))
+        return True, previous
+
+    def release_client_seq(self, client, report_type, report, student, seq, previous):
+        """claim_client_seq で記録した seq を、反映できなかったので前の通し番号に戻す（その後に新しい seq が記録されていればそのまま）"""
+        conn = self._connect()
+        key = (client, report_type, report, student)
+        with conn:
+            if previous is None:
+                conn.execute(
+                    "DELETE FROM client_seqs WHERE client = ? AND report_type = ? AND report = ? AND student = ? AND seq = ?",
+                    key + (seq,),
+                )
+            else:
+                conn.execute(
+                    "UPDATE client_seqs SET seq = ? WHERE client = ? AND report_type = ? AND report = ? AND student = ? AND seq = ?",
+                    (previous,) + key + (seq,),
+                )
+
+    def changes(self):
+        """
+        前回からの他のプロセスの変更を ({キー: 値}, [(種類, レポート名, 学生名), ...]) で返す。
+        古いイベントが消されていて取りこぼした場合、イベントのリストは None になる（キャッシュを全て捨てること）。
+        """
+        conn = self._connect()
+        with self._lock:
+            values = {}
+            with conn:
+                # 値とイベントを同じスナップショットから読む
+                conn.execute("BEGIN")
+                for key, version in conn.execute("SELECT key, version FROM shared_values").fetchall():
+                    if self._versions.get(key) != version:
+                        row = conn.execute("SELECT version, value FROM shared_values WHERE key = ?", (key,)).fetchone()
+                        self._versions[key] = row[0]
+                        values[key] = json.loads(row[1])
+                rows = conn.execute(
+                    "SELECT seq, pid, kind, report, student FROM events WHERE seq > ? ORDER BY seq", (self._last_seq,)
+                ).fetchall()
+            events = []
+            if rows and rows[0][0] > self._last_seq + 1:
+                events = None
+            for seq, pid, kind, report, student in rows:
+                if events is not None and pid != os.getpid():
+                    events.append((kind, report, student))
+                self._last_seq = seq
+            return values, events
+
+
+def create_shared_state(app):
+    """設定 (SHARED_STATE_ENABLED) に応じて SharedState を作成し、app.config に登録する"""
+    if not app.config.get('SHARED_STATE_ENABLED', False):
+        app.config['SHARED_STATE'] = None
+        return None
+    shared = SharedState(app.config['SHARED_STATE_PATH'])
+    app.config['SHARED_STATE'] = shared
+    return shared
+
+
+def publish_report_lists(app):
+    shared = app.config.get('SHARED_STATE')
+    if shared is None:
+        return
+    shared.publish("report_lists", {
+        "PDF_LIST": app.config['PDF_LIST'],
+        "RAW_PDF_LIST": app.config['RAW_PDF_LIST'],
+        "CODE_LIST": app.config['CODE_LIST'],
+    })
+
+
+def publish_report_settings(app, settings):
+    shared = app.config.get('SHARED_STATE')
+    if shared is None:
+        return
+    shared.publish("report_settings", settings)
+
+
+def publish_extract_status(app):
+    shared = app.config.get('SHARED_STATE')
+    extractor = app.config.get('ZIP_EXTRACTOR')
+    if shared is None or extractor is None:
+        return
+    shared.publish("extract_status", extractor.shared_status())
+
+
+def notify_change(app, kind, report=None, student=None):
+    """
+    他のプロセスにキャッシュの無効化を伝える。
+    kind は "grade"（学生の採点結果）, "problems"（問題の設定）, "reload"（レポートの再読み込み）
+    """
+    shared = app.config.get('SHARED_STATE')
+    if shared is None:
+        return
+    shared.notify(kind, report, student)
+
+
+def sync_shared_state(app):
+    """他のプロセスの変更を、このプロセスの app.config とキャッシュに取り込む"""
+    shared = app.config.get('SHARED_STATE')
+    if shared is None:
+        return
+    from grader_app.utils import REPORT_LIST_LOCK
+    from grader_app.pdf_grader.catalog import get_catalog
+
+    values, events = shared.changes()
+    lists = values.get("report_lists")
+    if lists is not None:
+        with REPORT_LIST_LOCK:
+            app.config.update(lists)
+            get_catalog(app).update([r for r in lists["RAW_PDF_LIST"] if r is not None])
+    settings = values.get("report_settings")
+    if settings is not None:
+        app.config.update(settings)
+
+    overview = app.config.get('REPORT_OVERVIEW')
+    if events is None or any(kind == "reload" for kind, _, _ in events):
+        from grader_app.models import get_grade_store
+        from grader_app.pdf_grader.utils import get_roster_cache
+        get_roster_cache(app).clear()
+        get_grade_store(app).clear_cache()
+        if overview is not None:
+            overview.clear()
+        return
+    if overview is None:
+        return
+    for kind, report, student in events:
+        if kind == "grade":
+            overview.grade_changed(report, student)
+        elif kind == "problems":
+            overview.problems_changed(report)
+
+
+def acquire_background_lock(app):
+    """
+    BACKGROUND_LOCK_PATH のロックを取れたら True を返す（プロセスが終わるまで持ち続ける）。
+    複数のプロセスで共有しない設定のときや、fcntl が使えない環境（1プロセスで動かす waitress など）では常に True。
+    """
+    if app.config.get('SHARED_STATE') is None or fcntl is None:
+        return True
+    f = open(app.config['BACKGROUND_LOCK_PATH'], 'a')
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return False
+    app.config['BACKGROUND_LOCK'] = f
+    return True
+
+
+_START_LOCK = threading.Lock()
+
+
+def start_background_services(app):
+    """
+    画像の事前生成・zipの展開・フォルダの監視を起動する（2回目以降は何もしない）。
+    複数のワーカープロセスで動かすときは、ロックを取れた1つのプロセス（リーダー）だけが起動する。
+    他のプロセス（フォロワー）は画像の事前生成を使わず、必要になった画像をその場で作る。
+    zipの展開はリーダーに依頼し、進み具合はリーダーが共有したものを表示する
+    （プロセス間で共有しない設定なら、フォロワーはその場で展開する）。
+    """
+    from grader_app.archive import ZipExtractor, SharedZipExtractor
+
+    with _START_LOCK:
+        role = app.config.get('BACKGROUND_ROLE')
+        if role is None:
+            role = "leader" if acquire_background_lock(app) else "follower"
+            app.config['BACKGROUND_ROLE'] = role
+            if role == "leader" and app.config.get('SHARED_STATE') is not None:
+                print(f"このプロセス (pid {os.getpid()}) で画像の事前生成・zipの展開・フォルダの監視を行います。")
+        if role == "follower":
+            app.config['PRERENDERER'] = None
+            # 起動しない ZipExtractor に渡したzipは展開されないので、使い続けない
+            # （起動時のスキャンで見つけたzipは、リーダーも自分のスキャンで展開する）
+            if isinstance(app.config.get('ZIP_EXTRACTOR'), ZipExtractor):
+                shared = app.config.get('SHARED_STATE')
+                app.config['ZIP_EXTRACTOR'] = SharedZipExtractor(shared, app.config.get('UNZIP_WORKERS', 1)) if shared is not None else None
+            return
+        if app.config.get('BACKGROUND_STARTED'):
+            return
+        app.config['BACKGROUND_STARTED'] = True
+    for name in ('PRERENDERER', 'ZIP_EXTRACTOR', 'REPORT_WATCHER'):
+        service = app.config.get(name)
+        if service is not None:
+            service.start()
+    # 前回のリーダーが残した展開の進み具合を消しておく
+    publish_extract_status(app)
+    receive_extract_requests(app)
+
+
+def receive_extract_requests(app):
+    """
+    リーダーで、フォロワーから送られたzipの展開の依頼 ("extract" イベント) を WATCH_INTERVAL 秒ごとに受け取り、展開する。
+    リクエストごとの sync_shared_state とイベントの読み込み位置を分けるため、SharedState をもう1つ開く。
+    """
+    extractor = app.config.get('ZIP_EXTRACTOR')
+    if app.config.get('SHARED_STATE') is None or extractor is None:
+        return
+    requests = SharedState(app.config['SHARED_STATE_PATH'])
+    interval = app.config.get('WATCH_INTERVAL', 2.0)
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                _, events = requests.changes()
+            except sqlite3.Error as e:
+                print(f"エラー: zipの展開の依頼を読めませんでした。エラー: {e}")
+                continue
+            for kind, zip_path, folder_path in events or []:
+                # 展開し終わったものを、もう一度展開しない
+                if kind == "extract" and not os.path.exists(folder_path):
+                    extractor.schedule(zip_path, folder_path)
+
+    threading.Thread(target=run, name="extract-requests", daemon=True).start()
+
+
+def warm_caches(app):
+    """学生名簿と採点結果の集計を読み込んでおく（gunicorn の preload_app なら、フォークする前に1回だけ）"""
+    from grader_app.pdf_grader.utils import get_students
+    from grader_app.utils import get_finished_status
+    with app.test_request_context():
+        for report_index, report_name in enumerate(app.config['PDF_LIST']):
+            if report_name is None:
+                continue
+            try:
+                get_finished_status('pdf', report_name, get_students(report_index))
+            except Exception as e:
+                print(f"エラー: {report_name} のキャッシュを作れませんでした。エラー: {e}")
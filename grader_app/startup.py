@@ -0,0 +1,120 @@
+import os
+import sys
+import json
+import threading
+import subprocess
+
+import click
+
+from grader_app.utils import refresh_app_config
+
+# 起動時 (create_app) に読み込まれてはいけない、読み込みに時間がかかるパッケージ
+# （使う関数の中で import する）
+HEAVY_MODULES = ("pandas", "numpy", "PIL", "pdf2image", "openpyxl", "jupyter_client", "zmq")
+
+# check-startup が子プロセスで実行するスクリプト。
+# 最初のリクエストで画像の事前生成などが起動しないよう、BACKGROUND_ROLE を先に決めておく
+STARTUP_SCRIPT = """
+import json, time
+start = time.perf_counter()
+from grader_app import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+app.config['BACKGROUND_ROLE'] = 'follower'
+client = app.test_client()
+timings = {"import": imported - start, "create_app": created - imported}
+for path in ("/", "/pdf/"):
+    t = time.perf_counter()
+    status = client.get(path).status_code
+    timings[path] = time.perf_counter() - t
+    if status != 200:
+        raise SystemExit(f"{path} returned {status}")
+timings["total"] = time.perf_counter() - start
+print(json.dumps(timings))
+"""
+
+
+def start_report_scan(app):
+    """
+    起動時のフォルダのスキャン (refresh_app_config) を行う。
+    STARTUP_SCAN が "background" なら別のスレッドで行い、終わるまでは空のレポートの一覧で応答する。
+    終わったかどうかは app.config['REPORT_SCAN_DONE'] (threading.Event) でわかる。
+    """
+    done = threading.Event()
+    app.config['REPORT_SCAN_DONE'] = done
+
+    def scan():
+        try:
+            with app.app_context():
+                refresh_app_config(app)
+        except Exception as e:
+            print(f"エラー: 提出フォルダを読み込めませんでした。エラー: {e}")
+        finally:
+            done.set()
+
+    if app.config.get('STARTUP_SCAN', 'sync') == 'sync':
+        scan()
+        return
+    threading.Thread(target=scan, name="report-scan", daemon=True).start()
+
+
+def is_report_scan_done(app):
+    done = app.config.get('REPORT_SCAN_DONE')
+    return done is None or done.is_set()
+
+
+def wait_for_report_scan(app):
+    """起動時のフォルダのスキャンが終わるまで待つ"""
+    done = app.config.get('REPORT_SCAN_DONE')
+    if done is not None:
+        done.wait()
+
+
+def parse_importtime(stderr):
+    """python -X importtime の出力から、読み込まれたモジュールごとの (自身の時間, 累計の時間) をマイクロ秒で返す"""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue  # 見出しの行
+        name = parts[2].strip()
+        modules[name] = (int(parts[0]), int(parts[1]))
+    return modules
+
+
+def register_startup_commands(app):
+    """起動時間を確かめるコマンド (flask --app run check-startup) を登録する"""
+
+    @app.cli.command("check-startup")
+    @click.option("--max-ms", default=1000, show_default=True, help="起動してから / と /pdf/ に応答し終わるまでの時間の上限（ミリ秒）")
+    @click.option("--top", default=10, show_default=True, help="読み込みに時間がかかったモジュールを何個表示するか")
+    def check_startup(max_ms, top):
+        """
+        python -X importtime の子プロセスで create_app から最初のリクエストまでを実行し、
+        HEAVY_MODULES が起動時に読み込まれていないこと、応答までの時間が --max-ms 以内であることを確かめる。
+        """
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", STARTUP_SCRIPT],
+            cwd=os.path.dirname(app.root_path), capture_output=True, text=True,
+        )
+        if result.returncode != 0:
+            raise click.ClickException(f"起動に失敗しました。\n{result.stderr[-2000:]}")
+        timings = json.loads(result.stdout.strip().splitlines()[-1])
+        modules = parse_importtime(result.stderr)
+
+        click.echo("読み込みに時間がかかったモジュール（累計, ms）:")
+        packages = {name: cumulative for name, (_, cumulative) in modules.items() if "." not in name}
+        for name, cumulative in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+            click.echo(f"  {name:<30} {cumulative / 1000:8.1f}")
+        for name in ("import", "create_app", "/", "/pdf/", "total"):
+            click.echo(f"{name:<12} {timings[name] * 1000:8.1f} ms")
+
+        heavy = sorted({name.split(".")[0] for name in modules if name.split(".")[0] in HEAVY_MODULES})
+        if heavy:
+            raise click.ClickException(f"起動時に読み込まれています: {', '.join(heavy)}（使う関数の中で import してください）")
+        if timings["total"] * 1000 > max_ms:
+            raise click.ClickException(f"起動してから応答するまでに {timings['total'] * 1000:.0f} ms かかりました（上限 {max_ms} ms）。")
+        click.echo("OK")
@@ -1,34 +1,34 @@
 document.addEventListener('DOMContentLoaded', async () => {
-  // 1. 対象となる全要素を取得
-  const statusElements = document.querySelectorAll('.status-text');
+  const list = document.getElementById('report-list');
+  if (!list) return;
 
-  // 2. for...of ループで一つずつ順番に処理
-  for (const el of statusElements) {
-    const url = el.dataset.checkUrl; // HTMLの data-check-url を取得
-    const statusId = el.id;
-
-    try {
-      // fetchが完了するまで次のループへは進みません
-      const response = await fetch(url);
-      
-      if (!response.ok) throw new Error('Network response was not ok');
-      
-      const data = await response.json();
-
-      // 3. 結果に応じて表示を更新
-      // 例: サーバーが { "finished": true } のようなJSONを返すと想定
-      if (data.all_finished) {
-        el.innerHTML = '<i class="bi bi-check-square-fill"></i>';
-        el.classList.remove('text-secondary');
-        el.classList.add('text-success');
-      } else {
-        el.innerHTML = '';
-        el.classList.remove('text-secondary');
-      }
+  // 全てのレポートの採点の進み具合を1回のリクエストで受け取る
+  // サーバーは { "reports": [{ "report_index": 0, "finished": 10, "total": 12, "all_finished": false }, ...] } を返す
+  let reports;
+  try {
+    const response = await fetch(list.dataset.statusUrl);
+    if (!response.ok) throw new Error('Network response was not ok');
+    reports = (await response.json()).reports;
+  } catch (error) {
+    console.error('エラー発生:', error);
+    list.querySelectorAll('.status-text').forEach((el) => {
+      el.innerHTML = '<i class="bi bi-exclamation-triangle text-danger"></i> エラー';
+    });
+    return;
+  }
 
-    } catch (error) {
-      console.error(`エラー発生 (${statusId}):`, error);
+  const byIndex = new Map(reports.map((r) => [r.report_index, r]));
+  list.querySelectorAll('.status-text').forEach((el) => {
+    const report = byIndex.get(Number(el.id.replace('status-', '')));
+    el.classList.remove('text-secondary');
+    if (!report || report.status === 'error') {
       el.innerHTML = '<i class="bi bi-exclamation-triangle text-danger"></i> エラー';
+    } else if (report.all_finished) {
+      el.innerHTML = '<i class="bi bi-check-square-fill"></i>';
+      el.classList.add('text-success');
+    } else {
+      el.textContent = `${report.finished} / ${report.total}`;
+      el.classList.add('text-secondary');
     }
-  }
+  });
 });
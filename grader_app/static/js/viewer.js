@@ -24,9 +24,62 @@ const AppSettings = {
 
 /**
  * 保存処理を管理するオブジェクト（連打対策・整合性維持）
+ *
+ * フォーム全体ではなく、変更された評価だけを通し番号 (seq) を付けて送る。
+ * 送信が終わるまでの変更は送信待ち (outbox) にまとめておき、次の送信で学生ごとにまとめて送る。
+ * 送信待ちは sessionStorage に置くので、ページを移動する前に送りきれなかった変更は、次のページで送られる。
+ * 他の採点者との競合は検出しない。同じ学生の同じ問題を同時に採点したときは、後から届いた評価が残り、
+ * 保存後に返ってくる採点結果でフォームを更新する（バージョンによる競合の検出 (409) は save_grades だけで行う）。
  */
 const AutoSaver = {
     timeoutId: null,
+    sending: false,
+    pending: false,
+    form: null,
+    studentIndex: null,
+    storageKey: null,
+    // フォームの評価（変更の検出用）: {name: value または null}
+    current: {},
+    // 保存が確認されていない変更: {学生番号: {seq, changes: {name: value または null}}}
+    outbox: {},
+
+    init(form) {
+        this.form = form;
+        this.studentIndex = form.dataset.studentIndex;
+        this.storageKey = 'grade_outbox:' + form.dataset.changesUrl;
+        this.outbox = JSON.parse(sessionStorage.getItem(this.storageKey) || '{}');
+        this.current = this.collect();
+        // 前のページで送りきれなかった変更があれば送る
+        if (Object.keys(this.outbox).length > 0) this.send();
+    },
+
+    collect() {
+        const grades = {};
+        this.form.querySelectorAll('input[type=radio]').forEach(r => {
+            if (!(r.name in grades)) grades[r.name] = null;
+            if (r.checked) grades[r.name] = r.value;
+        });
+        return grades;
+    },
+
+    clientId() {
+        let id = sessionStorage.getItem('grade_client_id');
+        if (!id) {
+            id = Date.now().toString(36) + Math.random().toString(36).slice(2);
+            sessionStorage.setItem('grade_client_id', id);
+        }
+        return id;
+    },
+
+    nextSeq() {
+        const seq = parseInt(sessionStorage.getItem('grade_seq') || '0') + 1;
+        sessionStorage.setItem('grade_seq', seq);
+        return seq;
+    },
+
+    persist() {
+        sessionStorage.setItem(this.storageKey, JSON.stringify(this.outbox));
+    },
 
     /**
      * 変更を通知し、適切なタイミングで送信を予約する
@@ -34,49 +87,122 @@ const AutoSaver = {
     trigger() {
         console.log('AutoSaver.trigger called');
 
+        // 前回からの変更分を送信待ちに加える
+        const latest = this.collect();
+        const changes = {};
+        Object.keys(latest).forEach(name => {
+            if (latest[name] !== this.current[name]) changes[name] = latest[name];
+        });
+        this.current = latest;
+        if (Object.keys(changes).length === 0) return;
+
+        const entry = this.outbox[this.studentIndex] || { changes: {} };
+        Object.assign(entry.changes, changes);
+        entry.seq = this.nextSeq();
+        this.outbox[this.studentIndex] = entry;
+        this.persist();
+
         clearTimeout(this.timeoutId);
         this.timeoutId = setTimeout(() => this.send(), 500);
 
     },
 
+    /**
+     * 予約中の送信があれば、すぐに送信する（ページを離れるとき用）
+     */
+    flush() {
+        if (this.timeoutId === null) return;
+        clearTimeout(this.timeoutId);
+        this.send();
+    },
+
     /**
      * サーバーへデータを送信する（一本道で実行）
      */
     async send() {
-        // すでに送信中の場合は、終わった後に再度呼ばれるのでスキップ
+        this.timeoutId = null;
+        // すでに送信中の場合は、終わった後に再度送信する
+        if (this.sending) {
+            this.pending = true;
+            return;
+        }
         console.log('AutoSaver.send called');
 
-        const form = document.getElementById('problems-form');
-        if (!form) return;
-
-        const formData = new FormData(form);
-        const grades = {};
-        formData.forEach((value, key) => { grades[key] = value; });
-        console.log('送信データ:', grades);
-
-        const saveDestination = form.getAttribute('data-save-url');
+        const students = Object.entries(this.outbox).map(([index, entry]) => ({
+            student_index: parseInt(index), seq: entry.seq, changes: entry.changes
+        }));
+        if (students.length === 0) return;
+        console.log('送信データ:', students);
 
+        this.sending = true;
         try {
-            const response = await fetch(saveDestination, {
+            const response = await fetch(this.form.dataset.changesUrl, {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ grades: grades }),
+                body: JSON.stringify({ client: this.clientId(), students: students }),
                 keepalive: true
             });
             const data = await response.json();
-            
+            if (!response.ok) throw new Error(data.message);
+
             console.log("保存完了:", data);
+            let finished = false;
+            data.results.forEach(result => {
+                const entry = this.outbox[result.student_index];
+                // 送信中に新しい変更が加わっていなければ、送信待ちから外す
+                if (entry && entry.seq <= result.seq) delete this.outbox[result.student_index];
+                if (String(result.student_index) === this.studentIndex) {
+                    this.refresh(result.grades);
+                    finished = (result.status === 'finished');
+                }
+            });
+            this.persist();
 
             // Flask側が「全問題採点済み」を返してきたら遷移チェック
-            if (data.status === 'finished') {
+            if (finished) {
                 handleAutoTransition();
             }
         } catch (error) {
             console.error("通信エラー:", error);
+        } finally {
+            this.sending = false;
+            if (this.pending) {
+                this.pending = false;
+                this.send();
+            }
         }
     },
+
+    /**
+     * 送信待ちの変更がない問題を、サーバーに保存されている評価（他の採点者の変更を含む）に合わせる
+     */
+    refresh(grades) {
+        const entry = this.outbox[this.studentIndex];
+        const pending = entry ? entry.changes : {};
+        let changed = false;
+        Object.keys(this.current).forEach(name => {
+            const value = grades[name] ?? null;
+            if (name in pending || this.current[name] === value) return;
+            this.form.querySelectorAll(`input[name="${name}"]`).forEach(r => {
+                r.checked = (r.value === value);
+            });
+            this.current[name] = value;
+            changed = true;
+        });
+        if (changed) showSaveStatus('他の採点者が保存した評価を反映しました。');
+    },
 };
 
+/**
+ * 保存に関するお知らせを表示する
+ */
+function showSaveStatus(message) {
+    const el = document.getElementById('save-status');
+    if (!el) return;
+    el.textContent = message;
+    setTimeout(() => { el.textContent = ''; }, 5000);
+}
+
 /**
  * 自動遷移のロジック
  */
@@ -97,6 +223,37 @@ async function handleAutoTransition() {
     }
 }
 
+/**
+ * 次に採点する学生の画像を <link rel=prefetch> でブラウザのキャッシュに載せておく
+ */
+async function prefetchNextImages() {
+    const el = document.getElementById('prefetch-list');
+    if (!el) return;
+
+    const urls = JSON.parse(el.dataset.prefetchUrls || '[]');
+    // 先頭（次に開く学生）から順番に処理する
+    for (const url of urls) {
+        try {
+            const response = await fetch(url);
+            if (!response.ok) continue;
+            const data = await response.json();
+            data.images.forEach(src => {
+                const link = document.createElement('link');
+                link.rel = 'prefetch';
+                link.href = src;
+                document.head.appendChild(link);
+            });
+        } catch (error) {
+            console.error("先読みエラー:", error);
+        }
+    }
+}
+
+// 表示中のページの読み込みを邪魔しないよう、load後に先読みを始める
+window.addEventListener('load', () => {
+    prefetchNextImages();
+});
+
 // 初期化処理
 document.addEventListener('DOMContentLoaded', () => {
     AppSettings.load();
@@ -109,6 +266,10 @@ document.addEventListener('DOMContentLoaded', () => {
     const form = document.getElementById('problems-form');
     if (!form) return;
 
+    AutoSaver.init(form);
+    // 保存を待っている変更があれば、ページを離れる前に送信する
+    window.addEventListener('pagehide', () => AutoSaver.flush());
+
     // フォーム内容が変更されたらトリガー
     form.addEventListener('change', () => {
         AutoSaver.trigger();
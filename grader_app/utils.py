@@ -1,12 +1,23 @@
 import os
 import zipfile
+import threading
 from flask import current_app
 import json
 import glob
+from grader_app.models import get_grade_store
+from grader_app.workbooks import get_workbook_cache
+from grader_app.archive import is_partial_dir
+from grader_app.shared import publish_report_lists, publish_report_settings, notify_change
 
-def unzip_if_needed_and_list_folders(target_dir):
+def unzip_if_needed_and_list_folders(target_dir, extractor=None, direct=False):
+    """
+    target_dir のzipを展開し、フォルダ名のリストを返す。
+    extractor (ZipExtractor) を渡すと展開はバックグラウンドで行い、展開中のものはリストに含めない。
+    direct=True なら展開せず、zipと同じ名前のフォルダとしてリストに含める（zipの中のファイルを直接読む）。
+    """
     print(f"Scanning directory: {target_dir}")
     # ディレクトリ内のファイルとフォルダを取得
+    unextracted = []
     for item in os.listdir(target_dir):
         if item.lower().endswith('.zip'):
             zip_path = os.path.join(target_dir, item)
@@ -15,40 +26,152 @@ def unzip_if_needed_and_list_folders(target_dir):
 
             # 対応するフォルダがない場合は解凍
             if not os.path.exists(folder_path):
-                with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                    zip_ref.extractall(folder_path)
+                if direct:
+                    unextracted.append(folder_name)
+                elif extractor is not None:
+                    extractor.schedule(zip_path, folder_path)
+                else:
+                    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+                        zip_ref.extractall(folder_path)
 
-    # フォルダ一覧を取得（.zipではないディレクトリ）
+    # フォルダ一覧を取得（.zipではないディレクトリ。展開中のものは除く）
     folder_list = [
         name for name in os.listdir(target_dir)
-        if os.path.isdir(os.path.join(target_dir, name))
+        if os.path.isdir(os.path.join(target_dir, name)) and not is_partial_dir(name)
     ]
     
-    return folder_list
+    return folder_list + unextracted
+
+# PDF_LIST・RAW_PDF_LIST・CODE_LIST を差分で更新するときのロック
+REPORT_LIST_LOCK = threading.Lock()
 
 def refresh_app_config(app=None):
-    """PDFとCodeのフォルダをスキャンしてconfigを更新する共通関数"""
+    """
+    PDFとCodeのフォルダをスキャンしてconfigを更新する共通関数。
+    一覧は作り直すので、削除されたレポートの跡 (None) はなくなり、レポートの番号は詰まる。
+    """
     if app is None:
         app = current_app
     
     from grader_app.pdf_grader.utils import get_report_list
+    from grader_app.pdf_grader.prerender import schedule_report_folders
+    from grader_app.pdf_grader.catalog import get_catalog
     from grader_app.code_grader.utils import extract_keys
 
     # PDFフォルダのスキャン
+    extractor = app.config.get('ZIP_EXTRACTOR')
     pdf_path = app.config['PDF_BASE_DIR']
-    raw_pdf_list = unzip_if_needed_and_list_folders(pdf_path)
+    raw_pdf_list = unzip_if_needed_and_list_folders(pdf_path, extractor, app.config.get('UNZIP_MODE') == 'direct')
     pdf_list = get_report_list(raw_pdf_list)
-    
-    app.config['PDF_LIST'] = pdf_list
-    app.config['RAW_PDF_LIST'] = raw_pdf_list
+    # 起動時のスキャンは別のスレッドで行うことがあるので、フォルダの監視による更新と混ざらないようにする
+    with REPORT_LIST_LOCK:
+        old_raw_pdf_list = app.config.get('RAW_PDF_LIST', [])
+        app.config['PDF_LIST'] = pdf_list
+        app.config['RAW_PDF_LIST'] = raw_pdf_list
+        get_catalog(app).update(raw_pdf_list)
+
+    # 新しく見つかったフォルダの画像をバックグラウンドで生成
+    new_raw_pdf_list = [r for r in raw_pdf_list if r not in old_raw_pdf_list]
+    schedule_report_folders(app, new_raw_pdf_list)
     
     # Codeフォルダのスキャン
     code_path = app.config['CODE_BASE_DIR']
-    raw_code_list = unzip_if_needed_and_list_folders(code_path)
-    app.config['CODE_LIST'] = sorted(raw_code_list, key=extract_keys)
+    raw_code_list = unzip_if_needed_and_list_folders(code_path, extractor)
+    code_list = sorted(raw_code_list, key=extract_keys)
+    with REPORT_LIST_LOCK:
+        app.config['CODE_LIST'] = code_list
+        publish_report_lists(app)
     
     print("Config reloaded: PDF and Code lists updated.")
 
+def apply_directory_changes(app, target_dir, added, removed):
+    """
+    PDF_BASE_DIR / CODE_BASE_DIR の直下で追加・削除されたもの（提出フォルダとzip）を、
+    PDF_LIST・RAW_PDF_LIST・CODE_LIST に差分で反映する。
+    開いているビューアのURLのレポートの番号が変わらないよう、新しいレポートは一覧の最後に加え、
+    削除されたものは PDF_LIST・RAW_PDF_LIST・CODE_LIST に None を残す（そのレポートのページは 404 になる）。
+    詰めて番号順に並べ直すには reload_reports を使う。
+    """
+    from grader_app.pdf_grader.utils import get_report_list, extract_keys as report_keys
+    from grader_app.pdf_grader.prerender import schedule_report_folders
+    from grader_app.pdf_grader.catalog import get_catalog
+    from grader_app.code_grader.utils import extract_keys
+
+    is_pdf = target_dir == app.config['PDF_BASE_DIR']
+    extractor = app.config.get('ZIP_EXTRACTOR')
+    direct = is_pdf and app.config.get('UNZIP_MODE') == 'direct'
+
+    added_folders = []
+    for name in added:
+        if not name.lower().endswith('.zip'):
+            added_folders.append(name)
+            continue
+        folder_name = os.path.splitext(name)[0]
+        folder_path = os.path.join(target_dir, folder_name)
+        if os.path.exists(folder_path):
+            continue
+        if direct:
+            added_folders.append(folder_name)
+        elif extractor is not None:
+            # 展開し終わったら、フォルダの追加として反映される
+            extractor.schedule(os.path.join(target_dir, name), folder_path)
+        else:
+            with zipfile.ZipFile(os.path.join(target_dir, name), 'r') as zip_ref:
+                zip_ref.extractall(folder_path)
+            added_folders.append(folder_name)
+
+    removed_folders = []
+    for name in removed:
+        if name.lower().endswith('.zip'):
+            # 展開せずに使っていたzipが削除された
+            folder_name = os.path.splitext(name)[0]
+            if not os.path.exists(os.path.join(target_dir, folder_name)):
+                removed_folders.append(folder_name)
+        elif not (direct and os.path.isfile(os.path.join(target_dir, name + ".zip"))):
+            # 展開済みのフォルダが削除されても、zipが残っていて直接読めるならそのまま使う
+            removed_folders.append(name)
+
+    with REPORT_LIST_LOCK:
+        if is_pdf:
+            old_raw_pdf_list = app.config.get('RAW_PDF_LIST', [])
+            new_raw_pdf_list = [r for r in dict.fromkeys(added_folders) if r not in old_raw_pdf_list]
+            raw_pdf_list = [None if r in removed_folders else r for r in old_raw_pdf_list] + new_raw_pdf_list
+            if raw_pdf_list == old_raw_pdf_list:
+                return
+            live_raw_pdf_list = [r for r in raw_pdf_list if r is not None]
+            reports = get_report_list(live_raw_pdf_list)
+            pdf_list = [r if r in reports else None for r in app.config['PDF_LIST']]
+            pdf_list += sorted([r for r in reports if r not in pdf_list], key=report_keys)
+            # 一覧を読んでいる途中のリクエストに影響しないよう、新しいリストに差し替える
+            app.config['RAW_PDF_LIST'] = raw_pdf_list
+            app.config['PDF_LIST'] = pdf_list
+            get_catalog(app).update(live_raw_pdf_list)
+            schedule_report_folders(app, new_raw_pdf_list)
+            publish_report_lists(app)
+            print(f"PDF list updated: {[r for r in pdf_list if r is not None]}")
+        elif target_dir == app.config['CODE_BASE_DIR']:
+            old_code_list = app.config.get('CODE_LIST', [])
+            code_list = [None if c in removed_folders else c for c in old_code_list]
+            code_list += sorted([c for c in dict.fromkeys(added_folders) if c not in code_list], key=extract_keys)
+            if code_list == old_code_list:
+                return
+            app.config['CODE_LIST'] = code_list
+            publish_report_lists(app)
+            print(f"Code list updated: {[c for c in code_list if c is not None]}")
+
+def abort_if_removed_report(list_key):
+    """
+    URLの report_index が、一覧 (PDF_LIST / CODE_LIST) の範囲外か削除されたレポート (None) なら 404 にする。
+    Blueprint の before_request から呼ぶ（共有された一覧を取り込んだ後に確かめる）。
+    """
+    from flask import request, abort
+    if not request.view_args or 'report_index' not in request.view_args:
+        return
+    report_index = request.view_args['report_index']
+    report_list = current_app.config[list_key]
+    if not 0 <= report_index < len(report_list) or report_list[report_index] is None:
+        abort(404)
+
 def load_problems_from_json(report_type, report_name):
     dirname = current_app.config[f'{report_type.upper()}_SAVE_DIR']
     DATA_FILE = os.path.join(dirname, f"{report_name}_problems.json")
@@ -58,27 +181,72 @@ def load_problems_from_json(report_type, report_name):
     # 初期構造
     return {"order": [], "problems": {}}
 
+# 読み込んだ *_problems.json のキャッシュ: パス -> ((更新時刻, サイズ), 問題の設定)
+PROBLEMS_CACHE = {}
+PROBLEMS_CACHE_LOCK = threading.Lock()
+
+def get_problems(report_type, report_name):
+    """
+    load_problems_from_json と同じものを返す。ファイルが変わっていなければ読み直さない。
+    返した dict は他のリクエストと共有するので、書き換えないこと（書き換える場合は load_problems_from_json を使う）。
+    """
+    dirname = current_app.config[f'{report_type.upper()}_SAVE_DIR']
+    DATA_FILE = os.path.join(dirname, f"{report_name}_problems.json")
+    try:
+        st = os.stat(DATA_FILE)
+        signature = (st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        signature = None
+    with PROBLEMS_CACHE_LOCK:
+        cached = PROBLEMS_CACHE.get(DATA_FILE)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+    problems = load_problems_from_json(report_type, report_name)
+    with PROBLEMS_CACHE_LOCK:
+        PROBLEMS_CACHE[DATA_FILE] = (signature, problems)
+    return problems
+
 def save_problems_to_json(report_type, report_name, data):
     dirname = current_app.config[f'{report_type.upper()}_SAVE_DIR']
     DATA_FILE = os.path.join(dirname, f"{report_name}_problems.json")
     with open(DATA_FILE, 'w', encoding='utf-8') as f:
         json.dump(data, f, ensure_ascii=False, indent=4)
+    get_grade_store(current_app).problems_saved(report_type, report_name, data)
+    overview = current_app.config.get('REPORT_OVERVIEW')
+    if overview is not None and report_type == 'pdf':
+        overview.problems_changed(report_name)
+    if report_type == 'pdf':
+        notify_change(current_app, "problems", report_name)
 
 def load_grades_from_json(report_type, report_name, student_name):
-    dirname = os.path.join(current_app.config[f'{report_type.upper()}_SAVE_DIR'], report_name)
-    GRADES_FILE = os.path.join(dirname, f"{student_name}.json")
-    if os.path.exists(GRADES_FILE):
-        with open(GRADES_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {}
+    # 保存先は GRADE_STORE の設定による（既定は学生ごとのJSONファイル）
+    return get_grade_store(current_app).load(report_type, report_name, student_name)
 
-def save_grades_to_json(report_type, report_name, student_name, grades):
-    dirname = os.path.join(current_app.config[f'{report_type.upper()}_SAVE_DIR'], report_name)
-    if not os.path.exists(dirname):
-        os.makedirs(dirname)
-    GRADES_FILE = os.path.join(dirname, f"{student_name}.json")
-    with open(GRADES_FILE, 'w', encoding='utf-8') as f:
-        json.dump(grades, f, ensure_ascii=False, indent=4)
+def save_grades_to_json(report_type, report_name, student_name, grades, expected_version=None):
+    """
+    採点結果を保存し、新しいバージョンを返す。
+    expected_version を渡すと、読み込んだ後に他から保存されていた場合は保存せずに GradeConflict を送出する。
+    """
+    version = get_grade_store(current_app).save(report_type, report_name, student_name, grades, expected_version)
+    grades_saved(report_type, report_name, student_name)
+    return version
+
+def apply_grade_changes(report_type, report_name, student_name, changes):
+    """
+    変更された評価だけを保存し、(保存した後の採点結果, 新しいバージョン) を返す。
+    changes は {"grade_{問題ID}": 評価} で、評価が None のものは取り消す。
+    """
+    grades, version = get_grade_store(current_app).apply_changes(report_type, report_name, student_name, changes)
+    grades_saved(report_type, report_name, student_name)
+    return grades, version
+
+def grades_saved(report_type, report_name, student_name):
+    # レポート一覧のキャッシュは、この学生の行だけを計算し直す
+    overview = current_app.config.get('REPORT_OVERVIEW')
+    if overview is not None and report_type == 'pdf':
+        overview.grade_changed(report_name, student_name)
+    if report_type == 'pdf':
+        notify_change(current_app, "grade", report_name, student_name)
 
 def check_all_grades_entered(problems, grades):
     for problem_id in problems['order']:
@@ -86,40 +254,57 @@ def check_all_grades_entered(problems, grades):
             return False
     return True
 
+def get_finished_status(report_type, report_name, student_names, problems=None):
+    """学生ごとに、全ての問題の採点が終わっているかどうかのリストを返す"""
+    if problems is None:
+        problems = get_problems(report_type, report_name)
+    return get_grade_store(current_app).finished(report_type, report_name, student_names, problems)
+
+def find_next_unfinished_students(report_type, report_name, student_names, problems, current_student_index, count):
+    """current_student_index の次から順に（最後まで行ったら先頭に戻って）未完了の学生を最大 count 人探す"""
+    finished = get_finished_status(report_type, report_name, student_names, problems)
+    indices = []
+    order = list(range(current_student_index + 1, len(student_names))) + list(range(0, current_student_index))
+    for idx in order:
+        if not finished[idx]:
+            indices.append(idx)
+            if len(indices) >= count:
+                break
+    return indices
+
 def find_next_unfinished_student(report_type, report_name, student_names, problems, current_student_index):
-    for idx in range(current_student_index + 1, len(student_names)):
-        student_name = student_names[idx]
-        grades = load_grades_from_json(report_type, report_name, student_name)
-        if not check_all_grades_entered(problems, grades):
-            return idx, student_name
-    for idx in range(0, current_student_index):
-        student_name = student_names[idx]
-        grades = load_grades_from_json(report_type, report_name, student_name)
-        if not check_all_grades_entered(problems, grades):
-            return idx, student_name
+    indices = find_next_unfinished_students(report_type, report_name, student_names, problems, current_student_index, 1)
+    if indices:
+        return indices[0], student_names[indices[0]]
     return None, None
 
 
-def get_enrolled_students(report_type):
+def find_workbook(report_type, keyword):
+    """{種類}_BASE_DIR にある、名前に keyword を含むExcelファイルのパス（無い・複数ある場合は None）"""
     dirname = current_app.config[f'{report_type.upper()}_BASE_DIR']
     print(f"Looking for enrolled student files in directory: {dirname}")
     
     # .xls と .xlsx 両方に対応できるようにしておくとより安全です
-    target_files = glob.glob(os.path.join(dirname, "*seiseki*.xls*"))
+    target_files = glob.glob(os.path.join(dirname, f"*{keyword}*.xls*"))
     
     print(f"Enrolled student files found: {target_files}")
     if not target_files:
-        print("エラー: 'seiseki' を含むファイルが見つかりませんでした。")
+        print(f"エラー: '{keyword}' を含むファイルが見つかりませんでした。")
         return None
     if len(target_files) > 1:
-        print("エラー: 'seiseki' を含むファイルが複数見つかりました。")
+        print(f"エラー: '{keyword}' を含むファイルが複数見つかりました。")
+        return None
+    return target_files[0]
+
+
+def get_enrolled_students(report_type):
+    target_file = find_workbook(report_type, "seiseki")
+    if target_file is None:
         return None
-        
-    target_file = target_files[0]
     print(f"Loading enrolled students from file: {target_file}")
     
-    import pandas as pd
-    df = pd.read_excel(target_file)
+    # Excelの解析は遅いので、読み込んだ結果をキャッシュから取り出す
+    df = get_workbook_cache(current_app).read(target_file)
 
     # --- ここで元の順番を保持する列を追加 ---
     # reset_index()により、その時点の行番号が 'index' 列として追加されます
@@ -133,22 +318,9 @@ def get_enrolled_students(report_type):
     return df
 
 def get_point(report_type, report_name, student_name):
-    problems = load_problems_from_json(report_type, report_name)
-    grades = load_grades_from_json(report_type, report_name, student_name)
-   
-    student_point = 0
-    total_point = 0
-    for problem_id in problems['order']:
-        point = problems.get('points', {}).get(problem_id, 0)
-        total_point += point
-        grade = grades.get(f"grade_{problem_id}", 0)
-        if grade == "circle":
-            student_point += point
-        elif grade == "triangle":
-            student_point += point / 2
-        # else: 0点として加算しない
-        
-    return student_point, total_point
+    """(学生の得点, 満点) を返す"""
+    problems = get_problems(report_type, report_name)
+    return get_grade_store(current_app).point(report_type, report_name, student_name, problems)
 
 
 def load_report_settings(app=None):
@@ -177,9 +349,12 @@ def load_report_settings(app=None):
         except Exception as e:
             print(f"設定ファイルの読み込み失敗: {e}")
             
-    # Flaskのconfigに反映
+    # Flaskのconfigに反映（ファイルが書き換えられていたら、他のワーカープロセスにも伝える）
+    changed = any(app.config.get(key) != value for key, value in default_settings.items())
     for key, value in default_settings.items():
         app.config[key] = value
+    if changed:
+        publish_report_settings(app, default_settings)
     return default_settings
 
 def save_report_settings_to_file(data, app=None):
@@ -206,47 +381,32 @@ def save_report_settings_to_file(data, app=None):
     # 2. 現在のアプリ設定を更新
     for key, value in settings.items():
         app.config[key] = value
+    publish_report_settings(app, settings)
 
         
 
+def is_outdated(path, sources):
+    """path が無いか、sources のどれかより古いときに True"""
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return True
+    return any(os.stat(source).st_mtime_ns > mtime for source in sources)
+
+
 def summarize_problems(report_type, report_name, student_names):
-    summary = {"total": {}, "correct": {}}
-
-    for student_name in student_names:
-        grades = load_grades_from_json(report_type, report_name, student_name)
-        for k, v in grades.items():
-            problem_id = k.replace("grade_", "")
-            if problem_id not in summary["total"]:
-                summary["total"][problem_id] = 0
-                summary["correct"][problem_id] = 0
-            if v in ["circle", "triangle", "cross"]:
-                summary["total"][problem_id] += 1
-                if v == "circle":
-                    summary["correct"][problem_id] += 1
-    return summary
+    """問題ごとの採点数 (total) と正答数 (correct) を返す"""
+    return get_grade_store(current_app).summary(report_type, report_name, student_names)
 
 
 def get_attendance(report_type):
-    dirname = current_app.config[f'{report_type.upper()}_BASE_DIR']
-    print(f"Looking for enrolled student files in directory: {dirname}")
-    
-    # .xls と .xlsx 両方に対応できるようにしておくとより安全です
-    target_files = glob.glob(os.path.join(dirname, "*出席*.xls*"))
-    
-    print(f"Enrolled student files found: {target_files}")
-    if not target_files:
-        print("エラー: '出席' を含むファイルが見つかりませんでした。")
-        print(os.listdir(dirname))
+    target_file = find_workbook(report_type, "出席")
+    if target_file is None:
         return None
-    if len(target_files) > 1:
-        print("エラー: '出席' を含むファイルが複数見つかりました。")
-        return None
-        
-    target_file = target_files[0]
     print(f"Loading enrolled students from file: {target_file}")
     
     import pandas as pd
-    df = pd.read_excel(target_file, sheet_name=None)
+    df = get_workbook_cache(current_app).read(target_file, sheet_name=None)
     all_emails = set()
     sheet_email_sets = {}
     for sheet_name, df_ in df.items():
@@ -274,7 +434,11 @@ def get_attendance(report_type):
     df_attendance = df_attendance.fillna("×")
     is_within_limit = (df_attendance == '×').sum(axis=1) <= 5
     df_attendance['判定'] = is_within_limit.map({True: '◎', False: '×'})
-    df_attendance.to_excel(os.path.join(current_app.config[report_type.upper() + '_SAVE_DIR'], 'attendance_summary.xlsx'), index=False)
+    # 集計結果のファイルは、出席や名簿のファイルが更新されたときだけ書き出し直す
+    summary_path = os.path.join(current_app.config[report_type.upper() + '_SAVE_DIR'], 'attendance_summary.xlsx')
+    sources = [target_file, find_workbook(report_type, "seiseki")]
+    if is_outdated(summary_path, [path for path in sources if path is not None]):
+        df_attendance.to_excel(summary_path, index=False)
     return {
         "enrolled": df_attendance.to_dict(orient='records'),
         "unlisted": unlisted.to_dict(orient='records') if unlisted is not None else [],
@@ -0,0 +1,182 @@
+import os
+import sys
+import time
+import select
+import ctypes
+import ctypes.util
+import threading
+import atexit
+
+from grader_app.archive import is_partial_dir
+
+# inotify のイベント (linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+
+class Inotify:
+    """
+    Linux の inotify を ctypes で使い、フォルダの直下に変化があったことを知る。
+    何が変わったかはイベントからは読み取らず、呼び出し側でフォルダを読み直す。
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    @classmethod
+    def create(cls, dirs):
+        """inotify を使えない環境（Linux 以外など）では None を返す"""
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        for d in dirs:
+            if libc.inotify_add_watch(fd, os.fsencode(d), WATCH_MASK) < 0:
+                os.close(fd)
+                return None
+        return cls(fd)
+
+    def wait(self, timeout):
+        """変化の通知が届いたら（読み捨てて）True、timeout 秒の間に届かなければ False を返す"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DirectoryWatcher:
+    """
+    PDF_BASE_DIR と CODE_BASE_DIR の直下で、提出フォルダとzipが追加・削除されたことを検出し、
+    on_change(フォルダ, 追加された名前のリスト, 削除された名前のリスト) を呼ぶ。
+    inotify が使えればそれで変化を待ち、使えなければ interval 秒ごとにフォルダを読み直す。
+    コピー中のzipを読まないよう、更新されてから debounce 秒経っていないzipは、まだ無いものとして扱う。
+    """
+
+    def __init__(self, dirs, on_change, interval=2.0, debounce=1.0):
+        self.dirs = list(dirs)
+        self.on_change = on_change
+        self.interval = interval
+        self.debounce = debounce
+        self._known = {}
+        for d in self.dirs:
+            self._known[d], _ = self._snapshot(d)
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """監視用のスレッドを起動する（2回目以降は何もしない）"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="report-watcher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def check(self):
+        """
+        前回からの変化を on_change に渡す。
+        まだ書き込み中かもしれないzipがあれば True を返す（少し後にもう一度確認する）。
+        """
+        waiting = False
+        for d in self.dirs:
+            entries, unready = self._snapshot(d)
+            added = sorted(entries - self._known[d])
+            removed = sorted(self._known[d] - entries)
+            self._known[d] = entries
+            if added or removed:
+                print(f"{d} の変更を検出しました。追加: {added} 削除: {removed}")
+                try:
+                    self.on_change(d, added, removed)
+                except Exception as e:
+                    print(f"エラー: {d} の変更を反映できませんでした。エラー: {e}")
+            waiting = waiting or unready
+        return waiting
+
+    def _snapshot(self, d):
+        """(提出フォルダとzipの名前の集合, 書き込み中かもしれないzipがあるか)"""
+        entries = set()
+        unready = False
+        try:
+            scanned = list(os.scandir(d))
+        except FileNotFoundError:
+            return entries, False
+        now = time.time()
+        for entry in scanned:
+            try:
+                if entry.is_dir():
+                    if not is_partial_dir(entry.name):
+                        entries.add(entry.name)
+                elif entry.name.lower().endswith('.zip'):
+                    if now - entry.stat().st_mtime < self.debounce:
+                        unready = True
+                    else:
+                        entries.add(entry.name)
+            except FileNotFoundError:
+                continue
+        return entries, unready
+
+    def _run(self):
+        inotify = Inotify.create(self.dirs)
+        if inotify is None:
+            print(f"inotify を使えないため、{self.interval}秒ごとに提出フォルダを確認します。")
+        waiting = False
+        try:
+            while not self._stop.is_set():
+                if inotify is not None:
+                    # 停止の指示に気づけるよう、1秒ごとに起きる
+                    if not inotify.wait(self.debounce if waiting else 1.0) and not waiting:
+                        continue
+                    # 大きなzipのコピーなど、続けて届く変化が落ち着くまで待つ
+                    while inotify.wait(self.debounce):
+                        pass
+                else:
+                    if self._stop.wait(self.debounce if waiting else self.interval):
+                        break
+                waiting = self.check()
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+
+def create_watcher(app):
+    """設定 (WATCH_ENABLED) に応じて DirectoryWatcher を作成し、app.config に登録する"""
+    if not app.config.get('WATCH_ENABLED', False):
+        app.config['REPORT_WATCHER'] = None
+        return None
+
+    def on_change(target_dir, added, removed):
+        from grader_app.utils import apply_directory_changes
+        with app.app_context():
+            apply_directory_changes(app, target_dir, added, removed)
+
+    watcher = DirectoryWatcher(
+        [app.config['PDF_BASE_DIR'], app.config['CODE_BASE_DIR']],
+        on_change,
+        interval=app.config.get('WATCH_INTERVAL', 2.0),
+        debounce=app.config.get('WATCH_DEBOUNCE', 1.0),
+    )
+    atexit.register(watcher.stop)
+    app.config['REPORT_WATCHER'] = watcher
+    return watcher
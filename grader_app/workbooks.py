@@ -0,0 +1,103 @@
+import os
+import pickle
+import hashlib
+import threading
+
+from grader_app.models import write_file_atomic
+
+SIDECAR_VERSION = 1
+
+
+def workbook_sha1(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class WorkbookCache:
+    """
+    名簿 (seiseki) や出席の Excel ファイルを読み込んだ結果のキャッシュ。
+    pd.read_excel の結果（DataFrame またはシート名 -> DataFrame の dict）を、
+    cache_dir に pickle のファイル（サイドカー）として保存しておく。
+    ファイルのサイズと更新時刻が同じならそのまま使い、更新時刻だけが変わった場合は
+    内容のハッシュが同じかどうかを確かめてから使う。
+    読み込みは、必要になったとき（read を呼んだとき）に初めて行う。
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        self._frames = {}  # (path, sheet_name) -> (サイズ, 更新時刻, 読み込んだ結果)
+
+    def read(self, path, sheet_name=0):
+        """pd.read_excel(path, sheet_name=sheet_name) と同じものを返す（呼び出し側で書き換えてよい）"""
+        st = os.stat(path)
+        key = (os.path.abspath(path), sheet_name)
+        with self._lock:
+            cached = self._frames.get(key)
+            if cached is None or cached[:2] != (st.st_size, st.st_mtime_ns):
+                cached = (st.st_size, st.st_mtime_ns, self._load(path, sheet_name, st))
+                self._frames[key] = cached
+        return copy_frames(cached[2])
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+
+    def _sidecar_path(self, path, sheet_name):
+        name = hashlib.sha1(repr((os.path.abspath(path), sheet_name)).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{os.path.basename(path)}_{name}.pkl")
+
+    def _load(self, path, sheet_name, st):
+        sidecar_path = self._sidecar_path(path, sheet_name)
+        sidecar = None
+        try:
+            with open(sidecar_path, 'rb') as f:
+                sidecar = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            pass
+        if sidecar is not None and sidecar.get("version") == SIDECAR_VERSION:
+            if sidecar["size"] == st.st_size and sidecar["mtime"] == st.st_mtime_ns:
+                return sidecar["frames"]
+            sha1 = workbook_sha1(path)
+            if sidecar["size"] == st.st_size and sidecar["sha1"] == sha1:
+                # 内容は同じ（コピーし直しただけなど）なので、更新時刻だけ書き換える
+                sidecar["mtime"] = st.st_mtime_ns
+                self._save(sidecar_path, sidecar)
+                return sidecar["frames"]
+        else:
+            sha1 = workbook_sha1(path)
+
+        import pandas as pd
+        print(f"Excelファイルを読み込みます: {path}")
+        frames = pd.read_excel(path, sheet_name=sheet_name)
+        self._save(sidecar_path, {
+            "version": SIDECAR_VERSION,
+            "size": st.st_size,
+            "mtime": st.st_mtime_ns,
+            "sha1": sha1,
+            "frames": frames,
+        })
+        return frames
+
+    def _save(self, sidecar_path, sidecar):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # 書きかけのファイルを読まれないよう、一時ファイルに書いてから置き換える
+        write_file_atomic(sidecar_path, pickle.dumps(sidecar, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def copy_frames(frames):
+    if isinstance(frames, dict):
+        return {name: df.copy() for name, df in frames.items()}
+    return frames.copy()
+
+
+def get_workbook_cache(app):
+    """app.config の WorkbookCache を返す（無ければ作る）"""
+    cache = app.config.get('WORKBOOK_CACHE')
+    if cache is None:
+        cache = WorkbookCache(app.config['WORKBOOK_CACHE_DIR'])
+        app.config['WORKBOOK_CACHE'] = cache
+    return cache
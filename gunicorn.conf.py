@@ -0,0 +1,20 @@
+# gunicorn の設定: gunicorn -c gunicorn.conf.py wsgi:app
+import os
+
+bind = os.environ.get("GRADER_BIND", "127.0.0.1:8000")
+workers = int(os.environ.get("GRADER_WORKERS", "4"))
+# 画像のストリーミング (Server-Sent Events) や自動保存でワーカーが埋まらないよう、スレッドも使う
+worker_class = "gthread"
+threads = int(os.environ.get("GRADER_THREADS", "8"))
+# 大きなPDFの画像をその場で作ることがあるので、長めにする
+timeout = 120
+
+# create_app（フォルダのスキャン・設定の読み込みなど）を親プロセスで1回だけ行い、フォークしたワーカーに引き継ぐ
+preload_app = True
+
+
+def post_worker_init(worker):
+    # 画像の事前生成・zipの展開・フォルダの監視は、ロックを取れた1つのワーカーだけが行う
+    # （そのワーカーが終了すると、次に起動したワーカーが引き継ぐ）
+    from grader_app.shared import start_background_services
+    start_background_services(worker.wsgi)
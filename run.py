@@ -4,4 +4,5 @@ app = create_app()
 
 if __name__ == '__main__':
     # デバッグモードをONにすると、コード変更が即反映されます
+    # （本番では wsgi.py を gunicorn / waitress で動かす）
     app.run(debug=True, port=5000)
\ No newline at end of file
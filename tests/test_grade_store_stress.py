@@ -0,0 +1,129 @@
+"""
+複数の採点者が同じ学生を同時に採点しても、評価が失われないことを確かめる（JSONとSQLiteの両方の保存先）。
+ビューアと同じように、採点結果の保存 (save_grades) と差分の自動保存 (save_grade_changes) に並行して POST する。
+
+    python -m pytest tests/test_grade_store_stress.py
+"""
+import os
+import random
+import threading
+
+import pytest
+from flask import Flask
+
+from grader_app.grade_index import GRADE_MARKS
+from grader_app.models import NO_VERSION, get_grade_store
+from grader_app.pdf_grader.catalog import get_catalog
+from grader_app.pdf_grader.routes import pdf_bp
+
+CLIENTS = 8
+REQUESTS = 400
+REPORT = "第1回レポート-課題1"
+STUDENT = "学生A"
+SAVE_URL = "/pdf/0/0/save_grades"
+CHANGES_URL = "/pdf/0/save_grade_changes/"
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def app(request, tmp_path):
+    raw = f"{REPORT}の提出(詳細)"
+    os.makedirs(tmp_path / "submissions" / raw / f"{STUDENT}_100_assignsubmission_file_")
+    app = Flask(__name__)
+    app.config.update(
+        GRADE_STORE=request.param,
+        PDF_SAVE_DIR=str(tmp_path),
+        GRADE_DB_PATH=str(tmp_path / "grades.sqlite3"),
+        PDF_BASE_DIR=str(tmp_path / "submissions"),
+        PDF_LIST=[REPORT],
+    )
+    app.register_blueprint(pdf_bp)
+    get_catalog(app).update([raw])
+    return app
+
+
+def run_clients(app, worker):
+    """CLIENTS 人の採点者 (worker(n, client)) を同時に動かす"""
+    errors = []
+    barrier = threading.Barrier(CLIENTS)
+
+    def run(n):
+        try:
+            client = app.test_client()
+            barrier.wait()
+            worker(n, client)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(CLIENTS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+
+
+def load_grades(app):
+    with app.app_context():
+        return get_grade_store(app).load("pdf", REPORT, STUDENT)
+
+
+def lost_grades(app):
+    grades = load_grades(app)
+    return [i for i in range(REQUESTS) if f"grade_stress_{i}" not in grades]
+
+
+def test_concurrent_save_grades(app):
+    """
+    各採点者はビューアの全体保存と同じように、読み込んだときのバージョンを付けて保存し、
+    競合 (409) したら返ってきた最新の採点結果に自分の評価を加えて保存し直す。
+    """
+    conflicts = []
+
+    def worker(n, client):
+        grades, version = {}, NO_VERSION
+        for i in range(n, REQUESTS, CLIENTS):
+            grades[f"grade_stress_{i}"] = random.choice(GRADE_MARKS)
+            while True:
+                response = client.post(SAVE_URL, json={"grades": grades, "version": version})
+                if response.status_code == 200:
+                    version = response.json["version"]
+                    break
+                assert response.status_code == 409
+                assert response.json["status"] == "conflict"
+                conflicts.append(n)
+                # 自分が付けた評価だけを残して、最新の採点結果に重ねる
+                mine = {k: v for k, v in grades.items() if int(k.rsplit("_", 1)[1]) % CLIENTS == n}
+                grades = {**response.json["grades"], **mine}
+                version = response.json["version"]
+
+    run_clients(app, worker)
+    assert conflicts != []
+    assert lost_grades(app) == []
+
+
+def test_concurrent_save_grade_changes(app):
+    """差分の自動保存は、他の採点者が変更していない問題の評価を消さない"""
+
+    def worker(n, client):
+        for seq, i in enumerate(range(n, REQUESTS, CLIENTS), 1):
+            response = client.post(CHANGES_URL, json={
+                "client": f"stress-{n}",
+                "students": [{"student_index": 0, "seq": seq, "changes": {f"grade_stress_{i}": random.choice(GRADE_MARKS)}}],
+            })
+            assert response.status_code == 200
+            assert response.json["results"][0]["applied"]
+
+    run_clients(app, worker)
+    assert lost_grades(app) == []
+
+
+def test_stale_version_is_rejected(app):
+    client = app.test_client()
+    version = client.post(SAVE_URL, json={"grades": {"grade_q1": "circle"}, "version": NO_VERSION}).json["version"]
+    client.post(SAVE_URL, json={"grades": {"grade_q1": "cross"}, "version": version})
+    response = client.post(SAVE_URL, json={"grades": {"grade_q1": "triangle"}, "version": version})
+    assert response.status_code == 409
+    assert response.json["status"] == "conflict"
+    assert response.json["grades"] == {"grade_q1": "cross"}
+    assert response.json["version"] != version
+    assert load_grades(app) == {"grade_q1": "cross"}
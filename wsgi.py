@@ -0,0 +1,25 @@
+"""
+本番用のエントリーポイント（run.py はデバッグ用の開発サーバー）。
+
+    gunicorn -c gunicorn.conf.py wsgi:app   # Linux / macOS: 複数のワーカープロセス
+    python wsgi.py                          # waitress (Windowsでも動く): 1プロセス・複数スレッド
+
+gunicorn と waitress は別途インストールする (pip install gunicorn / pip install waitress)。
+"""
+import os
+from grader_app import create_app
+from grader_app.shared import warm_caches
+
+# gunicorn.conf.py の preload_app により、フォルダのスキャンや設定の読み込みは親プロセスで1回だけ行われ、
+# 読み込んだ学生名簿・採点結果の集計はワーカーに引き継がれる
+app = create_app(production=True)
+warm_caches(app)
+
+if __name__ == '__main__':
+    from waitress import serve
+    serve(
+        app,
+        host=os.environ.get("GRADER_HOST", "127.0.0.1"),
+        port=int(os.environ.get("GRADER_PORT", "8000")),
+        threads=int(os.environ.get("GRADER_THREADS", "8")),
+    )